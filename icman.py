@@ -8,21 +8,36 @@
 # ~/.config/nemo/desktop-metadata
 
 import os
+import argparse
 import subprocess
 import json
+import hashlib
+import re
+import urllib.parse
+import struct
+import mmap
+import array
+import operator
 import appdirs
-import glob
 import tempfile
 import shutil
 import datetime
 import time
-
-import ctypes.util
-
-# from tkinter import *
-from tkinter import Tk, Listbox, StringVar, Scrollbar, N, W, S, E
-from tkinter import simpledialog
-from tkinter import ttk
+import signal
+import select
+import threading
+import queue
+import zlib
+import pwd
+import concurrent.futures
+import bisect
+import collections
+import stat
+import errno
+
+# ctypes.util, X11/XRandR, libgio and tkinter are loaded on first use, so
+# the command line mode starts without them
+import ctypes
 
 
 #######################################################
@@ -31,7 +46,12 @@ APP_NAME = 'icman'
 
 META_PATH_HOLDER = '~~META~~'
 
-NEMO_DESKTOP_NAME = "nemo-desktop"
+NEMO_DESKTOP_NAME = os.environ.get('ICMAN_NEMO_DESKTOP', "nemo-desktop")
+
+# seconds to wait after SIGTERM before SIGKILL, and again after SIGKILL
+NEMO_STOP_TIMEOUT = float(os.environ.get('ICMAN_NEMO_STOP_TIMEOUT', '5'))
+# poll step for processes which can't be waited on through a pidfd
+NEMO_POLL_STEP = 0.02
 
 HOME_DIR = os.path.expanduser("~")
 CONFIG_DIR = appdirs.user_config_dir(APP_NAME)
@@ -41,10 +61,50 @@ NEMO_NAME = "nemo"
 NEMO_META_FILE_NAME = "desktop-metadata"
 NEMO_META_PATH = "{}/{}".format(appdirs.user_config_dir(NEMO_NAME),
                                 NEMO_META_FILE_NAME)
+# gvfsd-metadata keeps the gio metadata of the Desktop files here
+GVFS_META_DIR = appdirs.user_data_dir('gvfs-metadata')
 
 DATA_FILE_EXT = "jdat"
 
-HDR1 = 'local path:'
+# json - indented json list, bin - packed binary profile (same extension,
+# told apart by the magic header on load)
+PROFILE_FORMAT = os.environ.get('ICMAN_PROFILE_FORMAT', 'json')
+# json profiles are {version, monitors, icons}, version 1 was a bare list
+PROFILE_JSON_VERSION = 2
+
+CATALOG_FILE_NAME = ".catalog.json"
+JOURNAL_FILE_NAME = ".journal.jsonl"
+CATALOG_VERSION = 2
+
+# layout thumbnails, cached as binary ppm files named by profile checksum
+THUMB_DIR_NAME = ".thumbs"
+THUMB_W = 64
+THUMB_H = 36
+THUMB_BG = b'\xff\xff\xff'
+THUMB_MON_FILL = b'\xd8\xde\xe4'
+THUMB_MON_EDGE = b'\x78\x82\x8c'
+THUMB_ICON = b'\x28\x5a\xa0'
+
+# parsed profiles kept in memory: the least recently used ones are dropped
+# once either budget is exceeded, 0 disables the cache
+PROFILE_CACHE_BYTES = int(os.environ.get('ICMAN_PROFILE_CACHE_BYTES',
+                                         str(32 * 1024 * 1024)))
+PROFILE_CACHE_ENTRIES = int(os.environ.get('ICMAN_PROFILE_CACHE_ENTRIES',
+                                           '64'))
+
+# snapshot history: objects/ holds zlib compressed chunks of icon records
+# named by their sha1, profiles/<name>/<seq>.json the manifests listing them
+SNAPSHOT_DIR_NAME = ".snapshots"
+SNAPSHOT_VERSION = 1
+# a chunk ends after a record whose crc32 has these bits clear (64 records
+# on average) or at SNAPSHOT_CHUNK_MAX records, so a moved icon changes
+# only its own chunk
+SNAPSHOT_CHUNK_MASK = 0x3f
+SNAPSHOT_CHUNK_MAX = 256
+# default retention: the newest versions plus the last one of each day
+SNAPSHOT_KEEP_LAST = 24
+SNAPSHOT_KEEP_DAILY = 30
+
 NIC_HDR = 'nemo-icon-position'
 HDR2 = f'metadata::{NIC_HDR}'
 
@@ -53,21 +113,155 @@ HDR3 = f'metadata::{MON_HDR}'
 
 DESK_MON_HDR = 'desktop-monitor'
 
-LHDR1 = len(HDR1)
+URI_HDR = 'uri:'
+FILE_URI_PREFIX = 'file://'
+
+LURI_HDR = len(URI_HDR)
 LNIC_HDR = len(NIC_HDR)
 LHDR2 = len(HDR2)
 LMON_HDR = len(MON_HDR)
 LHDR3 = len(HDR3)
 
 
-LOAD_DESKTOP_ICONS_CMD = ('gio info --attributes=metadata:: ~/Desktop/* '
-                          f'| grep "{HDR1}\\|{HDR2}:\\|{HDR3}"')
+DESKTOP_DIR = f'{HOME_DIR}/Desktop'
+
+GIO_INFO_CMD = ['gio', 'info', '--attributes=metadata::']
+GIO_INFO_BATCH = 512
+GIO_ENUM_ATTRS = f'standard::name,{HDR2},{HDR3}'.encode()
+
+GIO_SET_CMD = ['gio', 'set']
 
-GIO_SET_ICONS_POS_CMD_TPL = f'gio set "{{}}" {HDR2} {{}},{{}}'
-GIO_SET_ICONS_MON_CMD_TPL = f'gio set "{{}}" {HDR3} {{}}'
+# auto - in-process libgio with fallback to gio cli, lib - libgio only,
+# cli - one 'gio set' process per attribute
+GIO_BACKEND = os.environ.get('ICMAN_GIO_BACKEND', 'auto')
 
 E_GEN = ('metadata format changed, current version is non-operable.')
 
+# chrome trace (chrome://tracing, ui.perfetto.dev) of the save and apply
+# phases is written to this file, --trace FILE does the same
+TRACE_FILE = os.environ.get('ICMAN_TRACE', '')
+
+# counters recorded per span and in total
+TRACE_COUNTERS = ('spawns', 'bytes_read', 'bytes_written')
+
+#######################################################
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _TraceSpan:
+    __slots__ = ('tracer', 'name', 'args', 't0', 'c0')
+
+    def __init__(self, tracer_, name_, args_):
+        self.tracer = tracer_
+        self.name = name_
+        self.args = args_
+
+    def __enter__(self):
+        self.c0 = dict(self.tracer.counters)
+        self.t0 = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type_, exc_, tb_):
+        t1 = time.perf_counter_ns()
+        tr = self.tracer
+        args = dict(self.args)
+        for k, v in tr.counters.items():
+            if v != self.c0[k]:
+                args[k] = v - self.c0[k]
+        if exc_type_ is not None:
+            args['error'] = exc_type_.__name__
+        tr.events.append({'name': self.name, 'cat': APP_NAME, 'ph': 'X',
+                          'ts': (self.t0 - tr.t0) / 1000,
+                          'dur': (t1 - self.t0) / 1000,
+                          'pid': tr.pid, 'tid': threading.get_ident(),
+                          'args': args})
+        return False
+
+
+# phase timings and spawn / io counters; disabled it hands out one shared
+# no-op span and Count returns after a single attribute check
+class Tracer:
+
+    def __init__(self):
+        self.enabled = False
+        self.fp = None
+        self.events = []
+        self.counters = dict.fromkeys(TRACE_COUNTERS, 0)
+        self.pid = os.getpid()
+        self.t0 = 0
+
+    def Enable(self, fp_):
+        self.enabled = True
+        self.fp = fp_
+        self.events = []
+        self.counters = dict.fromkeys(TRACE_COUNTERS, 0)
+        self.t0 = time.perf_counter_ns()
+
+    def Span(self, name_, **args_):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _TraceSpan(self, name_, args_)
+
+    def Count(self, key_, n_=1):
+        if self.enabled:
+            self.counters[key_] += n_
+
+    # size of a path or an open fd, for files read or written whole
+    def CountFile(self, key_, f_):
+        if self.enabled:
+            try:
+                self.counters[key_] += os.stat(f_).st_size
+            except OSError:
+                pass
+
+    # passes the lines through, counting their length
+    def CountLines(self, key_, lines_):
+        if not self.enabled:
+            return lines_
+        return self._CountLines(key_, lines_)
+
+    def _CountLines(self, key_, lines_):
+        for line in lines_:
+            self.counters[key_] += len(line)
+            yield line
+
+    def Summary(self):
+        totals = {}
+        for e in self.events:
+            t = totals.setdefault(e['name'], [0, 0.0])
+            t[0] += 1
+            t[1] += e['dur'] / 1000
+        return totals
+
+    def Save(self):
+        if not self.enabled or not self.fp:
+            return
+        data = {'traceEvents': self.events,
+                'displayTimeUnit': 'ms',
+                'otherData': {'counters': self.counters}}
+        with open(self.fp, 'wt') as outf:
+            json.dump(data, outf)
+        for name, (cnt, ms) in sorted(self.Summary().items()):
+            print(f'trace: {name:24} {cnt:5} x {ms:10.3f} ms',
+                  file=os.sys.stderr)
+        print(f'trace: {self.counters}, written to {self.fp}',
+              file=os.sys.stderr)
+
+
+TRACE = Tracer()
+
 #######################################################
 
 
@@ -81,6 +275,13 @@ class Monitor:
         else:
             self.__dict__.update(kwargs)
 
+    def ToDict(self):
+        return {'x': self.x, 'y': self.y, 'w': self.w, 'h': self.h,
+                'name': self.name}
+
+    def Key(self):
+        return (self.name, self.x, self.y, self.w, self.h)
+
     def __str__(self):
         return str(vars(self))
 
@@ -161,63 +362,804 @@ class XRROutputInfo(ctypes.Structure):
 #######################
 
 
-def GetMonitorsInfo():
+FAKE_MONITORS = os.environ.get('ICMAN_MONITORS', '')
+FAKE_MONITOR_RE = re.compile(r'^(\d+)x(\d+)\+(-?\d+)\+(-?\d+)$')
 
-    results = []
+# RandR event selection masks and event numbers (relative to event base)
+RR_SCREEN_CHANGE_NOTIFY_MASK = 1 << 0
+RR_CRTC_CHANGE_NOTIFY_MASK = 1 << 1
+RR_OUTPUT_CHANGE_NOTIFY_MASK = 1 << 2
+RR_SCREEN_CHANGE_NOTIFY = 0
+RR_NOTIFY = 1
 
-    x11_lib = ctypes.cdll.LoadLibrary(ctypes.util.find_library("X11"))
-    x11_lib.XOpenDisplay.argtypes = [ctypes.c_char_p]
-    x11_lib.XOpenDisplay.restype = ctypes.POINTER(ctypes.c_void_p)
 
-    xrandr_lib = ctypes.cdll.LoadLibrary(ctypes.util.find_library("Xrandr"))
-    xrandr_lib.XRRGetScreenResourcesCurrent.restype = ctypes.POINTER(
-        XRRScreenResources)
-    xrandr_lib.XRRGetOutputInfo.restype = ctypes.POINTER(XRROutputInfo)
-    xrandr_lib.XRRGetCrtcInfo.restype = ctypes.POINTER(XRRCrtcInfo)
+class XEvent(ctypes.Union):
+    _fields_ = [
+        ("type", ctypes.c_int),
+        ("pad", ctypes.c_long * 24),
+    ]
 
-    disp = x11_lib.XOpenDisplay(b"")
-    if not disp:
-        raise RuntimeError("Can't open default display")
 
-    try:
+# keeps X11/XRandR loaded and one display connection open; the monitors
+# layout is cached until RandR reports a screen, crtc or output change
+class MonitorService:
+    instance = None
 
-        wrt = x11_lib.XDefaultRootWindow(disp)
-        sr = xrandr_lib.XRRGetScreenResourcesCurrent(disp, wrt)
+    def __init__(self):
+        self.x11 = None
+        self.xrandr = None
+        self.disp = None
+        self.root = 0
+        self.event_base = 0
+        self.monitors = None
+        self.generation = 0
+        self.lock = threading.RLock()
+
+    def Get():
+        if MonitorService.instance is None:
+            MonitorService.instance = MonitorService()
+        return MonitorService.instance
+
+    def _LoadLibs(self):
+        import ctypes.util
+
+        x11 = ctypes.cdll.LoadLibrary(ctypes.util.find_library("X11"))
+        x11.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        x11.XOpenDisplay.restype = ctypes.POINTER(ctypes.c_void_p)
+        x11.XDefaultRootWindow.restype = ctypes.c_ulong
+        x11.XPending.restype = ctypes.c_int
+        x11.XNextEvent.argtypes = [ctypes.c_void_p, ctypes.POINTER(XEvent)]
+        x11.XConnectionNumber.restype = ctypes.c_int
+
+        xrandr = ctypes.cdll.LoadLibrary(ctypes.util.find_library("Xrandr"))
+        xrandr.XRRGetScreenResourcesCurrent.argtypes = [ctypes.c_void_p,
+                                                        ctypes.c_ulong]
+        xrandr.XRRGetScreenResourcesCurrent.restype = ctypes.POINTER(
+            XRRScreenResources)
+        xrandr.XRRGetOutputInfo.argtypes = [
+            ctypes.c_void_p, ctypes.POINTER(XRRScreenResources),
+            ctypes.c_ulong]
+        xrandr.XRRGetOutputInfo.restype = ctypes.POINTER(XRROutputInfo)
+        xrandr.XRRGetCrtcInfo.argtypes = [
+            ctypes.c_void_p, ctypes.POINTER(XRRScreenResources),
+            ctypes.c_ulong]
+        xrandr.XRRGetCrtcInfo.restype = ctypes.POINTER(XRRCrtcInfo)
+        xrandr.XRRSelectInput.argtypes = [ctypes.c_void_p, ctypes.c_ulong,
+                                          ctypes.c_int]
+        xrandr.XRRUpdateConfiguration.argtypes = [ctypes.POINTER(XEvent)]
+        self.x11 = x11
+        self.xrandr = xrandr
+
+    def _Open(self):
+        if self.x11 is None:
+            self._LoadLibs()
+
+        disp = self.x11.XOpenDisplay(b"")
+        if not disp:
+            raise RuntimeError("Can't open default display")
+
+        ev_base = ctypes.c_int()
+        err_base = ctypes.c_int()
+        if not self.xrandr.XRRQueryExtension(disp, ctypes.byref(ev_base),
+                                             ctypes.byref(err_base)):
+            self.x11.XCloseDisplay(disp)
+            raise RuntimeError("RandR extension is not available")
+
+        self.disp = disp
+        self.root = self.x11.XDefaultRootWindow(disp)
+        self.event_base = ev_base.value
+        self.xrandr.XRRSelectInput(disp, self.root,
+                                   RR_SCREEN_CHANGE_NOTIFY_MASK
+                                   | RR_CRTC_CHANGE_NOTIFY_MASK
+                                   | RR_OUTPUT_CHANGE_NOTIFY_MASK)
+        self.x11.XFlush(disp)
+
+    def Close(self):
+        with self.lock:
+            if self.disp is not None:
+                self.x11.XCloseDisplay(self.disp)
+                self.disp = None
+            self.monitors = None
+
+    def Fileno(self):
+        with self.lock:
+            if self.disp is None:
+                self._Open()
+            return self.x11.XConnectionNumber(self.disp)
+
+    # reads queued events without blocking, returns True if layout changed
+    def ProcessEvents(self):
+        with self.lock:
+            if self.disp is None:
+                self._Open()
+
+            changed = False
+            ev = XEvent()
+            while self.x11.XPending(self.disp) > 0:
+                self.x11.XNextEvent(self.disp, ctypes.byref(ev))
+                t = ev.type - self.event_base
+                if t == RR_SCREEN_CHANGE_NOTIFY:
+                    self.xrandr.XRRUpdateConfiguration(ctypes.byref(ev))
+                    changed = True
+                elif t == RR_NOTIFY:
+                    changed = True
+
+            if changed:
+                self.monitors = None
+                self.generation += 1
+            return changed
+
+    def _Query(self):
+        results = []
+        x11, xrandr, disp = self.x11, self.xrandr, self.disp
+
+        sr = xrandr.XRRGetScreenResourcesCurrent(disp, self.root)
+        if not sr:
+            raise RuntimeError("Can't get screen resources")
 
-        for i in range(sr.contents.noutput):
+        try:
+            for i in range(sr.contents.noutput):
 
-            oi = xrandr_lib.XRRGetOutputInfo(disp, sr, sr.contents.outputs[i])
-            if not oi.contents.crtc or oi.contents.connection != 0:
-                continue
+                oi = xrandr.XRRGetOutputInfo(disp, sr,
+                                             sr.contents.outputs[i])
+                try:
+                    if not oi.contents.crtc or oi.contents.connection != 0:
+                        continue
+
+                    ci = xrandr.XRRGetCrtcInfo(disp, sr, oi.contents.crtc)
+                    try:
+                        m = Monitor(x=ci.contents.x, y=ci.contents.y,
+                                    w=ci.contents.width, h=ci.contents.height,
+                                    name=oi.contents.name.decode(
+                                        os.sys.getfilesystemencoding()))
+                        results.append(m)
+
+                    finally:
+                        xrandr.XRRFreeCrtcInfo(ci)
+                finally:
+                    xrandr.XRRFreeOutputInfo(oi)
+        finally:
+            xrandr.XRRFreeScreenResources(sr)
+
+        x11.XFlush(disp)
+        return results
+
+    # ICMAN_MONITORS=name:WxH+X+Y,... replaces the X query (tests, benches)
+    def _FakeMonitors(spec_):
+        results = []
+        for part in spec_.split(','):
+            name, _, geom = part.rpartition(':')
+            m = FAKE_MONITOR_RE.match(geom.strip())
+            if m is None:
+                raise RuntimeError(f'Invalid ICMAN_MONITORS entry: {part}')
+            w, h, x, y = (int(v) for v in m.groups())
+            results.append(Monitor(x=x, y=y, w=w, h=h, name=name.strip()))
+        return results
+
+    def GetMonitors(self):
+        if FAKE_MONITORS:
+            return MonitorService._FakeMonitors(FAKE_MONITORS)
+
+        with self.lock:
+            self.ProcessEvents()
+            if self.monitors is None:
+                self.monitors = self._Query()
+            return list(self.monitors)
 
+
+def GetMonitorsInfo():
+    with TRACE.Span('monitors'):
+        return MonitorService.Get().GetMonitors()
+
+
+#######################################################
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+INOTIFY_EVENT = struct.Struct('iIII')
+INOTIFY_READ_SIZE = 64 * 1024
+
+
+# non-blocking inotify instance; Fileno() goes into select / Tk file
+# handlers, Read() drains the queued events
+class Inotify:
+    libc = None
+
+    def __init__(self):
+        if Inotify.libc is None:
+            import ctypes.util
+
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                               ctypes.c_uint32]
+            Inotify.libc = libc
+        self.fd = Inotify.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, f'inotify_init1: {os.strerror(e)}')
+        self.paths = {}
+
+    def Watch(self, path_, mask_):
+        wd = Inotify.libc.inotify_add_watch(self.fd, os.fsencode(path_),
+                                            mask_)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, f'inotify_add_watch: {os.strerror(e)}', path_)
+        self.paths[wd] = path_
+        return wd
+
+    def Fileno(self):
+        return self.fd
+
+    # list of (watched path, file name, mask, cookie)
+    def Read(self):
+        events = []
+        while True:
             try:
-                ci = xrandr_lib.XRRGetCrtcInfo(disp, ctypes.byref(oi),
-                                               oi.contents.crtc)
-                try:
-                    m = Monitor(x=ci.contents.x, y=ci.contents.y,
-                                w=ci.contents.width, h=ci.contents.height,
-                                name=oi.contents.name.decode(
-                                    os.sys.getfilesystemencoding()))
-                    results.append(m)
+                buf = os.read(self.fd, INOTIFY_READ_SIZE)
+            except BlockingIOError:
+                break
+            i = 0
+            while i < len(buf):
+                wd, mask, cookie, n = INOTIFY_EVENT.unpack_from(buf, i)
+                i += INOTIFY_EVENT.size
+                name = os.fsdecode(buf[i:i + n].rstrip(b'\0'))
+                i += n
+                events.append((self.paths.get(wd), name, mask, cookie))
+                if mask & IN_IGNORED:
+                    self.paths.pop(wd, None)
+        return events
+
+    def Close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+#######################################################
 
-                finally:
-                    xrandr_lib.XRRFreeCrtcInfo(ci)
-            finally:
-                xrandr_lib.XRRFreeOutputInfo(oi)
-    finally:
-        x11_lib.XCloseDisplay(disp)
 
-    return results
+class GError(ctypes.Structure):
+    _fields_ = [
+        ("domain", ctypes.c_uint32),
+        ("code", ctypes.c_int),
+        ("message", ctypes.c_char_p),
+    ]
+
+
+class GioLib:
+    lib = None
+    load_failed = False
+
+    def _Load():
+        import ctypes.util
+
+        gio = ctypes.cdll.LoadLibrary(ctypes.util.find_library("gio-2.0"))
+        gobj = ctypes.cdll.LoadLibrary(ctypes.util.find_library("gobject-2.0"))
+        glib = ctypes.cdll.LoadLibrary(ctypes.util.find_library("glib-2.0"))
+
+        gio.g_file_new_for_path.argtypes = [ctypes.c_char_p]
+        gio.g_file_new_for_path.restype = ctypes.c_void_p
+        gio.g_file_info_new.argtypes = []
+        gio.g_file_info_new.restype = ctypes.c_void_p
+        gio.g_file_info_set_attribute_string.argtypes = [
+            ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+        gio.g_file_info_set_attribute_string.restype = None
+        gio.g_file_set_attributes_from_info.argtypes = [
+            ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+            ctypes.POINTER(ctypes.POINTER(GError))]
+        gio.g_file_set_attributes_from_info.restype = ctypes.c_int
+
+        gio.g_file_enumerate_children.argtypes = [
+            ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int, ctypes.c_void_p,
+            ctypes.POINTER(ctypes.POINTER(GError))]
+        gio.g_file_enumerate_children.restype = ctypes.c_void_p
+        gio.g_file_enumerator_next_file.argtypes = [
+            ctypes.c_void_p, ctypes.c_void_p,
+            ctypes.POINTER(ctypes.POINTER(GError))]
+        gio.g_file_enumerator_next_file.restype = ctypes.c_void_p
+        gio.g_file_enumerator_close.argtypes = [
+            ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+        gio.g_file_enumerator_close.restype = ctypes.c_int
+        gio.g_file_info_get_name.argtypes = [ctypes.c_void_p]
+        gio.g_file_info_get_name.restype = ctypes.c_char_p
+        gio.g_file_info_get_attribute_string.argtypes = [
+            ctypes.c_void_p, ctypes.c_char_p]
+        gio.g_file_info_get_attribute_string.restype = ctypes.c_char_p
+
+        gobj.g_object_unref.argtypes = [ctypes.c_void_p]
+        gobj.g_object_unref.restype = None
+        glib.g_error_free.argtypes = [ctypes.POINTER(GError)]
+        glib.g_error_free.restype = None
+
+        gio.g_object_unref = gobj.g_object_unref
+        gio.g_error_free = glib.g_error_free
+        return gio
+
+    # returns loaded libgio or None if it's unavailable or disabled
+    def Get():
+        if GIO_BACKEND == 'cli' or GioLib.load_failed:
+            return None
+        if GioLib.lib is None:
+            try:
+                GioLib.lib = GioLib._Load()
+            except (OSError, TypeError, AttributeError) as e:
+                GioLib.load_failed = True
+                if GIO_BACKEND == 'lib':
+                    raise RuntimeError(f"Can't load libgio: {e}")
+        return GioLib.lib
+
+    def TakeError(err_):
+        if not err_:
+            return 'unknown error'
+        msg = err_.contents.message
+        msg = msg.decode('utf-8', 'replace') if msg else 'unknown error'
+        GioLib.lib.g_error_free(err_)
+        return msg
+
+
+# sets position and monitor metadata for a batch of icons: one in-process
+# libgio call per icon, or 'gio set' without shell when libgio is missing
+class GioMetaWriter:
+
+    # run_as_ is a command prefix running gio as another user, which only
+    # the cli backend can do
+    def __init__(self, run_as_=()):
+        self.run_as = list(run_as_)
+        self.lib = GioLib.Get() if not run_as_ else None
+        self.written = 0
+
+    def _WriteLib(self, fp_, attrs_):
+        lib = self.lib
+        f = lib.g_file_new_for_path(os.fsencode(fp_))
+        info = lib.g_file_info_new()
+        err = ctypes.POINTER(GError)()
+        try:
+            for a, v in attrs_:
+                lib.g_file_info_set_attribute_string(info, a.encode(),
+                                                     v.encode())
+            if not lib.g_file_set_attributes_from_info(
+                    f, info, 0, None, ctypes.byref(err)):
+                return GioLib.TakeError(err)
+        finally:
+            lib.g_object_unref(info)
+            lib.g_object_unref(f)
+        return None
+
+    def _WriteCli(self, fp_, attrs_):
+        for a, v in attrs_:
+            TRACE.Count('spawns')
+            r = subprocess.run(self.run_as + GIO_SET_CMD + [fp_, a, v],
+                               capture_output=True, text=True)
+            if r.returncode != 0:
+                return r.stderr.strip() or f'gio exit code {r.returncode}'
+        return None
+
+    # returns list of (path, error message) for icons which were not written;
+    # progress_(done, total_) is called after every icon, a set cancel_ event
+    # stops before the next one and self.written tells how far it got
+    def Write(self, icons_, mon_cnt_, progress_=None, cancel_=None,
+              total_=None):
+        write = self._WriteLib if self.lib is not None else self._WriteCli
+        failed = []
+        total = len(icons_) if total_ is None else total_
+        self.written = 0
+
+        for fp, _, x, y, m in icons_.Rows():
+            if cancel_ is not None and cancel_.is_set():
+                break
+            mon = m if m < mon_cnt_ else 0
+            attrs = ((HDR2, f'{x},{y}'), (HDR3, f'{mon}'))
+            try:
+                err = write(fp, attrs)
+            except OSError as e:
+                err = str(e)
+            if err is not None:
+                failed.append((fp, err))
+            self.written += 1
+            if progress_ is not None:
+                progress_(self.written, total)
+
+        return failed
 
 
 #######################################################
 
 class IconData:
+    __slots__ = ('fp', 'name', 'x', 'y', 'm')
 
-    fp = ''
+    def __init__(self, *args, **kwargs):
+        self.fp = self.name = ''
+        self.x = self.y = self.m = 0
+        for k, v in (args[0] if len(args) > 0 else kwargs).items():
+            setattr(self, k, v)
+
+    def ToDict(self):
+        d = {'fp': self.fp, 'x': self.x, 'y': self.y, 'm': self.m}
+        if self.name:
+            d['name'] = self.name
+        return d
+
+    def __str__(self):
+        return str(self.ToDict())
+
+    def __repr__(self):
+        return str(self)
+
+
+# compact icons collection: coordinates and monitors live in typed arrays,
+# paths and names are interned into one string table
+class IconSet:
+
+    def __init__(self):
+        self.xs = array.array('i')
+        self.ys = array.array('i')
+        self.ms = array.array('i')
+        self.fps = array.array('I')
+        self.names = array.array('I')
+        self.strs = ['']
+        self.str_ids = {'': 0}
+        self.by_fp = None
+        self.by_name = None
+        # layout the icons were saved on
+        self.monitors = []
+
+    def _Intern(self, s_):
+        i = self.str_ids.get(s_)
+        if i is None:
+            i = self.str_ids[s_] = len(self.strs)
+            self.strs.append(s_)
+        return i
+
+    def Append(self, fp_, name_, x_, y_, m_):
+        i = len(self.xs)
+        self.xs.append(x_)
+        self.ys.append(y_)
+        self.ms.append(m_)
+        self.fps.append(self._Intern(fp_))
+        self.names.append(self._Intern(name_))
+        if self.by_fp is not None:
+            self._IndexRow(i)
+        return i
+
+    def Add(self, o_):
+        return self.Append(o_.fp, o_.name, o_.x, o_.y, o_.m)
+
+    def Extend(self, icons_):
+        for o in icons_:
+            self.Add(o)
+        return self
+
+    def FromRecords(records_):
+        return IconSet().Extend(records_)
+
+    def FromDicts(data_):
+        icons = IconSet()
+        for d in data_:
+            icons.Append(d.get('fp', ''), d.get('name', ''), int(d['x']),
+                         int(d['y']), int(d.get('m', 0)))
+        return icons
+
+    def ToDicts(self):
+        return [o.ToDict() for o in self]
+
+    def Path(self, i_):
+        return self.strs[self.fps[i_]]
+
+    def Name(self, i_):
+        return self.strs[self.names[i_]]
+
+    def SetPos(self, i_, x_, y_, m_):
+        self.xs[i_] = x_
+        self.ys[i_] = y_
+        self.ms[i_] = m_
+
+    def __len__(self):
+        return len(self.xs)
+
+    def __getitem__(self, i_):
+        return IconData(fp=self.strs[self.fps[i_]],
+                        name=self.strs[self.names[i_]],
+                        x=self.xs[i_], y=self.ys[i_], m=self.ms[i_])
+
+    def __iter__(self):
+        for i in range(len(self.xs)):
+            yield self[i]
+
+    # bulk iteration: (path, name, x, y, monitor) tuples
+    def Rows(self):
+        strs = self.strs
+        return zip((strs[i] for i in self.fps),
+                   (strs[i] for i in self.names), self.xs, self.ys, self.ms)
+
+    def _IndexRow(self, i_):
+        fp = self.strs[self.fps[i_]]
+        if fp == META_PATH_HOLDER:
+            self.by_name[self.strs[self.names[i_]]] = i_
+        else:
+            self.by_fp[fp] = i_
+
+    def _BuildIndex(self):
+        self.by_fp = {}
+        self.by_name = {}
+        for i in range(len(self.xs)):
+            self._IndexRow(i)
+
+    # row of the gio icon with path fp_ or -1
+    def FindPath(self, fp_):
+        if self.by_fp is None:
+            self._BuildIndex()
+        return self.by_fp.get(fp_, -1)
+
+    # row of the desktop-metadata icon with section name name_ or -1
+    def FindName(self, name_):
+        if self.by_fp is None:
+            self._BuildIndex()
+        return self.by_name.get(name_, -1)
+
+    # independent rows for callers which move icons, strings are shared
+    def Copy(self):
+        icons = IconSet()
+        icons.xs = array.array('i', self.xs)
+        icons.ys = array.array('i', self.ys)
+        icons.ms = array.array('i', self.ms)
+        icons.fps = array.array('I', self.fps)
+        icons.names = array.array('I', self.names)
+        icons.strs = list(self.strs)
+        icons.str_ids = dict(self.str_ids)
+        icons.monitors = list(self.monitors)
+        return icons
+
+    # approximate memory held, for cache budgets
+    def NBytes(self):
+        n = sum(a.itemsize * len(a)
+                for a in (self.xs, self.ys, self.ms, self.fps, self.names))
+        n += sum(os.sys.getsizeof(s) for s in self.strs)
+        return (n + os.sys.getsizeof(self.strs)
+                + os.sys.getsizeof(self.str_ids))
+
+    # splits into (gio icons, desktop-metadata icons)
+    def Split(self):
+        gio = IconSet()
+        meta = IconSet()
+        for fp, name, x, y, m in self.Rows():
+            dst = meta if fp == META_PATH_HOLDER else gio
+            dst.Append(fp, name, x, y, m)
+        return gio, meta
+
+
+# get file just name: name from path /some/path/name.ext
+def gfjn(fp_):
+    return os.path.splitext(os.path.split(fp_)[1])[0]
+
+
+# binary profile layout, all little-endian:
+#   header: magic, version, flags, icons count, strings count, strings size
+#   (version 2) uint32 monitors count, monitors: int32 x, y, w, h and
+#   uint32 name string index
+#   int32 x[n], int32 y[n], int32 m[n], uint32 dir[n], uint32 base[n],
+#   uint32 name[n] - string indexes, paths are split into directory and
+#   file name so the shared desktop directory is stored once
+#   uint32 string offsets[strings count + 1], utf-8 strings blob
+BIN_MAGIC = b'ICMB'
+BIN_VERSION = 2
+BIN_HDR = struct.Struct('<4sHHIII')
+BIN_MON_CNT = struct.Struct('<I')
+BIN_MON = struct.Struct('<iiiiI')
+BIN_NO_STR = 0xFFFFFFFF
+BIN_STR_ERRORS = 'surrogatepass'
+
+
+def IsBinProfile(head_):
+    return head_[:len(BIN_MAGIC)] == BIN_MAGIC
+
+
+def _LeArray(code_, items_):
+    a = array.array(code_, items_)
+    if os.sys.byteorder != 'little':
+        a.byteswap()
+    return a
+
+
+def PackBinProfile(icons_):
+    strs = {}
+    blob = bytearray()
+    offs = [0]
+
+    def intern(s_):
+        i = strs.get(s_)
+        if i is None:
+            i = strs[s_] = len(offs) - 1
+            blob.extend(s_.encode('utf-8', BIN_STR_ERRORS))
+            offs.append(len(blob))
+        return i
+
+    def split(fp_):
+        k = fp_.rfind('/')
+        if k < 0:
+            return BIN_NO_STR, intern(fp_)
+        return intern(fp_[:k]), intern(fp_[k + 1:])
+
+    n = len(icons_)
+    paths = [split(fp) for fp in icons_.strs]
+    dirs = [paths[i][0] for i in icons_.fps]
+    bases = [paths[i][1] for i in icons_.fps]
+    name_ids = [intern(nm) if nm else BIN_NO_STR for nm in icons_.strs]
+    names = [name_ids[i] for i in icons_.names]
+    mons = [BIN_MON.pack(m.x, m.y, m.w, m.h, intern(m.name))
+            for m in icons_.monitors]
+
+    parts = [BIN_HDR.pack(BIN_MAGIC, BIN_VERSION, 0, n, len(strs), len(blob)),
+             BIN_MON_CNT.pack(len(mons))] + mons
+    for code, items in (('i', icons_.xs), ('i', icons_.ys),
+                        ('i', icons_.ms), ('I', dirs), ('I', bases),
+                        ('I', names), ('I', offs)):
+        parts.append(_LeArray(code, items).tobytes())
+    parts.append(bytes(blob))
+    return b''.join(parts)
+
+
+# read-only mmap view of a binary profile, records are decoded on access
+class BinProfileView:
+
+    def __init__(self, fp_):
+        with open(fp_, "rb") as inf:
+            self.mm = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+        # the traceback keeps _Map's frame and the view alive, so the view
+        # is released explicitly or closing the mmap fails with BufferError
+        buf = memoryview(self.mm)
+        try:
+            self._Map(buf)
+        except BaseException:
+            buf.release()
+            self.Close()
+            raise
+
+    def _Map(self, buf_):
+        if len(buf_) < BIN_HDR.size:
+            raise RuntimeError('binary profile is truncated')
+        magic, ver, _, n, nstr, sz = BIN_HDR.unpack_from(buf_)
+        if magic != BIN_MAGIC or ver not in (1, BIN_VERSION):
+            raise RuntimeError(f'unsupported binary profile version: {ver}')
+
+        pos = BIN_HDR.size
+        mons = []
+        if ver >= 2:
+            if len(buf_) < pos + BIN_MON_CNT.size:
+                raise RuntimeError('binary profile is truncated')
+            nmon = BIN_MON_CNT.unpack_from(buf_, pos)[0]
+            pos += BIN_MON_CNT.size
+            for i in range(nmon):
+                if len(buf_) < pos + BIN_MON.size:
+                    raise RuntimeError('binary profile is truncated')
+                mons.append(BIN_MON.unpack_from(buf_, pos))
+                pos += BIN_MON.size
+        if len(buf_) != pos + 4 * (6 * n + nstr + 1) + sz:
+            raise RuntimeError('binary profile is truncated')
+
+        self.buf = buf_
+        self.count = n
+        cols = []
+        for code, cnt in (('i', n), ('i', n), ('i', n), ('I', n), ('I', n),
+                          ('I', n), ('I', nstr + 1)):
+            mv = buf_[pos:pos + 4 * cnt]
+            if os.sys.byteorder == 'little':
+                cols.append(mv.cast(code))
+            else:
+                cols.append(_LeArray(code, array.array(code, mv)))
+            pos += 4 * cnt
+        (self.xs, self.ys, self.ms, self.dirs, self.bases, self.names,
+         self.offs) = cols
+        self.blob = buf_[pos:]
+        self.strs = {}
+        self.monitors = [Monitor(x=x, y=y, w=w, h=h, name=self.Str(ni))
+                         for x, y, w, h, ni in mons]
+
+    def Str(self, i_):
+        s = self.strs.get(i_)
+        if s is None:
+            s = self.strs[i_] = bytes(
+                self.blob[self.offs[i_]:self.offs[i_ + 1]]).decode(
+                    'utf-8', BIN_STR_ERRORS)
+        return s
+
+    def Path(self, i_):
+        base = self.Str(self.bases[i_])
+        if self.dirs[i_] == BIN_NO_STR:
+            return base
+        return self.Str(self.dirs[i_]) + '/' + base
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i_):
+        if not 0 <= i_ < self.count:
+            raise IndexError(i_)
+        o = IconData(fp=self.Path(i_), x=self.xs[i_], y=self.ys[i_],
+                     m=self.ms[i_])
+        if self.names[i_] != BIN_NO_STR:
+            o.name = self.Str(self.names[i_])
+        return o
+
+    def ToIconSet(self):
+        blob = bytes(self.blob)
+        offs = self.offs.tolist()
+        strs = [blob[offs[i]:offs[i + 1]].decode('utf-8', BIN_STR_ERRORS)
+                for i in range(len(offs) - 1)]
+
+        icons = IconSet()
+        icons.monitors = list(self.monitors)
+        icons.xs = array.array('i', self.xs)
+        icons.ys = array.array('i', self.ys)
+        icons.ms = array.array('i', self.ms)
+
+        fp_ids = {}
+        fps = []
+        for k in zip(self.dirs, self.bases):
+            fi = fp_ids.get(k)
+            if fi is None:
+                d, b = k
+                fp = strs[b] if d == BIN_NO_STR else strs[d] + '/' + strs[b]
+                fi = fp_ids[k] = icons._Intern(fp)
+            fps.append(fi)
+        icons.fps = array.array('I', fps)
+
+        name_ids = {BIN_NO_STR: 0}
+        for i in set(self.names.tolist()):
+            if i not in name_ids:
+                name_ids[i] = icons._Intern(strs[i])
+        icons.names = array.array('I', [name_ids[i] for i in self.names])
+        return icons
+
+    def Close(self):
+        for a in ('xs', 'ys', 'ms', 'dirs', 'bases', 'names', 'offs', 'blob',
+                  'buf'):
+            v = self.__dict__.pop(a, None)
+            if isinstance(v, memoryview):
+                v.release()
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args_):
+        self.Close()
+
+
+# layout part of generated names: 1920x1080+2560x1440, 1920x1080+4monitors
+LAYOUT_NAME_RE = re.compile(r'^(\d+x\d+(?:\+\d+x\d+)*(?:\+\d+monitors)?)'
+                            r'(?:_\d+)?$')
+
+
+def LayoutName(monitors_):
+    if len(monitors_) == 0:
+        return '0x0'
+    if len(monitors_) > 3:
+        return f'{monitors_[0].w}x{monitors_[0].h}+{len(monitors_)}monitors'
+    return '+'.join(f'{m.w}x{m.h}' for m in monitors_)
+
+
+class ProfileInfo:
     name = ''
-    x = y = 0
-    m = 0
+    fp = ''
+    mtime = 0.0
+    mtime_ns = 0
+    size = 0
+    layout = ''
+    count = 0
+    checksum = ''
+    monitors = []
 
     def __init__(self, *args, **kwargs):
         if len(args) > 0:
@@ -226,128 +1168,1369 @@ class IconData:
             self.__dict__.update(kwargs)
 
     def __str__(self):
-        # return f"{{{self.path=}, {self.x=}, {self.y=}}}"
         return str(vars(self))
 
     def __repr__(self):
         return str(self)
 
 
-# get file just name: name from path /some/path/name.ext
-def gfjn(fp_):
-    return os.path.splitext(os.path.split(fp_)[1])[0]
+# persistent index of the profiles in the config dir: only new or changed
+# files are parsed, icon lists themselves are loaded on demand
+class ProfileCatalog:
+
+    def __init__(self, dir_):
+        self.dir = dir_
+        self.fp = f'{dir_}/{CATALOG_FILE_NAME}'
+        self.entries = {}
+        self.suffixes = {}
+        self.dirty = False
+
+    def _Load(self):
+        try:
+            with open(self.fp, "rt") as inf:
+                data = json.load(inf)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print(f"Error reading: {self.fp}\nex:{e} :", file=os.sys.stderr)
+            return
+
+        if data.get('version') != CATALOG_VERSION:
+            return
+        for d in data.get('profiles', []):
+            info = ProfileInfo(d)
+            self.entries[info.name] = info
+
+    def Save(self):
+        data = {'version': CATALOG_VERSION,
+                'profiles': [vars(e) for e in self.entries.values()]}
+        fd, tmp_fp = tempfile.mkstemp(dir=self.dir, prefix=CATALOG_FILE_NAME)
+        try:
+            with os.fdopen(fd, "wt") as outf:
+                json.dump(data, outf)
+            os.replace(tmp_fp, self.fp)
+        except BaseException:
+            os.unlink(tmp_fp)
+            raise
+        self.dirty = False
+
+    def _Scan(self, fp_, st_):
+        info = ProfileInfo(name=gfjn(fp_), fp=fp_, mtime=st_.st_mtime,
+                           mtime_ns=st_.st_mtime_ns, size=st_.st_size)
+        m = LAYOUT_NAME_RE.match(info.name)
+        info.layout = m.group(1) if m else ''
+        try:
+            with open(fp_, "rb") as inf:
+                raw = inf.read()
+            info.checksum = hashlib.sha1(raw).hexdigest()
+            if IsBinProfile(raw):
+                with BinProfileView(fp_) as v:
+                    info.count = v.count
+                    info.monitors = [m.ToDict() for m in v.monitors]
+            else:
+                data = json.loads(raw)
+                if isinstance(data, dict):
+                    info.count = len(data.get('icons', []))
+                    info.monitors = data.get('monitors', [])
+                else:
+                    info.count = len(data)
+        except Exception as e:
+            print(f"Error reading: {fp_}\nex:{e} :", file=os.sys.stderr)
+        if not info.layout and info.monitors:
+            info.layout = LayoutName([Monitor(m) for m in info.monitors])
+        return info
+
+    # brings the catalog in line with the config dir, parsing only the
+    # profiles that were added or changed since the last run
+    def Refresh(self):
+        if not self.entries:
+            self._Load()
+
+        ext = "." + DATA_FILE_EXT
+        seen = set()
+        with os.scandir(self.dir) as it:
+            for de in it:
+                if (not de.name.endswith(ext) or de.name.startswith('.')
+                        or not de.is_file()):
+                    continue
+                name = de.name[:-len(ext)]
+                seen.add(name)
+                st = de.stat()
+                info = self.entries.get(name)
+                if (info is not None and info.mtime_ns == st.st_mtime_ns
+                        and info.size == st.st_size):
+                    continue
+                prev_layout = info.layout if info is not None else ''
+                info = self._Scan(de.path, st)
+                info.layout = info.layout or prev_layout
+                self.entries[name] = info
+                self.dirty = True
+
+        for name in [n for n in self.entries if n not in seen]:
+            del self.entries[name]
+            self.dirty = True
+
+        if self.dirty:
+            self.Save()
+
+    def Update(self, fp_, layout_=None):
+        name = gfjn(fp_)
+        prev = self.entries.get(name)
+        info = self._Scan(fp_, os.stat(fp_))
+        if layout_ is not None:
+            info.layout = layout_
+        elif prev is not None and not info.layout:
+            info.layout = prev.layout
+        self.entries[name] = info
+        self.Save()
+        return info
+
+    def Remove(self, name_):
+        if self.entries.pop(name_, None) is not None:
+            self.Save()
+
+    # rescans one profile after a change seen on the dir; returns the
+    # entry before and after it, both None when nothing changed
+    def Sync(self, name_):
+        prev = self.entries.get(name_)
+        fp = f'{self.dir}/{name_}.{DATA_FILE_EXT}'
+        try:
+            st = os.stat(fp)
+        except FileNotFoundError:
+            if prev is None:
+                return None, None
+            self.Remove(name_)
+            return prev, None
+        if (prev is not None and prev.mtime_ns == st.st_mtime_ns
+                and prev.size == st.st_size):
+            return None, None
+        return prev, self.Update(fp)
+
+    def Rename(self, old_name_, new_name_, fp_new_):
+        info = self.entries.pop(old_name_, None)
+        if info is None:
+            return None
+        info.name = new_name_
+        info.fp = fp_new_
+        self.entries[new_name_] = info
+        self.Save()
+        return info
+
+    def _Taken(self, name_):
+        return (name_ in self.entries
+                or os.path.exists(f'{self.dir}/{name_}.{DATA_FILE_EXT}'))
+
+    # free profile name: template, template_0, template_1, ...
+    def FreeName(self, template_):
+        if not self._Taken(template_):
+            return template_
+
+        i = self.suffixes.get(template_)
+        if i is None:
+            i = 0
+            prefix = template_ + '_'
+            for n in self.entries:
+                if n.startswith(prefix) and n[len(prefix):].isdigit():
+                    i = max(i, int(n[len(prefix):]) + 1)
+
+        while self._Taken(f'{template_}_{i}'):
+            i += 1
+        self.suffixes[template_] = i + 1
+        return f'{template_}_{i}'
+
+
+def _FillRect(pix_, w_, h_, x0_, y0_, x1_, y1_, color_):
+    x0, x1 = max(0, x0_), min(w_, x1_)
+    if x0 >= x1:
+        return
+    row = color_ * (x1 - x0)
+    for y in range(max(0, y0_), min(h_, y1_)):
+        i = (y * w_ + x0) * 3
+        pix_[i:i + len(row)] = row
+
+
+# binary ppm miniature of the monitors and the icon cells on them; icon
+# positions are relative to their monitor
+def RenderThumbnail(icons_, w_=THUMB_W, h_=THUMB_H):
+    rects = [(m.x, m.y, m.w, m.h) for m in icons_.monitors]
+    if not rects:
+        rects = [(0, 0, max(icons_.xs, default=0) + ICON_CELL_W,
+                  max(icons_.ys, default=0) + ICON_CELL_H)]
+    x0 = min(r[0] for r in rects)
+    y0 = min(r[1] for r in rects)
+    x1 = max(r[0] + r[2] for r in rects)
+    y1 = max(r[1] + r[3] for r in rects)
+    scale = min((w_ - 2) / max(1, x1 - x0), (h_ - 2) / max(1, y1 - y0))
+    ox = (w_ - (x1 - x0) * scale) / 2 - x0 * scale
+    oy = (h_ - (y1 - y0) * scale) / 2 - y0 * scale
+
+    pix = bytearray(THUMB_BG * (w_ * h_))
+    for x, y, w, h in rects:
+        ax, ay = int(ox + x * scale), int(oy + y * scale)
+        bx, by = int(ox + (x + w) * scale), int(oy + (y + h) * scale)
+        _FillRect(pix, w_, h_, ax, ay, bx, by, THUMB_MON_EDGE)
+        _FillRect(pix, w_, h_, ax + 1, ay + 1, bx - 1, by - 1,
+                  THUMB_MON_FILL)
+
+    cw = max(1, int(ICON_CELL_W * scale * 0.6))
+    ch = max(1, int(ICON_CELL_H * scale * 0.6))
+    for x, y, m in zip(icons_.xs, icons_.ys, icons_.ms):
+        mx, my = rects[m][:2] if m < len(rects) else rects[0][:2]
+        ax, ay = int(ox + (mx + x) * scale), int(oy + (my + y) * scale)
+        _FillRect(pix, w_, h_, ax, ay, ax + cw, ay + ch, THUMB_ICON)
+
+    return f'P6 {w_} {h_} 255\n'.encode() + bytes(pix)
+
+
+class ThumbnailStore:
+
+    def __init__(self, dir_):
+        self.dir = dir_
+
+    def _Path(self, checksum_):
+        return f'{self.dir}/{checksum_}-{THUMB_W}x{THUMB_H}.ppm'
+
+    # cached ppm of the profile fp_ with content checksum_, rendered and
+    # stored on the first request
+    def Get(self, checksum_, fp_):
+        fp = self._Path(checksum_)
+        try:
+            with open(fp, "rb") as inf:
+                return inf.read()
+        except FileNotFoundError:
+            pass
+
+        data = RenderThumbnail(IcMan._LoadIconConf(fp_))
+        os.makedirs(self.dir, exist_ok=True)
+        fd, tmp_fp = tempfile.mkstemp(dir=self.dir, prefix='.tmp')
+        try:
+            with os.fdopen(fd, "wb") as outf:
+                outf.write(data)
+            os.replace(tmp_fp, fp)
+        except BaseException:
+            os.unlink(tmp_fp)
+            raise
+        return data
+
+    # drops thumbnails of profiles which no longer exist or changed
+    def Prune(self, checksums_):
+        try:
+            files = os.listdir(self.dir)
+        except FileNotFoundError:
+            return
+        for f in files:
+            if f.split('-', 1)[0] not in checksums_:
+                os.remove(f'{self.dir}/{f}')
+
+
+# LRU of parsed profiles keyed by (path, mtime_ns, size), so a changed file
+# is never served from memory; Get hands out copies the caller may modify
+class ProfileCache:
+
+    def __init__(self, max_bytes_=PROFILE_CACHE_BYTES,
+                 max_entries_=PROFILE_CACHE_ENTRIES):
+        self.max_bytes = max_bytes_
+        self.max_entries = max_entries_
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def Get(self, fp_, load_):
+        st = os.stat(fp_)
+        key = (fp_, st.st_mtime_ns, st.st_size)
+        e = self.entries.get(key)
+        if e is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return e[0].Copy()
+
+        self.misses += 1
+        icons = load_(fp_)
+        size = icons.NBytes()
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return icons
+        self.Drop(fp_)
+        self.entries[key] = (icons, size)
+        self.nbytes += size
+        while (len(self.entries) > self.max_entries
+               or self.nbytes > self.max_bytes):
+            _, (_, n) = self.entries.popitem(last=False)
+            self.nbytes -= n
+            self.evictions += 1
+        return icons.Copy()
+
+    def Drop(self, fp_):
+        for key in [k for k in self.entries if k[0] == fp_]:
+            self.nbytes -= self.entries.pop(key)[1]
+
+    def Stats(self):
+        return {'entries': len(self.entries), 'bytes': self.nbytes,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+
+# versioned icon sets sharing unchanged chunks between versions; a version
+# loads from its manifest and chunks only, whatever the history length
+class SnapshotStore:
+
+    def __init__(self, dir_):
+        self.dir = dir_
+        self.objects = f'{dir_}/objects'
+        self.profiles = f'{dir_}/profiles'
+
+    def _ProfileDir(self, name_):
+        return f'{self.profiles}/{urllib.parse.quote(name_, safe="")}'
+
+    def _ObjectPath(self, key_):
+        return f'{self.objects}/{key_[:2]}/{key_[2:]}'
+
+    def _WriteAtomic(self, fp_, raw_):
+        d = os.path.dirname(fp_)
+        os.makedirs(d, exist_ok=True)
+        fd, tmp_fp = tempfile.mkstemp(dir=d, prefix='.tmp')
+        try:
+            with os.fdopen(fd, "wb") as outf:
+                outf.write(raw_)
+            os.replace(tmp_fp, fp_)
+        except BaseException:
+            os.unlink(tmp_fp)
+            raise
+        TRACE.Count('bytes_written', len(raw_))
+
+    # records sorted by path / name, cut at content defined boundaries
+    def _Chunks(icons_):
+        lines = sorted(json.dumps(list(r), separators=(',', ':'))
+                       for r in icons_.Rows())
+        chunk = []
+        for line in lines:
+            chunk.append(line)
+            if (len(chunk) >= SNAPSHOT_CHUNK_MAX or
+                    zlib.crc32(line.encode()) & SNAPSHOT_CHUNK_MASK == 0):
+                yield '\n'.join(chunk).encode()
+                chunk = []
+        if chunk:
+            yield '\n'.join(chunk).encode()
+
+    def Names(self):
+        try:
+            return sorted(urllib.parse.unquote(n)
+                          for n in os.listdir(self.profiles))
+        except FileNotFoundError:
+            return []
+
+    def Versions(self, name_):
+        try:
+            files = os.listdir(self._ProfileDir(name_))
+        except FileNotFoundError:
+            return []
+        return sorted(int(f[:-5]) for f in files
+                      if f.endswith('.json') and f[:-5].isdigit())
+
+    def Manifest(self, name_, seq_):
+        fp = f'{self._ProfileDir(name_)}/{seq_:08}.json'
+        with open(fp, "rt") as inf:
+            TRACE.CountFile('bytes_read', inf.fileno())
+            return json.load(inf)
+
+    # returns (version, new chunks); an icon set equal to the latest
+    # version is not stored again
+    def Save(self, name_, icons_, layout_=''):
+        keys = []
+        written = 0
+        for raw in SnapshotStore._Chunks(icons_):
+            key = hashlib.sha1(raw).hexdigest()
+            keys.append(key)
+            fp = self._ObjectPath(key)
+            if not os.path.exists(fp):
+                self._WriteAtomic(fp, zlib.compress(raw))
+                written += 1
+
+        monitors = [m.ToDict() for m in icons_.monitors]
+        versions = self.Versions(name_)
+        if versions:
+            last = self.Manifest(name_, versions[-1])
+            if last['chunks'] == keys and last['monitors'] == monitors:
+                return versions[-1], 0
+
+        seq = versions[-1] + 1 if versions else 1
+        data = {'version': SNAPSHOT_VERSION, 'seq': seq, 'time': time.time(),
+                'layout': layout_, 'count': len(icons_),
+                'monitors': monitors, 'chunks': keys}
+        self._WriteAtomic(f'{self._ProfileDir(name_)}/{seq:08}.json',
+                          json.dumps(data).encode())
+        return seq, written
+
+    def Load(self, name_, seq_=None):
+        if seq_ is None:
+            versions = self.Versions(name_)
+            if not versions:
+                raise KeyError(name_)
+            seq_ = versions[-1]
+        data = self.Manifest(name_, seq_)
+        icons = IconSet()
+        for key in data['chunks']:
+            with open(self._ObjectPath(key), "rb") as inf:
+                raw = inf.read()
+            TRACE.Count('bytes_read', len(raw))
+            for line in zlib.decompress(raw).decode().split('\n'):
+                icons.Append(*json.loads(line))
+        icons.monitors = [Monitor(m) for m in data['monitors']]
+        return icons
+
+    # keeps the keep_last_ newest versions and the newest version of each
+    # of the keep_daily_ latest days of every profile, then drops chunks
+    # no kept version refers to; returns (versions, chunks) removed
+    def Prune(self, keep_last_=SNAPSHOT_KEEP_LAST,
+              keep_daily_=SNAPSHOT_KEEP_DAILY):
+        removed = 0
+        used = set()
+        for name in self.Names():
+            versions = self.Versions(name)
+            manifests = {v: self.Manifest(name, v) for v in versions}
+            keep = set(versions[-keep_last_:] if keep_last_ > 0 else [])
+            days = []
+            for v in reversed(versions):
+                day = datetime.date.fromtimestamp(manifests[v]['time'])
+                if len(days) >= keep_daily_:
+                    break
+                if not days or days[-1] != day:
+                    days.append(day)
+                    keep.add(v)
+            for v in versions:
+                if v in keep:
+                    used.update(manifests[v]['chunks'])
+                else:
+                    os.remove(f'{self._ProfileDir(name)}/{v:08}.json')
+                    removed += 1
+            if not keep:
+                os.rmdir(self._ProfileDir(name))
+
+        chunks = 0
+        try:
+            subdirs = os.listdir(self.objects)
+        except FileNotFoundError:
+            subdirs = []
+        for sub in subdirs:
+            d = f'{self.objects}/{sub}'
+            for f in os.listdir(d):
+                if sub + f not in used and not f.startswith('.tmp'):
+                    os.remove(f'{d}/{f}')
+                    chunks += 1
+        return removed, chunks
+
+
+# environment a nemo-desktop started for another user takes over from the
+# instance it replaces
+NEMO_SESSION_ENV = ('DISPLAY', 'WAYLAND_DISPLAY', 'XAUTHORITY',
+                    'XDG_RUNTIME_DIR', 'DBUS_SESSION_BUS_ADDRESS',
+                    'XDG_SESSION_ID', 'XDG_CURRENT_DESKTOP', 'HOME')
+
+
+# finds the user's nemo-desktop processes in /proc, stops them and waits
+# for their exit on pidfds instead of polling pgrep
+class NemoSupervisor:
+
+    def __init__(self, name_=NEMO_DESKTOP_NAME, timeout_=None, uid_=None):
+        self.name = name_
+        self.comm = os.fsencode(name_)[:15]
+        self.uid = os.getuid() if uid_ is None else uid_
+        self.timeout = NEMO_STOP_TIMEOUT if timeout_ is None else timeout_
+        self.procs = {}
+        self.t0 = None
+        self.stop_time = None
+        self.killed = False
+        # session variables of a stopped instance, for Start()
+        self.session_env = {}
+
+    def FindPids(self):
+        pids = []
+        with os.scandir('/proc') as it:
+            for de in it:
+                if not de.name.isdigit():
+                    continue
+                try:
+                    if de.stat().st_uid != self.uid:
+                        continue
+                    with open(f'/proc/{de.name}/stat', 'rb') as inf:
+                        stat = inf.read()
+                except OSError:
+                    continue
+                # pid (comm) state ..., zombies are already gone for us
+                k = stat.rfind(b')')
+                comm = stat[stat.find(b'(') + 1:k]
+                if comm == self.comm and stat[k + 2:k + 3] != b'Z':
+                    pids.append(int(de.name))
+        return pids
+
+    def IsRunning(self):
+        return len(self.FindPids()) > 0
+
+    def _Signal(self, pid_, sig_):
+        fd = self.procs.get(pid_)
+        try:
+            if fd is not None:
+                signal.pidfd_send_signal(fd, sig_)
+            else:
+                os.kill(pid_, sig_)
+        except ProcessLookupError:
+            self._Forget(pid_)
+
+    def _Forget(self, pid_):
+        fd = self.procs.pop(pid_, None)
+        if fd is not None:
+            os.close(fd)
+
+    def _ReadSessionEnv(self, pid_):
+        try:
+            with open(f'/proc/{pid_}/environ', 'rb') as inf:
+                raw = inf.read()
+        except OSError:
+            return
+        for item in raw.split(b'\0'):
+            k, _, v = os.fsdecode(item).partition('=')
+            if k in NEMO_SESSION_ENV:
+                self.session_env[k] = v
+
+    # sends SIGTERM to all running instances and returns immediately
+    def BeginStop(self):
+        self.t0 = time.monotonic()
+        self.killed = False
+        for pid in self.FindPids():
+            if not self.session_env:
+                self._ReadSessionEnv(pid)
+            if pid in self.procs:
+                continue
+            try:
+                self.procs[pid] = os.pidfd_open(pid)
+            except ProcessLookupError:
+                continue
+            except (AttributeError, OSError):
+                self.procs[pid] = None
+            self._Signal(pid, signal.SIGTERM)
+
+    def _WaitExit(self, deadline_):
+        poller = select.poll()
+        fds = {}
+        for pid, fd in self.procs.items():
+            if fd is not None:
+                poller.register(fd, select.POLLIN)
+                fds[fd] = pid
+
+        while self.procs:
+            left = deadline_ - time.monotonic()
+            if left <= 0:
+                break
+            polled = len(fds) < len(self.procs)
+            step = min(left, NEMO_POLL_STEP) if polled else left
+            for fd, _ in poller.poll(step * 1000):
+                poller.unregister(fd)
+                self._Forget(fds.pop(fd))
+            if polled:
+                for pid in [p for p, fd in self.procs.items() if fd is None]:
+                    try:
+                        os.kill(pid, 0)
+                    except ProcessLookupError:
+                        self._Forget(pid)
+
+        return not self.procs
+
+    # waits for the instances signalled by BeginStop, escalating to SIGKILL
+    # after the timeout; returns the shutdown time in seconds
+    def WaitStopped(self):
+        if self.t0 is None:
+            self.BeginStop()
+
+        if not self._WaitExit(time.monotonic() + self.timeout):
+            self.killed = True
+            for pid in list(self.procs):
+                self._Signal(pid, signal.SIGKILL)
+            if not self._WaitExit(time.monotonic() + self.timeout):
+                pids = list(self.procs)
+                for pid in pids:
+                    self._Forget(pid)
+                raise RuntimeError(f"{self.name} didn't exit: {pids}")
+
+        self.stop_time = time.monotonic() - self.t0
+        self.t0 = None
+        return self.stop_time
+
+    def Stop(self):
+        self.BeginStop()
+        return self.WaitStopped()
+
+    # another user's instance is started as that user in the session the
+    # stopped one ran in
+    def Start(self):
+        TRACE.Count('spawns')
+        cmd = [self.name]
+        if self.uid != os.geteuid():
+            user = pwd.getpwuid(self.uid).pw_name
+            cmd = ([a.format(user=user) for a in FLEET_RUN_AS] + ['env'] +
+                   [f'{k}={v}' for k, v in self.session_env.items()] + cmd)
+        subprocess.Popen(cmd, start_new_session=True)
+
+
+# icon cell on the nemo desktop, icons are kept a cell away from the right
+# and bottom monitor edges
+ICON_CELL_W = 100
+ICON_CELL_H = 100
+
+# grid ResolveOverlaps snaps to: ICMAN_ICON_CELL=WxH sets it, otherwise
+# ICON_CELL is scaled by the nemo desktop grid adjust settings (percent).
+# It approximates nemo's grid, which also follows the desktop zoom level
+ICON_CELL_ENV = os.environ.get('ICMAN_ICON_CELL', '')
+NEMO_DESKTOP_SCHEMA = 'org.nemo.desktop'
+NEMO_GRID_ADJUST_KEYS = ('horizontal-grid-adjust', 'vertical-grid-adjust')
+
+# snap restored icons to the grid and move overlapping ones apart
+RESOLVE_OVERLAPS = os.environ.get('ICMAN_RESOLVE_OVERLAPS', '0') == '1'
+
+# changes of gio metadata only are applied with nemo-desktop running, the
+# keyfile entries still need a restart
+HOT_APPLY = os.environ.get('ICMAN_HOT_APPLY', '1') == '1'
+# how the running desktop is made to re-read the positions: rename - the
+# files are moved to hidden names and back (never over existing files,
+# ones a killed icman left hidden are renamed back on start), touch - only
+# their mtime changes, which nemo-desktop may not act on
+HOT_NUDGE = os.environ.get('ICMAN_HOT_NUDGE', 'rename')
+HOT_NUDGE_PREFIX = '.icman-nudge-'
+HOT_NUDGE_SIGNALS = {signal.SIGTERM, signal.SIGINT, signal.SIGHUP}
+# seconds the files stay hidden, so nemo sees them go before they return
+HOT_NUDGE_DELAY = 0.2
+
+
+RENAME_NOREPLACE = 1
+AT_FDCWD = -100
+_renameat2 = None
+
+
+# rename which fails with FileExistsError rather than replace dst_;
+# renameat2 where libc and the file system have it, else a check first
+def RenameNoReplace(src_, dst_):
+    global _renameat2
+    if _renameat2 is None:
+        from ctypes.util import find_library
+
+        libc = ctypes.CDLL(find_library("c"), use_errno=True)
+        _renameat2 = getattr(libc, 'renameat2', False)
+        if _renameat2:
+            _renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                   ctypes.c_int, ctypes.c_char_p,
+                                   ctypes.c_uint]
+    if _renameat2:
+        if _renameat2(AT_FDCWD, os.fsencode(src_), AT_FDCWD,
+                      os.fsencode(dst_), RENAME_NOREPLACE) == 0:
+            return
+        e = ctypes.get_errno()
+        if e not in (errno.ENOSYS, errno.EINVAL):
+            raise OSError(e, os.strerror(e), src_, None, dst_)
+    if os.path.lexists(dst_):
+        raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), src_,
+                              None, dst_)
+    os.rename(src_, dst_)
+
+
+# moves icons saved on saved_ monitors onto current_ ones: monitors are
+# matched by output name, then by index, then fall back to the first one;
+# positions (relative to their monitor) are scaled to the new size and
+# clamped to its bounds. Works on the IconSet arrays in one pass through
+# a per-monitor table, returns the number of moved icons
+def RemapIcons(icons_, saved_, current_):
+    n_cur = len(current_)
+    if n_cur == 0 or len(icons_) == 0:
+        return 0
+    if [m.Key() for m in saved_] == [m.Key() for m in current_]:
+        return 0
+
+    cur_by_name = {}
+    for i, m in enumerate(current_):
+        if m.name:
+            cur_by_name.setdefault(m.name, i)
+
+    def entry(t_, sx_, sy_):
+        cm = current_[t_]
+        return (t_, sx_, sy_, max(0, cm.w - ICON_CELL_W),
+                max(0, cm.h - ICON_CELL_H))
+
+    table = {}
+    for m in set(icons_.ms):
+        if m < len(saved_):
+            sm = saved_[m]
+            t = cur_by_name.get(sm.name, m if m < n_cur else 0)
+            cm = current_[t]
+            table[m] = entry(t, cm.w / sm.w if sm.w > 0 else 1.0,
+                             cm.h / sm.h if sm.h > 0 else 1.0)
+        else:
+            table[m] = entry(m if 0 <= m < n_cur else 0, 1.0, 1.0)
+
+    rows = [table[m] for m in icons_.ms]
+    xs = [min(max(int(x * r[1] + 0.5), 0), r[3])
+          for x, r in zip(icons_.xs, rows)]
+    ys = [min(max(int(y * r[2] + 0.5), 0), r[4])
+          for y, r in zip(icons_.ys, rows)]
+    ms = [r[0] for r in rows]
+
+    moved = sum(1 for a, b, c, d, e, f in zip(xs, ys, ms, icons_.xs,
+                                                 icons_.ys, icons_.ms)
+                if (a, b, c) != (d, e, f))
+    icons_.xs = array.array('i', xs)
+    icons_.ys = array.array('i', ys)
+    icons_.ms = array.array('i', ms)
+    return moved
+
+
+def _NearestFreeCell(occupied_, m_, cx_, cy_, cols_, rows_):
+    best = None
+    for r in range(1, max(cols_, rows_)):
+        if best is not None and r * r > best[0]:
+            break
+        for dx in range(-r, r + 1):
+            for dy in ((-r, r) if abs(dx) != r else range(-r, r + 1)):
+                x, y = cx_ + dx, cy_ + dy
+                if (0 <= x < cols_ and 0 <= y < rows_
+                        and (m_, x, y) not in occupied_):
+                    d = dx * dx + dy * dy
+                    if best is None or d < best[0]:
+                        best = (d, x, y)
+    return None if best is None else best[1:]
+
+
+def _ReadGridCell():
+    if ICON_CELL_ENV:
+        try:
+            w, h = (int(v) for v in ICON_CELL_ENV.split('x'))
+        except ValueError:
+            w = h = 0
+        if w <= 0 or h <= 0:
+            raise RuntimeError(f'Invalid ICMAN_ICON_CELL: {ICON_CELL_ENV}')
+        return (w, h)
+
+    adjust = []
+    for key in NEMO_GRID_ADJUST_KEYS:
+        TRACE.Count('spawns')
+        try:
+            out = subprocess.run(['gsettings', 'get', NEMO_DESKTOP_SCHEMA,
+                                  key], capture_output=True, text=True,
+                                 check=True).stdout
+            adjust.append(max(1, int(out.split()[-1])))
+        except (OSError, subprocess.CalledProcessError, ValueError,
+                IndexError):
+            adjust.append(100)
+    return (max(1, ICON_CELL_W * adjust[0] // 100),
+            max(1, ICON_CELL_H * adjust[1] // 100))
+
+
+_grid_cell = None
+
+
+# (w, h) of the nemo desktop grid cell, read once
+def NemoGridCell():
+    global _grid_cell
+    if _grid_cell is None:
+        _grid_cell = _ReadGridCell()
+    return _grid_cell
+
+
+# snaps icons to the grid (cell_ or NemoGridCell()) of their monitor and
+# moves the ones landing on a taken cell to the nearest free cell; taken
+# cells live in a hash set, so the pass is linear in the icons count plus
+# the local search around collisions. Icons of fixed_ (e.g. desktop files
+# missing from the profile) hold their cells but are not moved. Returns
+# moved icons count
+def ResolveOverlaps(icons_, monitors_, fixed_=None, cell_=None):
+    if len(monitors_) == 0:
+        return 0
+
+    cw, ch = cell_ or NemoGridCell()
+    grid = [(max(1, m.w // cw), max(1, m.h // ch)) for m in monitors_]
+
+    def cell(x_, y_, m_):
+        m = m_ if 0 <= m_ < len(grid) else 0
+        cols, rows = grid[m]
+        return (m, min(max((x_ + cw // 2) // cw, 0), cols - 1),
+                min(max((y_ + ch // 2) // ch, 0), rows - 1))
+
+    occupied = set()
+    taken = [0] * len(grid)
+
+    def take(c_):
+        if c_ not in occupied:
+            occupied.add(c_)
+            taken[c_[0]] += 1
+
+    if fixed_ is not None:
+        for x, y, m in zip(fixed_.xs, fixed_.ys, fixed_.ms):
+            take(cell(x, y, m))
+
+    moved = 0
+    for i in range(len(icons_)):
+        c = cell(icons_.xs[i], icons_.ys[i], icons_.ms[i])
+        cols, rows = grid[c[0]]
+        # a full monitor has nowhere to move to, the icon stays stacked
+        if c in occupied and taken[c[0]] < cols * rows:
+            free = _NearestFreeCell(occupied, c[0], c[1], c[2], cols, rows)
+            if free is not None:
+                c = (c[0],) + free
+        take(c)
+
+        pos = (c[1] * cw, c[2] * ch, c[0])
+        if pos != (icons_.xs[i], icons_.ys[i], icons_.ms[i]):
+            icons_.SetPos(i, *pos)
+            moved += 1
+    return moved
+
+
+# match ranks returned by LayoutIndex.Match
+MATCH_EXACT = 0
+MATCH_OUTPUTS = 1
+MATCH_NEAREST = 2
+
+# distance added per monitor when the monitor counts differ
+MATCH_COUNT_PENALTY = 1000000
+
+
+# monitor keys (name, x, y, w, h) of a profile; profiles saved before the
+# geometry was stored only have the sizes encoded in the name
+def ProfileLayoutKey(info_):
+    if info_.monitors:
+        return tuple(Monitor(m).Key() for m in info_.monitors)
+    if not info_.layout or info_.layout.endswith('monitors'):
+        return ()
+    return tuple(('', 0, 0, int(w), int(h))
+                 for w, h in (p.split('x') for p in info_.layout.split('+')))
+
+
+# leaf size of the per monitor count k-d trees of LayoutIndex
+MATCH_TREE_LEAF = 8
+
+
+# k-d tree over layout vectors of one monitor count, searched with the
+# L1 distance LayoutIndex.Distance uses for layouts of equal count
+class _LayoutTree:
+
+    def __init__(self, items_):
+        self.root = _LayoutTree._Build(list(items_))
+
+    def _Build(items_):
+        if len(items_) <= MATCH_TREE_LEAF:
+            return items_
+        dims = len(items_[0][0])
+        # split on the widest dimension, layouts share many coordinates
+        axis = max(range(dims), key=lambda a: max(v[a] for v, _ in items_) -
+                   min(v[a] for v, _ in items_))
+        items_.sort(key=lambda it: it[0][axis])
+        lo, hi = items_[0][0][axis], items_[-1][0][axis]
+        if lo == hi:
+            return items_
+        split = items_[len(items_) // 2][0][axis]
+        if split == lo:
+            split = next(v[axis] for v, _ in items_ if v[axis] > lo)
+        left = [it for it in items_ if it[0][axis] < split]
+        right = [it for it in items_ if it[0][axis] >= split]
+        return (axis, split, _LayoutTree._Build(left),
+                _LayoutTree._Build(right))
+
+    # [distance, [keys]] of the keys nearest to vec_ merged into best_,
+    # ties kept; extra_ is added to every distance
+    def Nearest(self, vec_, extra_, best_):
+        _LayoutTree._Search(self.root, vec_, extra_, [0] * len(vec_),
+                            extra_, best_)
+        return best_
+
+    # bound_ is the L1 distance from vec_ to the cell of node_, off_ its
+    # per axis parts
+    def _Search(node_, vec_, bound_, off_, extra_, best_):
+        if isinstance(node_, list):
+            for v, k in node_:
+                d = extra_ + sum(map(abs, map(operator.sub, vec_, v)))
+                if best_[0] is None or d < best_[0]:
+                    best_[0] = d
+                    best_[1] = [k]
+                elif d == best_[0]:
+                    best_[1].append(k)
+            return
+        axis, split, left, right = node_
+        diff = vec_[axis] - split
+        near, far = (left, right) if diff < 0 else (right, left)
+        _LayoutTree._Search(near, vec_, bound_, off_, extra_, best_)
+        old = off_[axis]
+        bound = bound_ - old + abs(diff)
+        if best_[0] is None or bound <= best_[0]:
+            off_[axis] = abs(diff)
+            _LayoutTree._Search(far, vec_, bound, off_, extra_, best_)
+            off_[axis] = old
+
+
+# profiles grouped by saved monitor geometry: exact layouts and output
+# name sets are hash lookups, other layouts are found by a nearest
+# neighbour search in a k-d tree per monitor count
+class LayoutIndex:
+
+    def __init__(self):
+        self.layouts = {}
+        self.names = {}
+        self.newest = {}
+        self.vecs = {}
+        self.buckets = {}
+        # monitor count -> layout keys; trees of buckets and counts are
+        # built on demand
+        self.counts = {}
+        self.trees = {}
+
+    def Build(configs_):
+        idx = LayoutIndex()
+        for info in configs_.values():
+            idx.Add(info)
+        return idx
+
+    # monitors ordered by position, flattened to x, y, w, h, x, y, ...
+    def _Vec(key_):
+        vec = []
+        for k in sorted(key_, key=lambda k: (k[1], k[2])):
+            vec += k[1:]
+        return tuple(vec)
+
+    def _Outputs(key_):
+        outs = tuple(sorted(k[0] for k in key_))
+        return outs if all(outs) else None
+
+    def Add(self, info_):
+        self.Remove(info_.name)
+        key = ProfileLayoutKey(info_)
+        if not key:
+            return
+        self.names[info_.name] = key
+        self.newest.pop(key, None)
+        if key not in self.layouts:
+            self.layouts[key] = {}
+            self.vecs[key] = LayoutIndex._Vec(key)
+            outs = LayoutIndex._Outputs(key)
+            if outs is not None:
+                self.buckets.setdefault(outs, set()).add(key)
+                self.trees.pop(outs, None)
+            self.counts.setdefault(len(key), set()).add(key)
+            self.trees.pop(len(key), None)
+        self.layouts[key][info_.name] = info_.mtime
+
+    def Remove(self, name_):
+        key = self.names.pop(name_, None)
+        if key is None:
+            return
+        profs = self.layouts[key]
+        del profs[name_]
+        self.newest.pop(key, None)
+        if profs:
+            return
+        del self.layouts[key]
+        del self.vecs[key]
+        outs = LayoutIndex._Outputs(key)
+        if outs is not None:
+            self.buckets[outs].discard(key)
+            self.trees.pop(outs, None)
+            if not self.buckets[outs]:
+                del self.buckets[outs]
+        self.counts[len(key)].discard(key)
+        if not self.counts[len(key)]:
+            del self.counts[len(key)]
+        self.trees.pop(len(key), None)
+
+    def _Newest(self, key_):
+        name = self.newest.get(key_)
+        if name is None:
+            profs = self.layouts[key_]
+            name = self.newest[key_] = max(profs, key=profs.get)
+        return name
+
+    def Distance(va_, vb_):
+        d = sum(map(abs, map(operator.sub, va_, vb_)))
+        if len(va_) != len(vb_):
+            v = va_ if len(va_) > len(vb_) else vb_
+            for i in range(min(len(va_), len(vb_)), len(v), 4):
+                d += MATCH_COUNT_PENALTY + v[i + 2] + v[i + 3]
+        return d
+
+    def _Rank(self, key_, outs_, vec_, k_):
+        if k_ == key_:
+            rank = MATCH_EXACT
+        elif outs_ is not None and LayoutIndex._Outputs(k_) == outs_:
+            rank = MATCH_OUTPUTS
+        else:
+            rank = MATCH_NEAREST
+        name = self._Newest(k_)
+        return (rank, LayoutIndex.Distance(vec_, self.vecs[k_]),
+                -self.layouts[k_][name], name)
+
+    # [(rank, distance, name)] best first, the newest profile of each layout
+    def Match(self, monitors_, limit_=None):
+        key = tuple(m.Key() for m in monitors_)
+        vec = LayoutIndex._Vec(key)
+        outs = LayoutIndex._Outputs(key)
+        res = sorted(self._Rank(key, outs, vec, k) for k in self.layouts)
+        return [(r, d, n) for r, d, _, n in res[:limit_]]
+
+    # tree of an output name bucket or of a monitor count
+    def _Tree(self, bucket_):
+        tree = self.trees.get(bucket_)
+        if tree is None:
+            keys = (self.counts if isinstance(bucket_, int) else
+                    self.buckets)[bucket_]
+            tree = self.trees[bucket_] = _LayoutTree(
+                (self.vecs[k], k) for k in keys)
+        return tree
+
+    # the layouts nearest to vec_ over all monitor counts, closest counts
+    # first since every extra monitor costs MATCH_COUNT_PENALTY
+    def _Nearest(self, vec_):
+        n = len(vec_) // 4
+        best = [None, []]
+        for c in sorted(self.counts, key=lambda c: abs(c - n)):
+            if (best[0] is not None and
+                    abs(c - n) * MATCH_COUNT_PENALTY > best[0]):
+                break
+            if c <= n:
+                extra = LayoutIndex.Distance(vec_[4 * c:], ())
+                self._Tree(c).Nearest(vec_[:4 * c], extra, best)
+                continue
+            # the extra monitors are part of the candidates, rare enough
+            # to be scanned
+            for k in self.counts[c]:
+                d = LayoutIndex.Distance(vec_, self.vecs[k])
+                if best[0] is None or d < best[0]:
+                    best = [d, [k]]
+                elif d == best[0]:
+                    best[1].append(k)
+        return best[1]
+
+    # name of the first profile Match would return
+    def Best(self, monitors_):
+        key = tuple(m.Key() for m in monitors_)
+        if key in self.layouts:
+            return self._Newest(key)
+        if not self.layouts:
+            return None
+
+        vec = LayoutIndex._Vec(key)
+        outs = LayoutIndex._Outputs(key)
+        if outs is not None and outs in self.buckets:
+            cands = self._Tree(outs).Nearest(vec, 0, [None, []])[1]
+        else:
+            cands = self._Nearest(vec)
+
+        names = [(self._Newest(k), k) for k in cands]
+        return min((-self.layouts[k][n], n) for n, k in names)[1]
+
+
+# icons of a profile which differ from the current desktop state
+class ConfigDiff:
+
+    def __init__(self):
+        self.gio = IconSet()
+        self.meta = IconSet()
+        self.prev = {}
+        self.gone = []
+        self.cancelled = False
+        self.hot = False
+
+    def Empty(self):
+        return len(self.gio) == 0 and len(self.meta) == 0
+
+    def _Add(self, dst_, fp_, name_, x_, y_, m_, prev_):
+        dst_.Append(fp_, name_, x_, y_, m_)
+        self.prev[name_ if fp_ == META_PATH_HOLDER else fp_] = prev_
+
+    def Lines(self):
+        for icons in (self.gio, self.meta):
+            for fp, name, x, y, m in icons.Rows():
+                key = f'[{name}]' if fp == META_PATH_HOLDER else fp
+                prev = self.prev[name if fp == META_PATH_HOLDER else fp]
+                if prev is None:
+                    yield f'+ {key}: {x},{y} m{m}'
+                else:
+                    yield (f'~ {key}: {prev[0]},{prev[1]} m{prev[2]}'
+                           f' -> {x},{y} m{m}')
+        for key in self.gone:
+            yield f'! {key}: not found, skipped'
+
+    # previous positions of the first n_ gio icons, to undo a cancelled
+    # write; icons which had no position (or forced ones) are left as is
+    def Reverted(self, n_):
+        icons = IconSet()
+        for i in range(min(n_, len(self.gio))):
+            prev = self.prev.get(self.gio.Path(i))
+            if prev is not None:
+                icons.Append(self.gio.Path(i), '', *prev)
+        return icons
+
+    # profile_ and current_ are IconSet, monitors out of range fall back to 0
+    def Build(profile_, current_, mon_cnt_):
+        diff = ConfigDiff()
+        for fp, name, x, y, m in profile_.Rows():
+            m = m if m < mon_cnt_ else 0
+            is_meta = fp == META_PATH_HOLDER
+            dst = diff.meta if is_meta else diff.gio
+            i = (current_.FindName(name) if is_meta
+                 else current_.FindPath(fp))
+            if i < 0:
+                if not is_meta and not os.path.lexists(fp):
+                    diff.gone.append(fp)
+                else:
+                    diff._Add(dst, fp, name, x, y, m, None)
+                continue
+            prev = (current_.xs[i], current_.ys[i], current_.ms[i])
+            if prev != (x, y, m):
+                diff._Add(dst, fp, name, x, y, m, prev)
+        return diff
 
 
 class IcMan:
     configs = {}
 
     def __init__(self):
+        self.cache = ProfileCache()
+        IcMan._RestoreNudged()
         self._LoadConfigs()
+        self.snapshots = SnapshotStore(f'{CONFIG_DIR}/{SNAPSHOT_DIR_NAME}')
 
-    def _GenConfigPath(template_name_):
-        conf_dir = CONFIG_DIR + "/"
-        fp = conf_dir + template_name_ + "." + DATA_FILE_EXT
-        i = 0
-        while os.path.exists(fp):
-            fp = conf_dir + template_name_ + "_" + str(i) + "." + DATA_FILE_EXT
-            i += 1
-        return fp
+    def _GenConfigPath(self, template_name_):
+        return IcMan.GetConfigFullPath(self.catalog.FreeName(template_name_))
 
     def _LoadIconConf(fp_):
         data = []
         try:
-            with open(fp_, "rt") as inf:
+            with open(fp_, "rb") as inf:
+                TRACE.CountFile('bytes_read', inf.fileno())
+                if IsBinProfile(inf.read(len(BIN_MAGIC))):
+                    with BinProfileView(fp_) as v:
+                        return v.ToIconSet()
+                inf.seek(0)
                 data = json.load(inf)
         except Exception as e:
             print(f"Error reading: {fp_}\nerr: {os.sys.exc_info()[0]}"
-                  f"\nex:{e} :")
-
-        icons = []
-        for d in data:
-            icons.append(IconData(d))
+                  f"\nex:{e} :", file=os.sys.stderr)
 
-        return icons
+        if isinstance(data, dict):
+            icons = IconSet.FromDicts(data.get('icons', []))
+            icons.monitors = [Monitor(m) for m in data.get('monitors', [])]
+            return icons
+        return IconSet.FromDicts(data)
 
     def _LoadConfigs(self):
         self.configs = {}
 
         if not os.path.exists(CONFIG_DIR):
+            TRACE.Count('spawns')
             subprocess.run(f'mkdir -p {CONFIG_DIR}', shell=True, check=True)
 
-        conf_dir = CONFIG_DIR + "/"
-
-        files = glob.glob(conf_dir + "*." + DATA_FILE_EXT)
-        for fp in files:
-            icons = IcMan._LoadIconConf(fp)
-            if len(icons) > 0:
-                self.configs[gfjn(fp)] = icons
-
-    def _SaveIconConf(fp_, icons_):
+        with TRACE.Span('catalog.load'):
+            self.catalog = ProfileCatalog(CONFIG_DIR)
+            self.catalog.Refresh()
+        for name, info in self.catalog.entries.items():
+            if info.count > 0:
+                self.configs[name] = info
+        self.layouts = LayoutIndex.Build(self.configs)
+
+    # inotify on CONFIG_DIR, Fileno() of the result goes into select or a
+    # Tk file handler and ProcessConfigEvents() runs when it is readable
+    def WatchConfigs(self):
+        self.inotify = Inotify()
+        self.inotify.Watch(CONFIG_DIR, IN_CLOSE_WRITE | IN_MOVED_FROM
+                           | IN_MOVED_TO | IN_DELETE)
+        return self.inotify
+
+    # applies profile changes made by other processes to configs; returns
+    # [(name, old ProfileInfo or None, new ProfileInfo or None)], or None
+    # after an event queue overflow, when everything was reloaded
+    def ProcessConfigEvents(self):
+        ext = "." + DATA_FILE_EXT
+        names = []
+        for _, fname, mask, _ in self.inotify.Read():
+            if mask & IN_Q_OVERFLOW:
+                self._LoadConfigs()
+                return None
+            if fname.endswith(ext) and not fname.startswith('.'):
+                name = fname[:-len(ext)]
+                if name not in names:
+                    names.append(name)
+
+        changes = []
+        for name in names:
+            prev, info = self.catalog.Sync(name)
+            if prev is None and info is None:
+                continue
+            old = self.configs.pop(name, None)
+            self.layouts.Remove(name)
+            if info is not None and info.count > 0:
+                self.configs[name] = info
+                self.layouts.Add(info)
+            else:
+                info = None
+            if old is not None or info is not None:
+                changes.append((name, old, info))
+        return changes
+
+    # best saved profile for the monitors_ (live layout by default)
+    def MatchConfig(self, monitors_=None):
+        if monitors_ is None:
+            monitors_ = GetMonitorsInfo()
+        return self.layouts.Best(monitors_)
+
+    def _GetIcons(self, name_):
+        return self.cache.Get(self.configs[name_].fp, IcMan._LoadIconConf)
+
+    def _SaveIconConf(fp_, icons_, fmt_=None):
+        if (fmt_ or PROFILE_FORMAT) == 'bin':
+            with open(fp_, "wb") as outf:
+                n = outf.write(PackBinProfile(icons_))
+            TRACE.Count('bytes_written', n)
+            return
+        data = {'version': PROFILE_JSON_VERSION,
+                'monitors': [m.ToDict() for m in icons_.monitors],
+                'icons': icons_.ToDicts()}
         with open(fp_, "wt") as outf:
-            json.dump(icons_, outf, indent=2, default=vars)
-
-    def _LoadCurentIcons():
-        icons = []
-        id = {}
-
-        h1_present = False
-        h2_present = False
-        h3_present = False
-
-        e_no_hdr1 = f'Header <{HDR1}> is not present'
-
+            json.dump(data, outf, indent=2)
+            TRACE.Count('bytes_written', outf.tell())
+
+    # rewrites a profile in the other format, the result is loaded back and
+    # compared before it replaces the original
+    def ConvertConfig(fp_, fmt_):
+        icons = IcMan._LoadIconConf(fp_)
+        fd, tmp_fp = tempfile.mkstemp(dir=os.path.dirname(fp_), prefix='.',
+                                      suffix="." + DATA_FILE_EXT)
+        os.close(fd)
+        try:
+            IcMan._SaveIconConf(tmp_fp, icons, fmt_)
+            back = IcMan._LoadIconConf(tmp_fp)
+            if (back.ToDicts() != icons.ToDicts()
+                    or [m.ToDict() for m in back.monitors]
+                    != [m.ToDict() for m in icons.monitors]):
+                raise RuntimeError(f'{fp_}: conversion is not lossless')
+            os.replace(tmp_fp, fp_)
+        except BaseException:
+            os.unlink(tmp_fp)
+            raise
+
+    def _MakeCurrentIcon(fp_, pos_, mon_):
+        if pos_ is None or mon_ is None:
+            return None
+        try:
+            v2 = pos_.split(',')
+            return IconData(fp=fp_, x=int(v2[0]), y=int(v2[1]), m=int(mon_))
+        except (ValueError, IndexError):
+            raise RuntimeError(f'{E_GEN}\nInvalid metadata ({fp_!r}): '
+                               f'{HDR2}={pos_!r}, {HDR3}={mon_!r}')
+
+    # parses 'gio info --attributes=metadata::' output; the path is taken
+    # from the percent-encoded uri line, so odd file names can't break it
+    def _ProcessLines_LoadCurrentIcons(lines_):
+        fp = None
+        pos = mon = None
         lc = 0
-        # print (f"Executing: {LOAD_DESKTOP_ICONS_CMD}")
-        lines = subprocess.run(LOAD_DESKTOP_ICONS_CMD, shell=True,
-                               check=True, capture_output=True,
-                               text=True).stdout.splitlines()
-
-        for line in lines:
 
+        for line in lines_:
             s = line.strip()
-            # print('Processing: ', s)
             lc += 1
 
-            if s.startswith(HDR1):
-                id = IconData({})
-                id.fp = s[LHDR1 + 1:]
-                h1_present = True
-                h2_present = False
-                h3_present = False
-
-            elif s.startswith(HDR2):
-
-                if not h1_present or h2_present:
-                    raise RuntimeError(
-                        f'{E_GEN}\n{e_no_hdr1}\nInvalid line({lc}): {s}')
-
-                v2 = s[LHDR2 + 2:].split(',')
-                id.x = int(v2[0])
-                id.y = int(v2[1])
-
-                h2_present = True
-                if h3_present:
-                    h1_present = False
-                    icons.append(id)
-
-            elif s.startswith(HDR3):
-
-                if not h1_present or h3_present:
-                    raise RuntimeError(
-                        f'{E_GEN}\n{e_no_hdr1}\nInvalid line({lc}): {s}')
-
-                v3 = s[LHDR3 + 2:]
-                id.m = int(v3)
+            if s.startswith(URI_HDR):
+                if fp is not None:
+                    o = IcMan._MakeCurrentIcon(fp, pos, mon)
+                    if o is not None:
+                        yield o
+                uri = s[LURI_HDR + 1:]
+                if not uri.startswith(FILE_URI_PREFIX):
+                    raise RuntimeError(f'{E_GEN}\nInvalid line({lc}): {s}')
+                fp = os.fsdecode(urllib.parse.unquote_to_bytes(
+                    uri[len(FILE_URI_PREFIX):]))
+                pos = mon = None
+
+            elif s.startswith(HDR2 + ':'):
+                if fp is None or pos is not None:
+                    raise RuntimeError(f'{E_GEN}\nInvalid line({lc}): {s}')
+                pos = s[LHDR2 + 2:]
+
+            elif s.startswith(HDR3 + ':'):
+                if fp is None or mon is not None:
+                    raise RuntimeError(f'{E_GEN}\nInvalid line({lc}): {s}')
+                mon = s[LHDR3 + 2:]
+
+        if fp is not None:
+            o = IcMan._MakeCurrentIcon(fp, pos, mon)
+            if o is not None:
+                yield o
+
+    def _ListDesktopFiles(dir_):
+        # same set as the shell glob dir/*
+        with os.scandir(dir_) as it:
+            names = [e.name for e in it if not e.name.startswith('.')]
+        names.sort()
+        return [os.path.join(dir_, n) for n in names]
+
+    def _IterCurrentIconsCli(dir_, run_as_=()):
+        files = IcMan._ListDesktopFiles(dir_)
+        for i in range(0, len(files), GIO_INFO_BATCH):
+            cmd = list(run_as_) + GIO_INFO_CMD + files[i:i + GIO_INFO_BATCH]
+            TRACE.Count('spawns')
+            with subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True,
+                                  errors='surrogateescape') as p:
+                yield from IcMan._ProcessLines_LoadCurrentIcons(
+                    TRACE.CountLines('bytes_read', p.stdout))
+            if p.returncode != 0:
+                raise subprocess.CalledProcessError(p.returncode, cmd)
+
+    def _IterCurrentIconsLib(lib_, dir_):
+        d = lib_.g_file_new_for_path(os.fsencode(dir_))
+        err = ctypes.POINTER(GError)()
+        en = lib_.g_file_enumerate_children(d, GIO_ENUM_ATTRS, 0, None,
+                                            ctypes.byref(err))
+        if not en:
+            lib_.g_object_unref(d)
+            raise RuntimeError(f"Can't list {dir_}: {GioLib.TakeError(err)}")
 
-                h3_present = True
-                if h2_present:
-                    h1_present = False
-                    icons.append(id)
-
-            else:
-                raise RuntimeError(f'{E_GEN}\nInvalid line({lc}): {s}')
+        try:
+            while True:
+                info = lib_.g_file_enumerator_next_file(en, None,
+                                                        ctypes.byref(err))
+                if not info:
+                    if err:
+                        raise RuntimeError(
+                            f"Can't list {dir_}: {GioLib.TakeError(err)}")
+                    break
+                try:
+                    name = lib_.g_file_info_get_name(info)
+                    pos = lib_.g_file_info_get_attribute_string(
+                        info, HDR2.encode())
+                    mon = lib_.g_file_info_get_attribute_string(
+                        info, HDR3.encode())
+                finally:
+                    lib_.g_object_unref(info)
 
-        return icons
+                if name.startswith(b'.') or pos is None or mon is None:
+                    continue
+                o = IcMan._MakeCurrentIcon(
+                    os.path.join(dir_, os.fsdecode(name)),
+                    pos.decode('utf-8', 'replace'),
+                    mon.decode('utf-8', 'replace'))
+                if o is not None:
+                    yield o
+        finally:
+            lib_.g_file_enumerator_close(en, None, None)
+            lib_.g_object_unref(en)
+            lib_.g_object_unref(d)
+
+    # yields desktop icons one by one, straight from the files metadata
+    def IterCurrentIcons(dir_=DESKTOP_DIR, run_as_=()):
+        lib = GioLib.Get() if not run_as_ else None
+        if lib is not None:
+            return IcMan._IterCurrentIconsLib(lib, dir_)
+        return IcMan._IterCurrentIconsCli(dir_, run_as_)
+
+    def _LoadCurentIcons(env_=None):
+        with TRACE.Span('current.gio', backend=GIO_BACKEND):
+            if env_ is None:
+                return IconSet.FromRecords(IcMan.IterCurrentIcons())
+            return IconSet.FromRecords(
+                IcMan.IterCurrentIcons(env_.desktop, env_.run_as))
 
     def _ProcessLines_LoadNemoMetaIcons(lines_):
         icons = []
@@ -368,6 +2551,9 @@ class IcMan:
                 h3_present = False
                 continue
 
+            if s.startswith('#'):
+                continue
+
             if skip_block:
                 if not s.startswith('['):
                     continue
@@ -421,179 +2607,532 @@ class IcMan:
                     icons.append(id)
         return icons
 
-    def _LoadNemoMetaIcons(fp_):
+    # env_ is the UserEnv of another user's home fp_ is in
+    def _LoadNemoMetaIcons(fp_, env_=None):
         lines = []
+        if env_ is not None and env_.Owner() is not None:
+            # a keyfile failing the ownership checks is an error here
+            try:
+                dfd = env_.OpenDir(os.path.dirname(fp_))
+            except FileNotFoundError:
+                return IcMan._ProcessLines_LoadNemoMetaIcons(lines)
+            try:
+                inf = env_.OpenFile(dfd, os.path.basename(fp_))
+            finally:
+                os.close(dfd)
+            if inf is not None:
+                with inf:
+                    TRACE.CountFile('bytes_read', inf.fileno())
+                    lines = inf.readlines()
+            return IcMan._ProcessLines_LoadNemoMetaIcons(lines)
+
         try:
             with open(fp_, 'rt') as file1:
+                TRACE.CountFile('bytes_read', file1.fileno())
                 lines = file1.readlines()
+        except FileNotFoundError:
+            pass
         except Exception as e:
-            print(f'_LoadNemoMetaIcons exception:\n{e}')
+            print(f'_LoadNemoMetaIcons exception:\n{e}', file=os.sys.stderr)
 
         icons = IcMan._ProcessLines_LoadNemoMetaIcons(lines)
         return icons
 
-    def _ProcessLines_ApplyNemoMetaDesktop(lines_, meta_dict_, fp_, mon_cnt_):
+    def _MetaKeyLines(o_, mon_cnt_, pos_=True, mon_=True):
+        if pos_:
+            yield f'{NIC_HDR}={o_.x},{o_.y}\n'
+        if mon_:
+            yield f'{MON_HDR}={o_.m if o_.m < mon_cnt_ else 0}\n'
+
+    # generator of the rewritten keyfile lines: sections of meta_ get the
+    # saved position and monitor (keys are added when absent), sections
+    # which are missing from the file are appended at the end; all other
+    # lines, comments and blank lines are passed through unchanged
+    def _ProcessLines_ApplyNemoMetaDesktop(lines_, meta_, fp_, mon_cnt_):
         lc = 0
         skip_block = False
         processing_block = False
-        curr_o = IconData({})
-        out_line = []
+        curr_o = None
+        pos_done = mon_done = False
+        seen = set()
+        # last text written, tells how the appended sections are separated
+        last = '\n'
 
         for line in lines_:
             lc += 1
             s = line.strip()
 
-            if(len(s) == 0):
+            if curr_o is not None and (len(s) == 0 or s.startswith('[')):
+                yield from IcMan._MetaKeyLines(curr_o, mon_cnt_,
+                                               not pos_done, not mon_done)
+                curr_o = None
+
+            last = line
+            if len(s) == 0:
                 processing_block = False
-                out_line.append('\n')
-                # print('0>>> ' + out_line[len(out_line) - 1])
+                yield line
+                continue
+
+            if s.startswith('#'):
+                yield line
                 continue
 
             if skip_block:
                 if not s.startswith('['):
-                    out_line.append(s + '\n')
-                    # print('1>>> ' + out_line[len(out_line) - 1])
+                    yield line
                     continue
                 else:
                     skip_block = False
 
-            if s.startswith("[desktop-monitor"):
+            if s.startswith(f"[{DESK_MON_HDR}"):
                 skip_block = True
-                out_line.append(s + '\n')
-                # print('2>>> ' + out_line[len(out_line) - 1])
+                yield line
                 continue
 
             if s.startswith("["):
                 processing_block = True
                 n = s.strip('[]')
 
-                if n not in meta_dict_:
+                i = meta_.FindName(n)
+                if i < 0:
                     skip_block = True
-                    out_line.append(s + '\n')
-                    # print('3>>> ' + out_line[len(out_line) - 1])
+                    yield line
                     continue
                 else:
-                    curr_o = meta_dict_[n]
+                    curr_o = meta_[i]
+                    pos_done = mon_done = False
+                    seen.add(n)
+                    yield line
+                    continue
 
             if not processing_block:
                 raise RuntimeError(f'{fp_} {E_GEN}\n line({lc}): {s}')
 
             if s.startswith(NIC_HDR + '='):
-                out_line.append(f'{NIC_HDR}={curr_o.x},{curr_o.y}\n')
-                # print('4>>> ' + out_line[len(out_line) - 1])
+                yield from IcMan._MetaKeyLines(curr_o, mon_cnt_, True, False)
+                pos_done = True
+                last = '-\n'
             elif s.startswith(MON_HDR + '='):
-                mon = curr_o.m if curr_o.m < mon_cnt_ else 0
-                out_line.append(f'{MON_HDR}={mon}\n')
+                yield from IcMan._MetaKeyLines(curr_o, mon_cnt_, False, True)
+                mon_done = True
+                last = '-\n'
             else:
-                out_line.append(s + '\n')
-                # print('5>>> ' + out_line[len(out_line) - 1])
+                yield line
 
-        return out_line
+        if curr_o is not None:
+            if not last.endswith('\n'):
+                yield '\n'
+            yield from IcMan._MetaKeyLines(curr_o, mon_cnt_,
+                                           not pos_done, not mon_done)
+            last = '-\n'
 
-    def _ApplyNemoMetaDesktop(fp_, meta_icons_, mon_cnt_):
+        for o in meta_:
+            if o.name in seen:
+                continue
+            if not last.endswith('\n'):
+                yield '\n'
+            if last.strip():
+                yield '\n'
+            yield f'[{o.name}]\n'
+            yield from IcMan._MetaKeyLines(o, mon_cnt_)
+            last = '-\n'
+
+    # streams the rewritten keyfile into a temp file next to fp_ and renames
+    # it over the original, so a crash never leaves a truncated file; env_
+    # is the UserEnv when fp_ is in another user's home: the directory and
+    # the keyfile are then opened without following symlinks, must belong
+    # to the home owner and the new file is given to them
+    def _ApplyNemoMetaDesktop(fp_, meta_icons_, mon_cnt_, env_=None):
         if len(meta_icons_) == 0:
             return
 
-        lines = []
-        meta_dict = {}
-
+        env = env_ if env_ is not None else UserEnv.Current()
+        owner = env.Owner()
+        meta_dir, name = os.path.split(fp_)
+        dfd = env.OpenDir(meta_dir, create_=True)
+        inf = None
         try:
-            with open(fp_, 'rt') as file1:
-                lines = file1.readlines()
-        except Exception as e:
-            print(f'_LoadNemoMetaIcons read exception:\n{e}')
-            return
-
-        for o in meta_icons_:
-            meta_dict[o.name] = o
-        out_line = IcMan._ProcessLines_ApplyNemoMetaDesktop(lines, meta_dict,
-                                                            fp_, mon_cnt_)
-
-        if len(out_line) > 0:
-            with open(fp_, "wt") as outf:
-                str = ''.join(out_line)
-                # print(str)
-                outf.write(str)
+            try:
+                inf = env.OpenFile(dfd, name)
+            except Exception as e:
+                if owner is not None:
+                    raise
+                print(f'_LoadNemoMetaIcons read exception:\n{e}',
+                      file=os.sys.stderr)
+                return
+            st = os.fstat(inf.fileno()) if inf is not None else None
+
+            tmp_name = f'.{name}.{os.urandom(6).hex()}'
+            fd = os.open(tmp_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                         os.O_NOFOLLOW, 0o600, dir_fd=dfd)
+            try:
+                with os.fdopen(fd, 'wt') as outf:
+                    outf.writelines(
+                        IcMan._ProcessLines_ApplyNemoMetaDesktop(
+                            inf if inf is not None else [], meta_icons_,
+                            fp_, mon_cnt_))
+                    outf.flush()
+                    if st is not None:
+                        TRACE.Count('bytes_read', st.st_size)
+                        os.fchmod(outf.fileno(), st.st_mode & 0o7777)
+                    if owner is not None:
+                        os.fchown(outf.fileno(), *owner)
+                    os.fsync(outf.fileno())
+                    TRACE.CountFile('bytes_written', outf.fileno())
+                os.replace(tmp_name, name, src_dir_fd=dfd, dst_dir_fd=dfd)
+            except BaseException:
+                os.unlink(tmp_name, dir_fd=dfd)
+                raise
+            os.fsync(dfd)
+        finally:
+            if inf is not None:
+                inf.close()
+            os.close(dfd)
 
     def SaveCurrentConfig(self):
+        with TRACE.Span('save'):
+            return self._SaveCurrentConfig()
+
+    def _SaveCurrentConfig(self):
         monitors = GetMonitorsInfo()
-        name_tpl = '0x0'
-
-        if len(monitors) == 1:
-            name_tpl = f'{monitors[0].w}x{monitors[0].h}'
-        elif len(monitors) == 2:
-            name_tpl = (f'{monitors[0].w}x{monitors[0].h}'
-                        f'+{monitors[1].w}x{monitors[1].h}')
-        elif len(monitors) == 3:
-            name_tpl = (f'{monitors[0].w}x{monitors[0].h}'
-                        f'+{monitors[1].w}x{monitors[1].h}'
-                        f'+{monitors[2].w}x{monitors[2].h}')
-        elif len(monitors) > 3:
-            name_tpl = (f'{monitors[0].w}x{monitors[0].h}'
-                        f'+{len(monitors)}monitors')
-
-        fp = IcMan._GenConfigPath(name_tpl)
-        icons = IcMan._LoadCurentIcons()
-        icons += IcMan._LoadNemoMetaIcons(NEMO_META_PATH)
-
-        if len(icons) > 0:
-            IcMan._SaveIconConf(fp, icons)
-            self.configs[gfjn(fp)] = icons
-
-    def _KillNemoDesktop():
-        subprocess.run(f'killall -u $(whoami) {NEMO_DESKTOP_NAME}',
-                       shell=True)
-
-    def _CheckNemoDesktopRunning():
-        s = f'pgrep -u $(whoami) {NEMO_DESKTOP_NAME}'
-        # print(f'Running:\n{s}')
-        try:
-            lines = subprocess.run(s, shell=True, check=True,
-                                   capture_output=True, text=True
-                                   ).stdout.splitlines()
-        except Exception:
-            return False
-        # sout = '\n'.join(lines)
-        # print(f'Result:\n{sout}')
-        return len(lines) > 0
-
-    def _StartNemoDesktop():
-        subprocess.Popen(f'{NEMO_DESKTOP_NAME}')
-
-    def _RestartNemoDesktop():
-        IcMan._KillNemoDesktop()
-        IcMan._StartNemoDesktop()
-
-    def ApplyConfig(self, name_):
+        name_tpl = LayoutName(monitors)
+
+        fp = self._GenConfigPath(name_tpl)
+        icons = IcMan._LoadCurrentState()
+        icons.monitors = monitors
+
+        if len(icons) == 0:
+            return None
+
+        return self._AddConfig(fp, icons, name_tpl)
+
+    def _AddConfig(self, fp_, icons_, layout_):
+        with TRACE.Span('profile.write', icons=len(icons_)):
+            IcMan._SaveIconConf(fp_, icons_)
+        with TRACE.Span('catalog.update'):
+            info = self.catalog.Update(fp_, layout_)
+        self.configs[info.name] = info
+        self.layouts.Add(info)
+        return info.name
+
+    # adds the current desktop to the snapshot history of name_ (the layout
+    # name by default); returns (name, version, new chunks) or None
+    def SnapshotCurrent(self, name_=None):
+        with TRACE.Span('snapshot.save'):
+            monitors = GetMonitorsInfo()
+            layout = LayoutName(monitors)
+            icons = IcMan._LoadCurrentState()
+            icons.monitors = monitors
+            if len(icons) == 0:
+                return None
+            name = name_ or layout
+            seq, written = self.snapshots.Save(name, icons, layout)
+            return name, seq, written
+
+    # turns a snapshot version (the latest by default) into a profile named
+    # name@version and returns the profile name
+    def RestoreSnapshot(self, name_, seq_=None):
+        with TRACE.Span('snapshot.restore'):
+            if seq_ is None:
+                versions = self.snapshots.Versions(name_)
+                if not versions:
+                    return None
+                seq_ = versions[-1]
+            layout = self.snapshots.Manifest(name_, seq_).get('layout', '')
+            icons = self.snapshots.Load(name_, seq_)
+            fp = self._GenConfigPath(f'{name_}@{seq_}')
+            return self._AddConfig(fp, icons, layout)
+
+    def _LoadCurrentState(env_=None):
+        icons = IcMan._LoadCurentIcons(env_)
+        with TRACE.Span('current.meta'):
+            if env_ is None:
+                icons.Extend(IcMan._LoadNemoMetaIcons(NEMO_META_PATH))
+            else:
+                icons.Extend(IcMan._LoadNemoMetaIcons(env_.nemo_meta_path,
+                                                      env_))
+        return icons
+
+    # profile icons moved onto the current monitors
+    def _GetRemappedIcons(self, name_, monitors_):
+        with TRACE.Span('profile.load'):
+            icons = self._GetIcons(name_)
+        with TRACE.Span('profile.remap'):
+            moved = RemapIcons(icons, icons.monitors, monitors_)
+        if moved > 0:
+            print(f'{name_}: {moved} icons remapped to the current layout')
+        return icons
+
+    def _ResolveOverlaps(name_, icons_, current_, monitors_):
+        fixed = IconSet()
+        for fp, name, x, y, m in current_.Rows():
+            i = (icons_.FindName(name) if fp == META_PATH_HOLDER
+                 else icons_.FindPath(fp))
+            if i < 0:
+                fixed.Append(fp, name, x, y, m)
+        with TRACE.Span('profile.resolve'):
+            moved = ResolveOverlaps(icons_, monitors_, fixed)
+        if moved > 0:
+            print(f'{name_}: {moved} icons moved to the grid or apart')
+
+    def DiffConfig(self, name_, monitors_=None, force_=False,
+                   resolve_=None):
+        if monitors_ is None:
+            monitors_ = GetMonitorsInfo()
+        if resolve_ is None:
+            resolve_ = RESOLVE_OVERLAPS
+
+        icons = self._GetRemappedIcons(name_, monitors_)
+        current = None
+        if resolve_ or not force_:
+            current = IcMan._LoadCurrentState()
+        if resolve_:
+            IcMan._ResolveOverlaps(name_, icons, current, monitors_)
+
+        with TRACE.Span('diff'):
+            if force_:
+                diff = ConfigDiff()
+                diff.gio, diff.meta = icons.Split()
+                return diff
+            return ConfigDiff.Build(icons, current, len(monitors_))
+
+    # writes only the icons which differ from the current desktop and skips
+    # the nemo-desktop restart when nothing differs; force_ rewrites all
+    # icons, dry_run_ only prints the difference, resolve_ snaps icons to
+    # the grid and moves overlapping ones apart; progress_(done, total) is
+    # called from the calling thread as icons are written and a set cancel_
+    # event undoes the written icons any time before nemo-desktop restarts;
+    # hot_ (HOT_APPLY by default) keeps nemo-desktop running when no keyfile
+    # entry changes
+    def ApplyConfig(self, name_, dry_run_=False, force_=False,
+                    resolve_=None, progress_=None, cancel_=None, hot_=None):
+        if hot_ is None:
+            hot_ = HOT_APPLY
+        with TRACE.Span('apply', profile=name_):
+            return self._ApplyConfig(name_, dry_run_, force_, resolve_,
+                                     progress_, cancel_, hot_)
+
+    def _ApplyConfig(self, name_, dry_run_, force_, resolve_, progress_,
+                     cancel_, hot_):
         if name_ not in self.configs:
             print(f'Invalid condig name: {name_}')
-            return
+            return None
 
-        icons = self.configs[name_]
-        meta_icons = []
         monitors = GetMonitorsInfo()
         mon_cnt = len(monitors)
 
-        IcMan._KillNemoDesktop()
-        for o in icons:
+        diff = self.DiffConfig(name_, monitors, force_, resolve_)
 
-            if o.fp != META_PATH_HOLDER:
-                cmd = GIO_SET_ICONS_POS_CMD_TPL.format(o.fp, o.x, o.y)
-                subprocess.run(cmd, shell=True)
-                mon = o.m if o.m < mon_cnt else 0
-                cmd = GIO_SET_ICONS_MON_CMD_TPL.format(o.fp, mon)
-                subprocess.run(cmd, shell=True)
-            else:
-                meta_icons.append(o)
+        if dry_run_:
+            for line in diff.Lines():
+                print(line)
+            return diff
 
-            # IcMan.ShakeIcon(o.fp)
+        if diff.Empty():
+            print(f'{name_}: desktop already matches, nothing to apply')
+            return diff
 
-        while IcMan._CheckNemoDesktopRunning():
-            IcMan._KillNemoDesktop()
-            time.sleep(1)
+        gio_icons, meta_icons = diff.gio, diff.meta
+        total = len(gio_icons) + len(meta_icons)
 
-        IcMan._ApplyNemoMetaDesktop(NEMO_META_PATH, meta_icons, mon_cnt)
-        IcMan._StartNemoDesktop()
+        if cancel_ is not None and cancel_.is_set():
+            diff.cancelled = True
+            print(f'{name_}: cancelled, nothing applied')
+            return diff
+
+        nemo = NemoSupervisor()
+        if hot_ and len(meta_icons) == 0 and nemo.IsRunning():
+            return IcMan._HotApply(name_, diff, mon_cnt, progress_, cancel_)
+
+        with TRACE.Span('nemo.stop_begin'):
+            nemo.BeginStop()
+        # nemo-desktop is started again whatever fails in between, the
+        # user is never left without a desktop
+        try:
+            writer = GioMetaWriter()
+            with TRACE.Span('gio.write', icons=len(gio_icons)):
+                failed = writer.Write(gio_icons, mon_cnt, progress_, cancel_,
+                                      total)
+            for fp, err in failed:
+                print(f'Failed to set metadata: {fp}\nerr: {err}',
+                      file=os.sys.stderr)
+
+            with TRACE.Span('nemo.stop_wait'):
+                stop_time = nemo.WaitStopped()
+            print(f'{NEMO_DESKTOP_NAME} stopped in {stop_time:.3f}s'
+                  + (' (killed)' if nemo.killed else ''))
+
+            if cancel_ is not None and cancel_.is_set():
+                diff.cancelled = True
+                with TRACE.Span('gio.revert', icons=writer.written):
+                    writer.Write(diff.Reverted(writer.written), mon_cnt)
+                print(f'{name_}: cancelled, {writer.written} written icons '
+                      'reverted')
+            else:
+                with TRACE.Span('meta.rewrite', icons=len(meta_icons)):
+                    IcMan._ApplyNemoMetaDesktop(NEMO_META_PATH, meta_icons,
+                                                mon_cnt)
+                if progress_ is not None:
+                    progress_(total, total)
+        finally:
+            with TRACE.Span('nemo.start'):
+                nemo.Start()
+        return diff
+
+    # gio metadata is written under the running nemo-desktop, which is then
+    # nudged to show the new positions
+    def _HotApply(name_, diff_, mon_cnt_, progress_, cancel_):
+        diff_.hot = True
+        writer = GioMetaWriter()
+        with TRACE.Span('gio.write', icons=len(diff_.gio)):
+            failed = writer.Write(diff_.gio, mon_cnt_, progress_, cancel_)
+        for fp, err in failed:
+            print(f'Failed to set metadata: {fp}\nerr: {err}',
+                  file=os.sys.stderr)
+
+        if cancel_ is not None and cancel_.is_set():
+            diff_.cancelled = True
+            with TRACE.Span('gio.revert', icons=writer.written):
+                writer.Write(diff_.Reverted(writer.written), mon_cnt_)
+            print(f'{name_}: cancelled, {writer.written} written icons '
+                  'reverted')
+            return diff_
+
+        bad = set(fp for fp, _ in failed)
+        paths = [fp for fp, _, _, _, _ in diff_.gio.Rows() if fp not in bad]
+        with TRACE.Span('nemo.nudge', icons=len(paths)):
+            IcMan._NudgeIcons(paths)
+        print(f'{name_}: {len(paths)} icons applied, {NEMO_DESKTOP_NAME} '
+              'kept running')
+        return diff_
+
+    # makes the running desktop re-read the positions of the files
+    def _NudgeIcons(paths_):
+        if HOT_NUDGE == 'touch':
+            for fp in paths_:
+                try:
+                    os.utime(fp)
+                except OSError as e:
+                    print(f'Failed to touch: {fp}\nerr: {e}',
+                          file=os.sys.stderr)
+            return
+
+        # a signal would leave the files hidden until the next start; only
+        # the signals for this thread are held, other threads may still
+        # take them
+        blocked = signal.pthread_sigmask(signal.SIG_BLOCK, HOT_NUDGE_SIGNALS)
+        moved = []
+        try:
+            for fp in paths_:
+                tmp_fp = os.path.join(os.path.dirname(fp),
+                                      HOT_NUDGE_PREFIX + os.path.basename(fp))
+                try:
+                    RenameNoReplace(fp, tmp_fp)
+                except OSError as e:
+                    print(f'Failed to move: {fp}\nerr: {e}',
+                          file=os.sys.stderr)
+                    continue
+                moved.append((fp, tmp_fp))
+            if moved:
+                time.sleep(HOT_NUDGE_DELAY)
+        finally:
+            for fp, tmp_fp in moved:
+                try:
+                    RenameNoReplace(tmp_fp, fp)
+                except OSError as e:
+                    print(f'Failed to move back: {tmp_fp}\nerr: {e}',
+                          file=os.sys.stderr)
+            signal.pthread_sigmask(signal.SIG_SETMASK, blocked)
+
+    # renames back the files a killed nudge left hidden in dir_
+    def _RestoreNudged(dir_=DESKTOP_DIR):
+        try:
+            names = os.listdir(dir_)
+        except OSError:
+            return
+        for n in names:
+            if not n.startswith(HOT_NUDGE_PREFIX) or n == HOT_NUDGE_PREFIX:
+                continue
+            tmp_fp = f'{dir_}/{n}'
+            fp = f'{dir_}/{n[len(HOT_NUDGE_PREFIX):]}'
+            try:
+                RenameNoReplace(tmp_fp, fp)
+                print(f'Restored: {fp}', file=os.sys.stderr)
+            except OSError as e:
+                print(f'Failed to move back: {tmp_fp}\nerr: {e}',
+                      file=os.sys.stderr)
+
+    # profile icons of src_dir_ moved to the same names in dst_dir_
+    def _RebaseIcons(icons_, src_dir_, dst_dir_):
+        prefix = src_dir_.rstrip('/') + '/'
+        icons = IconSet()
+        icons.monitors = icons_.monitors
+        for fp, name, x, y, m in icons_.Rows():
+            if fp.startswith(prefix):
+                fp = f'{dst_dir_}/{fp[len(prefix):]}'
+            icons.Append(fp, name, x, y, m)
+        return icons
+
+    def _ApplyToHome(icons_, home_, dry_run_, restart_):
+        r = FleetResult(home_)
+        t0 = time.monotonic()
+        try:
+            env = UserEnv.ForHome(home_)
+            icons = IcMan._RebaseIcons(icons_, DESKTOP_DIR, env.desktop)
+            mon_cnt = max(1, len(icons.monitors))
+            diff = ConfigDiff.Build(icons, IcMan._LoadCurrentState(env),
+                                    mon_cnt)
+            r.changed = len(diff.gio) + len(diff.meta)
+            r.gone = len(diff.gone)
+            if not dry_run_ and not diff.Empty():
+                r.failed = IcMan._WriteHome(env, diff, mon_cnt, restart_)
+            r.ok = not r.failed
+        except Exception as e:
+            r.error = str(e) or type(e).__name__
+        r.seconds = time.monotonic() - t0
+        return r
+
+    # a running nemo-desktop keeps the keyfile in memory and writes it back
+    # over ours, so it is stopped first and started again after the
+    # rewrite; without restart_ its keyfile entries fail instead. Returns
+    # list of (path, error message) which were not written
+    def _WriteHome(env_, diff_, mon_cnt_, restart_):
+        failed = []
+        meta = diff_.meta
+        nemo = NemoSupervisor(uid_=env_.uid)
+        stop = (restart_ or len(meta) > 0) and nemo.IsRunning()
+        if stop and not restart_:
+            failed = [(f'{env_.nemo_meta_path} [{name}]',
+                       f'{NEMO_DESKTOP_NAME} is running, use --restart')
+                      for _, name, _, _, _ in meta.Rows()]
+            meta = IconSet()
+            stop = False
+
+        if stop:
+            nemo.BeginStop()
+        try:
+            failed += GioMetaWriter(env_.run_as).Write(diff_.gio, mon_cnt_)
+            if stop:
+                nemo.WaitStopped()
+            IcMan._ApplyNemoMetaDesktop(env_.nemo_meta_path, meta, mon_cnt_,
+                                        env_)
+        finally:
+            if stop:
+                nemo.Start()
+        return failed
+
+    # applies profile name_ to every home in homes_ on a pool of jobs_
+    # threads (one per core by default); the work is mostly waiting on gio
+    # processes and files, so the homes really run side by side. Returns a
+    # FleetResult per home, in order
+    def FleetApply(self, name_, homes_, jobs_=None, dry_run_=False,
+                   restart_=False):
+        icons = self._GetIcons(name_)
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=jobs_ or FLEET_JOBS) as pool:
+            futures = [pool.submit(IcMan._ApplyToHome, icons, home,
+                                   dry_run_, restart_) for home in homes_]
+            return [f.result() for f in futures]
 
     def GetConfigFullPath(name_):
         fp = f'{CONFIG_DIR}/{name_}.{DATA_FILE_EXT}'
@@ -604,151 +3143,1296 @@ class IcMan:
         print('CTD: ', fp)
         if os.path.exists(fp):
             os.remove(fp)
+        self.cache.Drop(fp)
         self.configs.pop(name_, None)
+        self.catalog.Remove(name_)
+        self.layouts.Remove(name_)
 
     def Rename(self, new_name_, old_name_):
         if new_name_ != old_name_:
             fp_old = IcMan.GetConfigFullPath(old_name_)
             fp_new = IcMan.GetConfigFullPath(new_name_)
             print(f'CTR: {fp_old} => {fp_new}')
+            self.cache.Drop(fp_old)
+            self.cache.Drop(fp_new)
 
             if os.path.exists(fp_old):
                 if os.path.exists(fp_new):
                     os.remove(fp_new)
                 os.rename(fp_old, fp_new)
-            self.configs[new_name_] = self.configs.pop(old_name_)
-
-#   def ShakeIcon(_fp):
-#       name = gfjn(_fp)
-#       tmp_fp = f'{HOME_DIR}/{name}.{DATA_FILE_EXT}'
-#       os.rename(_fp, tmp_fp)
-#       os.rename(tmp_fp, _fp)
-#       # print ("Moved: ", _fp, " <==> ", tmp_fp)
+            self.catalog.entries.pop(new_name_, None)
+            self.configs.pop(new_name_, None)
+            info = self.catalog.Rename(old_name_, new_name_, fp_new)
+            self.configs.pop(old_name_, None)
+            self.layouts.Remove(old_name_)
+            self.layouts.Remove(new_name_)
+            if info is not None and info.count > 0:
+                self.configs[new_name_] = info
+                self.layouts.Add(info)
+
+############################################################################
+
+
+# homes handled at once by a fleet apply
+FLEET_JOBS = os.cpu_count() or 1
+# runs gio as the owner of a home when icman itself runs as root
+FLEET_RUN_AS = ['runuser', '-u', '{user}', '--']
+# gio reaches the owner's gvfs metadata daemon over the session bus in
+# their runtime dir; owners without a running session get a private bus
+# from dbus-run-session for every gio call, which is much slower
+FLEET_RUNTIME_DIR = '/run/user/{uid}'
+FLEET_NO_SESSION = ['dbus-run-session', '--']
+
+
+# paths of one user's desktop, profiles and nemo keyfile; ForHome() lays
+# them out with the XDG defaults of any home
+class UserEnv:
+
+    def __init__(self, home_, desktop_, config_dir_, nemo_meta_path_, uid_,
+                 gid_, run_as_=()):
+        self.home = home_
+        self.desktop = desktop_
+        self.config_dir = config_dir_
+        self.nemo_meta_path = nemo_meta_path_
+        self.uid = uid_
+        self.gid = gid_
+        self.run_as = list(run_as_)
+
+    def ForHome(home_):
+        home = os.path.abspath(home_)
+        st = os.stat(home)
+        run_as = ()
+        if st.st_uid != os.geteuid():
+            if os.geteuid() != 0:
+                raise PermissionError(f'{home} belongs to another user, '
+                                      'run as root')
+            run_as = UserEnv._RunAs(home, st.st_uid)
+        return UserEnv(home, f'{home}/Desktop', f'{home}/.config/{APP_NAME}',
+                       f'{home}/.config/{NEMO_NAME}/{NEMO_META_FILE_NAME}',
+                       st.st_uid, st.st_gid, run_as)
+
+    # command prefix running as uid_ with the home and session bus of that
+    # user rather than the ones inherited from root
+    def _RunAs(home_, uid_):
+        user = pwd.getpwuid(uid_).pw_name
+        cmd = [a.format(user=user) for a in FLEET_RUN_AS]
+        cmd += ['env', '-u', 'XDG_DATA_HOME', '-u', 'XDG_CONFIG_HOME']
+        runtime = FLEET_RUNTIME_DIR.format(uid=uid_)
+        if os.path.exists(f'{runtime}/bus'):
+            return cmd + [f'HOME={home_}', f'XDG_RUNTIME_DIR={runtime}',
+                          f'DBUS_SESSION_BUS_ADDRESS=unix:path={runtime}/bus']
+        return cmd + ['-u', 'XDG_RUNTIME_DIR', '-u',
+                      'DBUS_SESSION_BUS_ADDRESS', f'HOME={home_}'] + \
+            FLEET_NO_SESSION
+
+    # owner for the files written into the home, None for our own
+    def Owner(self):
+        if self.uid == os.geteuid():
+            return None
+        return self.uid, self.gid
+
+    def _CheckOwner(self, fd_, path_):
+        if os.fstat(fd_).st_uid != self.uid:
+            raise PermissionError(f'{path_} does not belong to the owner '
+                                  f'of {self.home}')
+
+    # fd of directory path_; in another user's home every level below the
+    # home is opened without following symlinks and has to belong to the
+    # owner, so root never reads or writes files through planted links.
+    # create_ makes missing levels, owned by the home owner
+    def OpenDir(self, path_, create_=False):
+        flags = os.O_RDONLY | os.O_DIRECTORY
+        if self.Owner() is None:
+            if create_:
+                os.makedirs(path_, exist_ok=True)
+            return os.open(path_, flags)
+
+        rel = os.path.relpath(path_, self.home)
+        if rel == '..' or rel.startswith('../'):
+            raise PermissionError(f'{path_} is outside of {self.home}')
+        fd = os.open(self.home, flags)
+        try:
+            self._CheckOwner(fd, self.home)
+            path = self.home
+            for part in rel.split('/'):
+                if part in ('', '.'):
+                    continue
+                path += '/' + part
+                try:
+                    nfd = os.open(part, flags | os.O_NOFOLLOW, dir_fd=fd)
+                except FileNotFoundError:
+                    if not create_:
+                        raise
+                    os.mkdir(part, 0o700, dir_fd=fd)
+                    os.chown(part, self.uid, self.gid, dir_fd=fd,
+                             follow_symlinks=False)
+                    nfd = os.open(part, flags | os.O_NOFOLLOW, dir_fd=fd)
+                os.close(fd)
+                fd = nfd
+                self._CheckOwner(fd, path)
+            return fd
+        except BaseException:
+            os.close(fd)
+            raise
+
+    # file name_ of directory dfd_ opened for reading, None when missing;
+    # in another user's home it must be a regular file of the owner and
+    # not a symlink
+    def OpenFile(self, dfd_, name_):
+        strict = self.Owner() is not None
+        flags = os.O_RDONLY
+        if strict:
+            flags |= os.O_NOFOLLOW | os.O_NONBLOCK
+        try:
+            fd = os.open(name_, flags, dir_fd=dfd_)
+        except FileNotFoundError:
+            return None
+        try:
+            if strict:
+                if not stat.S_ISREG(os.fstat(fd).st_mode):
+                    raise PermissionError(f'{name_} is not a regular file')
+                self._CheckOwner(fd, name_)
+            return os.fdopen(fd, 'rt')
+        except BaseException:
+            os.close(fd)
+            raise
+
+    # the current user's paths
+    def Current():
+        return UserEnv(HOME_DIR, DESKTOP_DIR, CONFIG_DIR,
+                       NEMO_META_PATH, os.geteuid(), os.getegid())
+
+
+class FleetResult:
+
+    def __init__(self, home_):
+        self.home = home_
+        self.ok = False
+        self.changed = 0
+        self.gone = 0
+        self.failed = []
+        self.error = ''
+        self.seconds = 0.0
+
+    def ToDict(self):
+        return dict(vars(self))
+
+
+# seconds without RandR events before a new layout counts as settled
+DAEMON_SETTLE_TIME = 2.0
+
+
+# headless mode: waits for RandR events on the X connection and applies the
+# best matching saved profile once hot-plug events settle down
+class AutoRestoreDaemon:
+
+    def __init__(self, icman_, settle_=DAEMON_SETTLE_TIME):
+        self.icman = icman_
+        self.settle = settle_
+        self.mons = MonitorService.Get()
+        self.applied_layout = None
+
+    def _LayoutKey(monitors_):
+        return tuple((m.name, m.x, m.y, m.w, m.h) for m in monitors_)
+
+    def _OnSettled(self):
+        monitors = GetMonitorsInfo()
+        key = AutoRestoreDaemon._LayoutKey(monitors)
+        if key == self.applied_layout:
+            return
+        self.applied_layout = key
+
+        self.icman._LoadConfigs()
+        name = self.icman.MatchConfig(monitors)
+        if name is None:
+            print(f'Layout {LayoutName(monitors)}: no saved profile')
+            return
+        print(f'Layout {LayoutName(monitors)}: applying {name}')
+        self.icman.ApplyConfig(name)
+        print(f'Profile cache: {self.icman.cache.Stats()}')
+
+    def Run(self):
+        fd = self.mons.Fileno()
+        self.applied_layout = AutoRestoreDaemon._LayoutKey(GetMonitorsInfo())
+        generation = self.mons.generation
+        deadline = None
+
+        try:
+            while True:
+                self.mons.ProcessEvents()
+                if self.mons.generation != generation:
+                    generation = self.mons.generation
+                    deadline = time.monotonic() + self.settle
+
+                timeout = None
+                if deadline is not None:
+                    timeout = max(0.0, deadline - time.monotonic())
+                    if timeout == 0.0:
+                        deadline = None
+                        try:
+                            self._OnSettled()
+                        except Exception as e:
+                            print(f'Auto restore failed:\n{e}')
+                        continue
+
+                select.select([fd], [], [], timeout)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.mons.Close()
+        return 0
+
+
+# seconds without metadata changes before the journal records the moves,
+# and the longest an ongoing stream of changes can delay a record
+JOURNAL_SETTLE_TIME = float(os.environ.get('ICMAN_JOURNAL_SETTLE', '1.0'))
+JOURNAL_MAX_DELAY = 10.0
+
+
+def _IconKey(fp_, name_):
+    return name_ if fp_ == META_PATH_HOLDER else fp_
+
+
+# append-only log of icon moves, one json line per recorded batch:
+# {"t": time, "monitors": [...] (when the layout changed), "icons": [...]};
+# replaying it from the start gives the latest position of every icon
+class DesktopJournal:
+
+    def __init__(self, fp_):
+        self.fp = fp_
+
+    # returns (IconSet, monitors, time of the last batch)
+    def Replay(self):
+        state = {}
+        monitors = []
+        t = None
+        try:
+            with open(self.fp, "rt") as inf:
+                TRACE.CountFile('bytes_read', inf.fileno())
+                for line in inf:
+                    try:
+                        batch = json.loads(line)
+                    except ValueError:
+                        # torn last line of a crashed writer
+                        continue
+                    t = batch.get('t', t)
+                    if 'monitors' in batch:
+                        monitors = [Monitor(m) for m in batch['monitors']]
+                    for d in batch.get('icons', []):
+                        state[_IconKey(d.get('fp', ''),
+                                       d.get('name', ''))] = d
+        except FileNotFoundError:
+            pass
+        icons = IconSet.FromDicts(state.values())
+        icons.monitors = monitors
+        return icons, monitors, t
+
+    def Append(self, icons_, monitors_=None):
+        batch = {'t': time.time()}
+        if monitors_ is not None:
+            batch['monitors'] = [m.ToDict() for m in monitors_]
+        batch['icons'] = icons_.ToDicts()
+        raw = (json.dumps(batch, separators=(',', ':')) + '\n').encode()
+        fd = os.open(self.fp, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            # a crashed writer may have left a torn last line, the record
+            # starts on a new one so Replay skips only the torn bytes
+            size = os.fstat(fd).st_size
+            if size > 0 and os.pread(fd, 1, size - 1) != b'\n':
+                raw = b'\n' + raw
+            os.write(fd, raw)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        TRACE.Count('bytes_written', len(raw))
+
+    # saves the replayed state as a profile and restarts the journal from
+    # it, so the journal stays complete but short; returns the profile name
+    def Compact(self, icman_, name_=None):
+        icons, monitors, _ = self.Replay()
+        if len(icons) == 0:
+            return None
+        layout = LayoutName(monitors)
+        fp = icman_._GenConfigPath(name_ or f'{layout}_journal')
+        name = icman_._AddConfig(fp, icons, layout)
+
+        d = os.path.dirname(self.fp)
+        fd, tmp_fp = tempfile.mkstemp(dir=d, prefix=JOURNAL_FILE_NAME)
+        os.close(fd)
+        try:
+            DesktopJournal(tmp_fp).Append(icons, monitors)
+            os.replace(tmp_fp, self.fp)
+        except BaseException:
+            os.unlink(tmp_fp)
+            raise
+        return name
+
+
+# watches desktop-metadata and the gvfs metadata store, and once changes
+# settle appends the icons which moved since the last record
+class JournalWatcher:
+
+    def __init__(self, journal_, settle_=JOURNAL_SETTLE_TIME):
+        self.journal = journal_
+        self.settle = settle_
+        self.state = {}
+        self.monitors = None
+
+    def _Load(self):
+        icons, monitors, _ = self.journal.Replay()
+        self.state = {_IconKey(fp, name): (x, y, m)
+                      for fp, name, x, y, m in icons.Rows()}
+        self.monitors = [m.Key() for m in monitors] if monitors else None
+
+    # returns the number of icons recorded
+    def Record(self):
+        with TRACE.Span('journal.record'):
+            monitors = GetMonitorsInfo()
+            current = IcMan._LoadCurrentState()
+            moved = IconSet()
+            for fp, name, x, y, m in current.Rows():
+                key = _IconKey(fp, name)
+                if self.state.get(key) != (x, y, m):
+                    self.state[key] = (x, y, m)
+                    moved.Append(fp, name, x, y, m)
+
+            keys = [m.Key() for m in monitors]
+            changed = keys != self.monitors
+            if len(moved) == 0 and not changed:
+                return 0
+            self.journal.Append(moved, monitors if changed else None)
+            self.monitors = keys
+            return len(moved)
+
+    def _Watch(self):
+        ino = Inotify()
+        meta_dir = os.path.dirname(NEMO_META_PATH)
+        os.makedirs(meta_dir, exist_ok=True)
+        ino.Watch(meta_dir, IN_CLOSE_WRITE | IN_MOVED_TO)
+        try:
+            ino.Watch(GVFS_META_DIR, IN_MODIFY | IN_CLOSE_WRITE
+                      | IN_MOVED_TO | IN_CREATE)
+        except OSError as e:
+            print(f'gio metadata changes are not watched: {e}')
+        return ino, meta_dir
+
+    def Run(self):
+        self._Load()
+        ino, meta_dir = self._Watch()
+        print(f'{self.Record()} icons recorded to {self.journal.fp}')
+        deadline = None
+        first = None
+
+        try:
+            while True:
+                timeout = None
+                if deadline is not None:
+                    timeout = max(0.0, min(deadline,
+                                           first + JOURNAL_MAX_DELAY)
+                                  - time.monotonic())
+                r, _, _ = select.select([ino.Fileno()], [], [], timeout)
+                if r:
+                    for path, name, _, _ in ino.Read():
+                        if path == meta_dir and name != NEMO_META_FILE_NAME:
+                            continue
+                        now = time.monotonic()
+                        deadline = now + self.settle
+                        first = first or now
+                    continue
+                if deadline is not None:
+                    deadline = first = None
+                    try:
+                        n = self.Record()
+                    except Exception as e:
+                        print(f'Journal record failed:\n{e}')
+                        continue
+                    if n > 0:
+                        print(f'{n} icons recorded')
+        except KeyboardInterrupt:
+            pass
+        finally:
+            ino.Close()
+        return 0
+
+
 ############################################################################
 
 
 GRID_LB_VERT_SIZE = 6
 
+# milliseconds between checks of the worker queue while save/apply runs
+GUI_POLL_MS = 50
+
+# profile list columns: date, layout, name
+GUI_LIST_COLS = (4, 140, 300)
+GUI_LIST_SEL_BG = '#4a6984'
+GUI_LIST_SEL_FG = 'white'
+
+
+# thumbnails turned into Tk images, at most this many kept
+GUI_THUMB_IMAGES = 512
+
+
+# thumbnails are read or rendered on a worker thread, newest request
+# first, so the rows in view come before the ones already scrolled past;
+# the Tk thread only turns finished ppm data into PhotoImages
+class ThumbnailLoader:
 
+    def __init__(self, root_, store_, on_ready_):
+        self.root = root_
+        self.store = store_
+        self.on_ready = on_ready_
+        self.requests = queue.LifoQueue()
+        self.results = queue.Queue()
+        self.images = collections.OrderedDict()
+        self.pending = set()
+        self.polling = False
+        threading.Thread(target=self._Run, daemon=True).start()
+
+    def _Run(self):
+        while True:
+            checksum, arg = self.requests.get()
+            if checksum is None:
+                self.store.Prune(arg)
+                continue
+            try:
+                data = self.store.Get(checksum, arg)
+            except Exception as e:
+                print(f'Thumbnail of {arg} failed:\n{e}')
+                data = None
+            self.results.put((checksum, data))
+
+    def Prune(self, checksums_):
+        self.requests.put((None, set(checksums_)))
+
+    # PhotoImage for the checksum, or None while it is being loaded
+    def Image(self, checksum_, fp_):
+        img = self.images.get(checksum_)
+        if img is not None:
+            self.images.move_to_end(checksum_)
+            return img
+        if checksum_ not in self.pending:
+            self.pending.add(checksum_)
+            self.requests.put((checksum_, fp_))
+            if not self.polling:
+                self.polling = True
+                self.root.after(GUI_POLL_MS, self._Poll)
+        return None
+
+    def _Poll(self):
+        from tkinter import PhotoImage
+
+        ready = False
+        while True:
+            try:
+                checksum, data = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.pending.discard(checksum)
+            if data is None:
+                continue
+            self.images[checksum] = PhotoImage(data=data, format='PPM')
+            ready = True
+        while len(self.images) > GUI_THUMB_IMAGES:
+            self.images.popitem(last=False)
+
+        self.polling = bool(self.pending)
+        if self.polling:
+            self.root.after(GUI_POLL_MS, self._Poll)
+        if ready:
+            self.on_ready()
+
+
+# Canvas list of the profiles which draws only the rows in view, so it
+# opens and scrolls at the same speed for ten or ten thousand profiles.
+# Rows are keyed by profile name, kept newest first and filtered by a
+# search over name, layout and date
+class ProfileList:
+
+    # thumbs_ is a ThumbnailLoader, None for text only rows
+    def __init__(self, parent_, on_activate_, thumbs_=None):
+        from tkinter import Canvas, Scrollbar, font
+
+        self.on_activate = on_activate_
+        self.thumbs = thumbs_
+        self.canvas = Canvas(parent_, width=540, height=280, bg='white',
+                             highlightthickness=0, takefocus=1)
+        self.scrollbar = Scrollbar(parent_, orient="vertical",
+                                   command=self._YView)
+        self.row_h = font.nametofont('TkDefaultFont').metrics(
+            'linespace') + 4
+        self.x0 = 0
+        if thumbs_ is not None:
+            self.row_h = max(self.row_h, THUMB_H + 4)
+            self.x0 = THUMB_W + 8
+        # name -> (sort key, date, layout, search text, checksum, path)
+        self.rows = {}
+        self.order = []
+        self.shown = []
+        self.query = ''
+        self.top = 0
+        self.selected = None
+
+        c = self.canvas
+        c.bind('<Configure>', lambda e: self._Draw())
+        c.bind('<Button-1>', self._OnClick)
+        c.bind('<Double-1>', lambda e: self.on_activate())
+        c.bind('<Return>', lambda e: self.on_activate())
+        c.bind('<Up>', lambda e: self._Step(-1))
+        c.bind('<Down>', lambda e: self._Step(1))
+        c.bind('<Prior>', lambda e: self._Step(-self._Visible()))
+        c.bind('<Next>', lambda e: self._Step(self._Visible()))
+        c.bind('<MouseWheel>',
+               lambda e: self._Scroll(-1 if e.delta > 0 else 1))
+        c.bind('<Button-4>', lambda e: self._Scroll(-3))
+        c.bind('<Button-5>', lambda e: self._Scroll(3))
+
+    def _Row(info_):
+        dt = datetime.datetime.fromtimestamp(info_.mtime)
+        date = dt.strftime("%Y-%m-%d %H:%M:%S")
+        return ((-info_.mtime, info_.name), date, info_.layout,
+                f'{info_.name}\n{info_.layout}\n{date}'.lower(),
+                info_.checksum, info_.fp)
+
+    def _Matches(self, name_):
+        return self.query in self.rows[name_][3]
+
+    def SetRows(self, infos_):
+        self.rows = {i.name: ProfileList._Row(i) for i in infos_}
+        self.order = sorted(r[0] for r in self.rows.values())
+        self.shown = [k for k in self.order if self._Matches(k[1])]
+        self._Draw()
+
+    def Insert(self, info_):
+        self.Remove(info_.name, False)
+        row = ProfileList._Row(info_)
+        self.rows[info_.name] = row
+        bisect.insort(self.order, row[0])
+        if self._Matches(info_.name):
+            bisect.insort(self.shown, row[0])
+        self._Draw()
+
+    def Remove(self, name_, draw_=True):
+        row = self.rows.pop(name_, None)
+        if row is None:
+            return
+        for keys in (self.order, self.shown):
+            i = bisect.bisect_left(keys, row[0])
+            if i < len(keys) and keys[i] == row[0]:
+                del keys[i]
+        if draw_:
+            self._Draw()
+
+    # a query extending the last one only narrows the rows already shown
+    def Filter(self, query_):
+        query = query_.strip().lower()
+        keys = (self.shown if self.query and query.startswith(self.query)
+                else self.order)
+        self.query = query
+        self.shown = [k for k in keys if self._Matches(k[1])]
+        self.top = 0
+        self._Draw()
+
+    # the selected profile, or the first one in view like the old Listbox
+    def Selected(self):
+        if self.selected in self.rows and self._Matches(self.selected):
+            return self.selected
+        return self.shown[0][1] if self.shown else None
+
+    def _Visible(self):
+        return max(1, self.canvas.winfo_height() // self.row_h)
+
+    def _SetTop(self, top_):
+        self.top = max(0, min(top_, len(self.shown) - self._Visible()))
+        self._Draw()
+
+    def _Scroll(self, rows_):
+        self._SetTop(self.top + rows_)
+
+    def _YView(self, *args_):
+        if args_[0] == 'moveto':
+            self._SetTop(int(float(args_[1]) * len(self.shown)))
+        elif args_[0] == 'scroll':
+            n = int(args_[1])
+            self._Scroll(n * self._Visible() if args_[2] == 'pages' else n)
+
+    def _Index(self, name_):
+        row = self.rows.get(name_)
+        if row is None:
+            return -1
+        i = bisect.bisect_left(self.shown, row[0])
+        return i if i < len(self.shown) and self.shown[i] == row[0] else -1
+
+    def _Step(self, n_):
+        if not self.shown:
+            return
+        i = self._Index(self.Selected())
+        i = max(0, min(i + n_, len(self.shown) - 1))
+        self.selected = self.shown[i][1]
+        if i < self.top:
+            self.top = i
+        elif i >= self.top + self._Visible():
+            self.top = i - self._Visible() + 1
+        self._Draw()
+
+    def _OnClick(self, e_):
+        self.canvas.focus_set()
+        i = self.top + e_.y // self.row_h
+        if i < len(self.shown):
+            self.selected = self.shown[i][1]
+            self._Draw()
+
+    def _Draw(self):
+        c = self.canvas
+        c.delete('all')
+        vis = self._Visible()
+        self.top = max(0, min(self.top, len(self.shown) - vis))
+        w = c.winfo_width()
+        x_date, x_layout, x_name = (self.x0 + x for x in GUI_LIST_COLS)
+        selected = self.Selected()
+        for r, (_, name) in enumerate(self.shown[self.top:self.top + vis]):
+            _, date, layout, _, checksum, fp = self.rows[name]
+            y = r * self.row_h
+            fg = 'black'
+            if name == selected:
+                c.create_rectangle(0, y, w, y + self.row_h,
+                                   fill=GUI_LIST_SEL_BG, width=0)
+                fg = GUI_LIST_SEL_FG
+            y += self.row_h // 2
+            img = None
+            if self.thumbs is not None and checksum:
+                img = self.thumbs.Image(checksum, fp)
+            if img is not None:
+                c.create_image(4, y, image=img, anchor='w')
+            c.create_text(x_date, y, text=date, anchor='w', fill=fg)
+            c.create_text(x_layout, y, text=layout, anchor='w', fill=fg)
+            c.create_text(x_name, y, text=name, anchor='w', fill=fg)
+
+        n = len(self.shown)
+        if n <= vis:
+            self.scrollbar.set(0, 1)
+        else:
+            self.scrollbar.set(self.top / n, (self.top + vis) / n)
+
+
+# save and apply run on a worker thread, which reports to the Tk thread
+# only through self.events: ('progress', done, total), ('done', result) or
+# ('error', exception)
 class MainWnd:
 
     def __init__(self, root_, icman_):
+        from tkinter import StringVar, N, W, S, E
+        from tkinter import ttk
+
         self.icman = icman_
         self.root = root_
+        self.worker = None
+        self.on_done = None
+        self.closing = False
+        self.cancel = threading.Event()
+        self.events = queue.Queue()
 
         root_.title("Icons manager")
-        root_.geometry('520x300')
+        root_.geometry('640x400')
 
         mainframe = ttk.Frame(root_, padding="3 3 12 12")
         mainframe.grid(column=0, row=0, sticky=(N, W, E, S))
         root_.columnconfigure(0, weight=1)
         root_.rowconfigure(0, weight=1)
 
-        self.config_names_var = StringVar()
-        self._RefreshList()
-
-        self.lbox = Listbox(mainframe, height=18, width=50,
-                            listvariable=self.config_names_var)
-        self.lbox.grid(column=0, row=0, rowspan=GRID_LB_VERT_SIZE,
-                       sticky=(N, S, E, W))
-        self.lbox.bind("<Double-1>", lambda e: self.ApplyConfig())
-
-        scrollbar = Scrollbar(mainframe, orient="vertical")
-        scrollbar.config(command=self.lbox.yview)
-        self.lbox.config(yscrollcommand=scrollbar.set)
-        scrollbar.grid(column=1, row=0, rowspan=GRID_LB_VERT_SIZE, sticky=N+S)
+        mainframe.columnconfigure(0, weight=1)
+        mainframe.rowconfigure(GRID_LB_VERT_SIZE, weight=1)
+
+        self.search_var = StringVar()
+        search = ttk.Entry(mainframe, textvariable=self.search_var)
+        search.grid(column=0, row=0, columnspan=2, sticky=(W, E))
+        search.bind('<Escape>', lambda e: self.search_var.set(''))
+        search.bind('<Down>', lambda e: self.plist.canvas.focus_set())
+        search.bind('<Return>', lambda e: self.ApplyConfig())
+        self.search_var.trace_add(
+            'write', lambda *a: self.plist.Filter(self.search_var.get()))
+
+        self.thumbs = ThumbnailLoader(
+            root_, ThumbnailStore(f'{CONFIG_DIR}/{THUMB_DIR_NAME}'),
+            lambda: self.plist._Draw())
+        self.plist = ProfileList(mainframe, self.ApplyConfig, self.thumbs)
+        self.plist.canvas.grid(column=0, row=1, rowspan=GRID_LB_VERT_SIZE,
+                               sticky=(N, S, E, W))
+        self.plist.scrollbar.grid(column=1, row=1, rowspan=GRID_LB_VERT_SIZE,
+                                  sticky=N+S)
 
         ttk.Button(mainframe, text="Save",
                    command=self.SaveCurrentConfig).grid(
-                       column=3, row=0, sticky=W)
+                       column=3, row=1, sticky=W)
         ttk.Button(mainframe, text="Del",
                    command=self.DeleteCurrentConfig).grid(
-                        column=3, row=1, sticky=W)
+                        column=3, row=2, sticky=W)
         ttk.Button(mainframe, text="Rename",
                    command=self.Rename).grid(
-                       column=3, row=2, sticky=W)
+                       column=3, row=3, sticky=W)
+        self.cancel_btn = ttk.Button(mainframe, text="Cancel",
+                                     command=self.Cancel, state='disabled')
+        self.cancel_btn.grid(column=3, row=4, sticky=W)
+
+        self.progress = ttk.Progressbar(mainframe, mode='determinate')
+        self.progress.grid(column=0, row=GRID_LB_VERT_SIZE + 1, columnspan=2,
+                           sticky=(W, E))
+        self.status_var = StringVar()
+        ttk.Label(mainframe, textvariable=self.status_var).grid(
+            column=0, row=GRID_LB_VERT_SIZE + 2, columnspan=4, sticky=W)
+        search.focus_set()
+
+        root_.protocol("WM_DELETE_WINDOW", self.Close)
         # ttk.Button(mainframe, text="Apply",
         #            command=self.ApplyConfig).grid(
         #                column=3, row=2, sticky=E)
 
+        self._RefreshList()
+        self.watching = False
+        self.watch_pending = False
+        try:
+            self.icman.WatchConfigs()
+            self._WatchConfigs(True)
+        except OSError as e:
+            print(f'Profiles dir is not watched: {e}')
+
     def _RefreshList(self):
-        names_ts = []
-        names = list(self.icman.configs.keys())
-        for n in names:
-            n_ts = MainWnd._GenConfigName(IcMan.GetConfigFullPath(n))
-            names_ts.append(n_ts)
+        self.plist.SetRows(self.icman.configs.values())
+        self.thumbs.Prune(i.checksum for i in self.icman.configs.values())
+
+    def _InsertRow(self, info_):
+        self.plist.Insert(info_)
+
+    def _RemoveRow(self, info_):
+        self.plist.Remove(info_.name)
+
+    # the Tk file handler is dropped while a worker owns icman and events
+    # are picked up once it finishes
+    def _WatchConfigs(self, on_):
+        from tkinter import READABLE
+
+        fd = self.icman.inotify.Fileno()
+        if on_ and not self.watching:
+            self.root.tk.createfilehandler(fd, READABLE, self._OnConfigEvents)
+        elif not on_ and self.watching:
+            self.root.tk.deletefilehandler(fd)
+        self.watching = on_
+
+    def _OnConfigEvents(self, fd_=None, mask_=None):
+        if self.worker is not None:
+            self.watch_pending = True
+            self._WatchConfigs(False)
+            return
+        changes = self.icman.ProcessConfigEvents()
+        if changes is None:
+            self._RefreshList()
+            return
+        for name, old, new in changes:
+            if old is not None:
+                self._RemoveRow(old)
+            if new is not None:
+                self._InsertRow(new)
 
-        self.config_names = names_ts
-        self.config_names.sort(reverse=True)
-        self.config_names_var.set(self.config_names)
+    def _Work(self, job_):
+        try:
+            self.events.put(('done', job_()))
+        except Exception as e:
+            self.events.put(('error', e))
+
+    # total_ False shows a busy bar for jobs which report no progress
+    def _StartWorker(self, status_, job_, on_done_, cancel_=False,
+                     total_=True):
+        if self.worker is not None:
+            return
+        self.cancel.clear()
+        self.on_done = on_done_
+        self.status_var.set(status_)
+        if total_:
+            self.progress.config(mode='determinate', value=0, maximum=1)
+        else:
+            self.progress.config(mode='indeterminate')
+            self.progress.start()
+        if cancel_:
+            self.cancel_btn.state(['!disabled'])
+        self.worker = threading.Thread(target=self._Work, args=(job_,),
+                                       daemon=True)
+        self.worker.start()
+        self.root.after(GUI_POLL_MS, self._Poll)
+
+    # worker thread side of the progress reporting
+    def _Progress(self, done_, total_):
+        self.events.put(('progress', done_, total_))
+
+    def _Poll(self):
+        progress = None
+        result = None
+        while True:
+            try:
+                ev = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if ev[0] == 'progress':
+                progress = ev
+            else:
+                result = ev
+
+        if progress is not None:
+            _, done, total = progress
+            self.progress.config(value=done, maximum=max(total, 1))
+            self.status_var.set(f'{done} / {total} icons')
+
+        if result is None:
+            self.root.after(GUI_POLL_MS, self._Poll)
+            return
+
+        self.worker.join()
+        self.worker = None
+        if self.watch_pending:
+            self.watch_pending = False
+            self._WatchConfigs(True)
+            self._OnConfigEvents()
+        self.progress.stop()
+        self.cancel_btn.state(['disabled'])
+        if result[0] == 'error':
+            self.status_var.set(f'Error: {result[1]}')
+        else:
+            self.on_done(result[1])
+        if self.closing:
+            self.root.destroy()
+
+    def Cancel(self):
+        if self.worker is not None:
+            self.cancel.set()
+            self.status_var.set('Cancelling...')
+
+    # an apply in progress is cancelled and the window closes once the
+    # worker has restarted nemo-desktop
+    def Close(self):
+        if self.worker is None:
+            self.root.destroy()
+            return
+        self.closing = True
+        self.Cancel()
 
     def SaveCurrentConfig(self):
-        self.icman.SaveCurrentConfig()
-        self._RefreshList()
-#        #print("configs: ", self.config_names)
+        self._StartWorker('Saving...', self.icman.SaveCurrentConfig,
+                          self._OnSaved, total_=False)
 
-    def _CurrConfigName(self):
-        idxs = self.lbox.curselection()
-        idx = 0 if len(idxs) <= 0 else int(idxs[0])
-        name = self.lbox.get(idx)
-        return name
+    def _OnSaved(self, name_):
+        if name_ is not None:
+            self._InsertRow(self.icman.configs[name_])
+        self.status_var.set('No icons found, nothing saved' if name_ is None
+                            else f'Saved {name_}')
 
-    def _CurrConfigNameEx(self):
-        return MainWnd._ExtractConfigName(self._CurrConfigName())
+    def _CurrConfigName(self):
+        return self.plist.Selected()
 
     def ApplyConfig(self):
-        name = self._CurrConfigNameEx()
-        self.icman.ApplyConfig(name)
+        name = self._CurrConfigName()
+        if name is None:
+            return
+        self._StartWorker(
+            f'Applying {name}...',
+            lambda: self.icman.ApplyConfig(name, progress_=self._Progress,
+                                           cancel_=self.cancel),
+            lambda diff_: self._OnApplied(name, diff_), cancel_=True)
+
+    def _OnApplied(self, name_, diff_):
+        if diff_ is None:
+            self.status_var.set(f'Invalid config name: {name_}')
+        elif diff_.cancelled:
+            self.status_var.set(f'{name_}: cancelled')
+        elif diff_.Empty():
+            self.status_var.set(f'{name_}: desktop already matches')
+        else:
+            self.status_var.set(f'Applied {name_}: '
+                                f'{len(diff_.gio) + len(diff_.meta)} icons')
 
     def DeleteCurrentConfig(self):
-        name = self._CurrConfigNameEx()
+        if self.worker is not None:
+            return
+        name = self._CurrConfigName()
+        if name is None:
+            return
+        info = self.icman.configs.get(name)
         self.icman.DeleteConfig(name)
-        self._RefreshList()
-        # print("configs: ", self.config_names)
+        if info is not None:
+            self._RemoveRow(info)
 
     def Rename(self):
-        old_name = self._CurrConfigNameEx()
+        if self.worker is not None:
+            return
+        old_name = self._CurrConfigName()
+        if old_name is None:
+            return
+        from tkinter import simpledialog
+
         new_name = simpledialog.askstring("Rename", "Enter new name",
                                           parent=self.root,
                                           initialvalue=old_name)
         if new_name is not None:
+            rows = [self.icman.configs.get(n) for n in (old_name, new_name)]
             self.icman.Rename(new_name, old_name)
-            self._RefreshList()
-
-    def _GenConfigName(fp_):
-        ts = os.path.getmtime(fp_)
-        dt = datetime.datetime.fromtimestamp(ts)
-        tm_str = dt.strftime("%Y-%m-%d %H:%M:%S")
-        nm_str = gfjn(fp_)
-        s = f'{tm_str}    {nm_str}'
-        return s
-
-    def _ExtractConfigName(gen_name_):
-        s = gen_name_.split()[2]
-        return s
+            for info in rows:
+                if info is not None:
+                    self._RemoveRow(info)
+            info = self.icman.configs.get(new_name)
+            if info is not None:
+                self._InsertRow(info)
 
 
 def GuiMain(icman_):
+    from tkinter import Tk
+
     root = Tk()
     MainWnd(root, icman_)
     root.mainloop()
 
 
-def main():
-    if shutil.which('gio') is None:
-        print('gio not found')
+def _CheckTools(need_nemo_=True):
+    if GioLib.Get() is None and shutil.which('gio') is None:
+        print('gio not found', file=os.sys.stderr)
+        return False
+
+    if need_nemo_ and shutil.which(f'{NEMO_DESKTOP_NAME}') is None:
+        print(f'{NEMO_DESKTOP_NAME} not found', file=os.sys.stderr)
+        return False
+    return True
+
+
+def _CmdGui(icman_, args_):
+    GuiMain(icman_)
+    return 0
+
+
+def _CmdDaemon(icman_, args_):
+    return AutoRestoreDaemon(icman_, args_.settle).Run()
+
+
+def _CmdSave(icman_, args_):
+    name = icman_.SaveCurrentConfig()
+    if name is None:
+        print('No icons found, nothing saved')
+        return 1
+    print(name)
+    return 0
+
+
+def _ResolveName(icman_, args_):
+    name = args_.name
+    if name is None:
+        name = icman_.MatchConfig()
+        if name is None:
+            print('No saved profiles')
+    elif name not in icman_.configs:
+        print(f'Invalid config name: {name}')
+        name = None
+    return name
+
+
+def _CmdApply(icman_, args_):
+    name = _ResolveName(icman_, args_)
+    if name is None:
+        return 1
+    icman_.ApplyConfig(name, dry_run_=args_.dry_run, force_=args_.force,
+                       resolve_=args_.resolve or None,
+                       hot_=False if args_.restart else None)
+    return 0
+
+
+def _CmdDiff(icman_, args_):
+    args_.dry_run = True
+    args_.force = False
+    args_.restart = False
+    return _CmdApply(icman_, args_)
+
+
+def _CmdList(icman_, args_):
+    infos = sorted(icman_.configs.values(), key=lambda i: i.mtime,
+                   reverse=True)
+    if args_.json:
+        json.dump([{'name': i.name, 'mtime': i.mtime, 'layout': i.layout,
+                    'count': i.count, 'monitors': i.monitors}
+                   for i in infos], os.sys.stdout, indent=2)
+        print()
+        return 0
+
+    for i in infos:
+        dt = datetime.datetime.fromtimestamp(i.mtime)
+        print(f'{dt.strftime("%Y-%m-%d %H:%M:%S")}  {i.count:6}  '
+              f'{i.layout:24}  {i.name}')
+    return 0
+
+
+def _CmdDelete(icman_, args_):
+    rc = 0
+    for name in args_.names:
+        if name not in icman_.configs:
+            print(f'Invalid config name: {name}')
+            rc = 1
+            continue
+        icman_.DeleteConfig(name)
+    return rc
+
+
+def _CmdRename(icman_, args_):
+    if args_.old_name not in icman_.configs:
+        print(f'Invalid config name: {args_.old_name}')
         return 1
+    icman_.Rename(args_.new_name, args_.old_name)
+    return 0
+
 
-    if shutil.which(f'{NEMO_DESKTOP_NAME}') is None:
-        print(f'{NEMO_DESKTOP_NAME} not found')
+def _CmdConvert(icman_, args_):
+    for name in args_.names:
+        if name not in icman_.configs:
+            print(f'Invalid config name: {name}')
+            return 1
+        IcMan.ConvertConfig(icman_.configs[name].fp, args_.format)
+    icman_._LoadConfigs()
+    return 0
+
+
+def _CmdSnapshot(icman_, args_):
+    store = icman_.snapshots
+    if args_.snap_cmd == 'save':
+        if not _CheckTools(False):
+            return 1
+        r = icman_.SnapshotCurrent(args_.name)
+        if r is None:
+            print('No icons found, nothing saved')
+            return 1
+        name, seq, written = r
+        print(f'{name}@{seq} ({written} new chunks)')
+        return 0
+
+    if args_.snap_cmd == 'restore':
+        if args_.apply and not _CheckTools(True):
+            return 1
+        if args_.version is None and not store.Versions(args_.name):
+            print(f'No snapshots of {args_.name}')
+            return 1
+        try:
+            name = icman_.RestoreSnapshot(args_.name, args_.version)
+        except FileNotFoundError:
+            print(f'No snapshot {args_.name}@{args_.version}')
+            return 1
+        print(name)
+        if args_.apply:
+            icman_.ApplyConfig(name)
+        return 0
+
+    if args_.snap_cmd == 'prune':
+        versions, chunks = store.Prune(args_.keep_last, args_.keep_daily)
+        print(f'{versions} versions and {chunks} chunks removed')
+        return 0
+
+    rows = []
+    for name in [args_.name] if args_.name else store.Names():
+        for seq in store.Versions(name):
+            m = store.Manifest(name, seq)
+            rows.append({'name': name, 'version': seq, 'time': m['time'],
+                         'layout': m['layout'], 'count': m['count']})
+    if args_.json:
+        json.dump(rows, os.sys.stdout, indent=2)
+        print()
+        return 0
+    for r in rows:
+        dt = datetime.datetime.fromtimestamp(r['time'])
+        print(f'{dt.strftime("%Y-%m-%d %H:%M:%S")}  {r["count"]:6}  '
+              f'{r["name"]}@{r["version"]}')
+    return 0
+
+
+def _CmdFleet(icman_, args_):
+    if args_.name not in icman_.configs:
+        print(f'Invalid config name: {args_.name}', file=os.sys.stderr)
+        return 1
+    homes = list(args_.homes)
+    if args_.homes_from:
+        with (os.sys.stdin if args_.homes_from == '-'
+              else open(args_.homes_from, 'rt')) as inf:
+            homes.extend(line.strip() for line in inf if line.strip())
+    if not homes:
+        print('No homes given', file=os.sys.stderr)
+        return 1
+    if not _CheckTools(False):
         return 1
 
-    icman = IcMan()
-    GuiMain(icman)
+    t0 = time.monotonic()
+    results = icman_.FleetApply(args_.name, homes, args_.jobs,
+                                args_.dry_run, args_.restart)
+    if args_.json:
+        json.dump([r.ToDict() for r in results], os.sys.stdout, indent=2)
+        print()
+    else:
+        for r in results:
+            status = 'ok' if r.ok else 'FAILED'
+            print(f'{status:6}  {r.changed:5} icons  {r.seconds:7.3f}s  '
+                  f'{r.home}')
+            if r.error:
+                print(f'        {r.error}')
+            for fp, err in r.failed:
+                print(f'        {fp}: {err}')
+        ok = sum(1 for r in results if r.ok)
+        print(f'{ok}/{len(results)} homes in {time.monotonic() - t0:.3f}s')
+    return 0 if all(r.ok for r in results) else 1
+
+
+def _CmdJournal(icman_, args_):
+    journal = DesktopJournal(f'{CONFIG_DIR}/{JOURNAL_FILE_NAME}')
+    if args_.journal_cmd == 'watch':
+        if not _CheckTools(False):
+            return 1
+        return JournalWatcher(journal, args_.settle).Run()
+
+    if args_.journal_cmd == 'compact':
+        name = journal.Compact(icman_, args_.name)
+        if name is None:
+            print('Journal is empty, nothing saved')
+            return 1
+        print(name)
+        return 0
+
+    icons, monitors, t = journal.Replay()
+    if t is None:
+        print('Journal is empty')
+        return 0
+    dt = datetime.datetime.fromtimestamp(t)
+    print(f'{dt.strftime("%Y-%m-%d %H:%M:%S")}  {len(icons):6}  '
+          f'{LayoutName(monitors)}  {os.path.getsize(journal.fp)} bytes')
     return 0
 
-# SaveIcons()
+
+def _ArgParser():
+    parser = argparse.ArgumentParser(prog=APP_NAME,
+                                     description='Icons saver for NEMO')
+    parser.add_argument('--trace', metavar='FILE', default=TRACE_FILE,
+                        help='write a chrome trace of the save and apply '
+                             'phases')
+    sub = parser.add_subparsers(dest='cmd', metavar='command')
+
+    sub.add_parser('gui', help='open the profiles window (default)')
+
+    p = sub.add_parser('daemon',
+                       help='restore saved profiles on monitor hot-plug')
+    p.add_argument('--settle', type=float, default=DAEMON_SETTLE_TIME,
+                   help='seconds for a new layout to settle')
+
+    sub.add_parser('save', help='save current icons positions')
+
+    for cmd, hlp in (('apply', 'restore a saved profile'),
+                     ('diff', 'show what applying a profile would change')):
+        p = sub.add_parser(cmd, help=hlp)
+        p.add_argument('name', nargs='?',
+                       help='profile name, best match for the current '
+                            'layout by default')
+        p.add_argument('--resolve', action='store_true',
+                       help='snap icons to the grid and move overlapping '
+                            'ones apart')
+        if cmd == 'apply':
+            p.add_argument('--dry-run', action='store_true',
+                           help='only print the changes')
+            p.add_argument('--force', action='store_true',
+                           help='rewrite all icons and restart nemo-desktop')
+            p.add_argument('--restart', action='store_true',
+                           help='restart nemo-desktop even when only gio '
+                                'metadata changes')
+
+    p = sub.add_parser('list', help='list saved profiles')
+    p.add_argument('--json', action='store_true', help='json output')
+
+    p = sub.add_parser('delete', help='delete saved profiles')
+    p.add_argument('names', nargs='+', metavar='name')
+
+    p = sub.add_parser('rename', help='rename a saved profile')
+    p.add_argument('old_name')
+    p.add_argument('new_name')
+
+    p = sub.add_parser('convert', help='convert profiles to another format')
+    p.add_argument('--format', choices=('json', 'bin'), required=True)
+    p.add_argument('names', nargs='+', metavar='name')
+
+    p = sub.add_parser('snapshot', help='deduplicated history of the icons')
+    snap = p.add_subparsers(dest='snap_cmd', metavar='action')
+    snap.required = True
+    p = snap.add_parser('save', help='add the current icons to the history')
+    p.add_argument('--name', help='history name, the layout by default')
+    p = snap.add_parser('list', help='list snapshot versions')
+    p.add_argument('name', nargs='?')
+    p.add_argument('--json', action='store_true', help='json output')
+    p = snap.add_parser('restore',
+                        help='turn a version into a profile name@version')
+    p.add_argument('name')
+    p.add_argument('version', nargs='?', type=int,
+                   help='the latest by default')
+    p.add_argument('--apply', action='store_true',
+                   help='apply the restored profile')
+    p = snap.add_parser('prune', help='drop old versions and unused chunks')
+    p.add_argument('--keep-last', type=int, default=SNAPSHOT_KEEP_LAST)
+    p.add_argument('--keep-daily', type=int, default=SNAPSHOT_KEEP_DAILY)
+
+    p = sub.add_parser('fleet', help='apply a profile to many user homes')
+    p.add_argument('name', help='profile name')
+    p.add_argument('homes', nargs='*', metavar='home')
+    p.add_argument('--homes-from', metavar='FILE',
+                   help='file with one home per line, - for stdin')
+    p.add_argument('--jobs', type=int, default=FLEET_JOBS,
+                   help='homes handled at once, one per core by default')
+    p.add_argument('--dry-run', action='store_true',
+                   help='only count the changes')
+    p.add_argument('--restart', action='store_true',
+                   help="restart the users' running nemo-desktop, "
+                        "which is needed for desktop keyfile changes")
+    p.add_argument('--json', action='store_true', help='json output')
+
+    p = sub.add_parser('journal', help='continuous journal of icon moves')
+    journal = p.add_subparsers(dest='journal_cmd', metavar='action')
+    journal.required = True
+    p = journal.add_parser('watch', help='record icon moves as they happen')
+    p.add_argument('--settle', type=float, default=JOURNAL_SETTLE_TIME,
+                   help='seconds without changes before a record')
+    p = journal.add_parser('compact',
+                           help='save the journal as a profile and shorten '
+                                'it')
+    p.add_argument('--name', help='profile name, layout_journal by default')
+    journal.add_parser('status', help='show the last record')
+    return parser
+
+
+# command: (handler, needs gio, needs nemo-desktop)
+COMMANDS = {
+    'gui': (_CmdGui, True, True),
+    'daemon': (_CmdDaemon, True, True),
+    'save': (_CmdSave, True, False),
+    'apply': (_CmdApply, True, True),
+    'diff': (_CmdDiff, True, False),
+    'list': (_CmdList, False, False),
+    'delete': (_CmdDelete, False, False),
+    'rename': (_CmdRename, False, False),
+    'convert': (_CmdConvert, False, False),
+    'snapshot': (_CmdSnapshot, False, False),
+    'journal': (_CmdJournal, False, False),
+    'fleet': (_CmdFleet, False, False),
+}
+
+
+def main(argv_=None):
+    args = _ArgParser().parse_args(argv_)
+    cmd = args.cmd or 'gui'
+    handler, need_gio, need_nemo = COMMANDS[cmd]
+
+    if need_gio and not _CheckTools(need_nemo):
+        return 1
+
+    if args.trace:
+        TRACE.Enable(args.trace)
+    try:
+        icman = IcMan()
+        return handler(icman, args)
+    finally:
+        TRACE.Save()
 
 
 if __name__ == "__main__":
-    main()
+    os.sys.exit(main())
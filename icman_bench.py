@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Benchmark for icman: builds a synthetic home (Desktop files, gio metadata,
+# desktop-metadata keyfile), puts stub gio, pgrep, killall and nemo-desktop
+# executables on PATH, fakes the XRandR layout and measures every save,
+# load and apply phase. Results are written as json, so runs of different
+# revisions can be compared with --compare.
+#
+#   ./icman_bench.py --sizes 10,100,1000 --output new.json
+#   ./icman_bench.py --compare old.json --output new.json
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import datetime
+import importlib
+import subprocess
+import statistics
+import tracemalloc
+import urllib.parse
+
+#######################################################
+
+BENCH_SIZES = '10,100,1000,10000'
+BENCH_REPEAT = 3
+BENCH_MONITORS = 'DP-1:1920x1080+0+0,HDMI-1:2560x1440+1920+0'
+# share of icons which differ from the profile in the apply phase
+BENCH_APPLY_CHANGED = 0.1
+# profiles in the config dir for the catalog phases: icons count / 10
+BENCH_PROFILES_DIV = 10
+
+# name of the fake nemo-desktop, so a real one is never touched
+BENCH_NEMO_NAME = 'nemo-bench'
+
+STUB_TOOLS = ('gio', 'pgrep', 'killall', BENCH_NEMO_NAME)
+
+POS_ATTR = 'metadata::nemo-icon-position'
+MON_ATTR = 'metadata::monitor'
+
+GIO_STUB = '''#!/bin/sh
+echo gio >> "$ICMAN_BENCH_SPAWNS"
+if [ "$1" = set ]; then
+    printf '%s\\t%s\\t%s\\n' "$2" "$3" "$4" >> "$ICMAN_BENCH_STORE"
+    exit 0
+fi
+exec "$ICMAN_BENCH_PYTHON" "$ICMAN_BENCH_SCRIPT" stub-gio "$@"
+'''
+
+TOOL_STUB = '''#!/bin/sh
+echo {name} >> "$ICMAN_BENCH_SPAWNS"
+exit 1
+'''
+
+NEMO_STUB = '''#!/bin/sh
+echo {name} >> "$ICMAN_BENCH_SPAWNS"
+while :; do sleep 0.2; done
+'''
+
+#######################################################
+
+
+# 'gio info --attributes=metadata:: FILE...' over the bench metadata store
+def StubGioInfo(args_):
+    files = [a for a in args_[1:] if not a.startswith('-')]
+    store = {}
+    with open(os.environ['ICMAN_BENCH_STORE'], 'rt') as inf:
+        for line in inf:
+            fp, attr, value = line.rstrip('\n').split('\t')
+            store.setdefault(fp, {})[attr] = value
+
+    out = []
+    for fp in files:
+        out.append(f'uri: file://{urllib.parse.quote(fp)}\n')
+        out.append(f'local path: {fp}\n')
+        out.append('attributes:\n')
+        for attr, value in sorted(store.get(fp, {}).items()):
+            out.append(f'  {attr}: {value}\n')
+    sys.stdout.write(''.join(out))
+    return 0
+
+
+class BenchHome:
+
+    def __init__(self, root_):
+        self.root = root_
+        self.home = f'{root_}/home'
+        self.desktop = f'{self.home}/Desktop'
+        self.config = f'{self.home}/.config'
+        self.bin = f'{root_}/bin'
+        self.store = f'{root_}/gio-metadata.tsv'
+        self.spawns = f'{root_}/spawns.log'
+
+    def Setup(self):
+        for d in (self.desktop, self.config, self.bin):
+            os.makedirs(d, exist_ok=True)
+
+        stubs = {'gio': GIO_STUB,
+                 'pgrep': TOOL_STUB.format(name='pgrep'),
+                 'killall': TOOL_STUB.format(name='killall'),
+                 BENCH_NEMO_NAME: NEMO_STUB.format(name=BENCH_NEMO_NAME)}
+        for name, text in stubs.items():
+            fp = f'{self.bin}/{name}'
+            with open(fp, 'wt') as outf:
+                outf.write(text)
+            os.chmod(fp, 0o755)
+        open(self.spawns, 'w').close()
+
+        os.environ.update({
+            'HOME': self.home,
+            'XDG_CONFIG_HOME': self.config,
+            'PATH': f'{self.bin}:{os.environ.get("PATH", "")}',
+            'ICMAN_MONITORS': BENCH_MONITORS,
+            'ICMAN_NEMO_DESKTOP': BENCH_NEMO_NAME,
+            'ICMAN_NEMO_STOP_TIMEOUT': '2',
+            'ICMAN_BENCH_STORE': self.store,
+            'ICMAN_BENCH_SPAWNS': self.spawns,
+            'ICMAN_BENCH_PYTHON': sys.executable,
+            'ICMAN_BENCH_SCRIPT': os.path.abspath(__file__),
+        })
+
+    def Spawns(self):
+        counts = dict.fromkeys(STUB_TOOLS, 0)
+        with open(self.spawns, 'rt') as inf:
+            for line in inf:
+                counts[line.strip()] = counts.get(line.strip(), 0) + 1
+        return counts
+
+    # n desktop files with gio metadata plus n desktop-metadata sections
+    def Populate(self, icman_, n_):
+        shutil.rmtree(self.desktop)
+        os.makedirs(self.desktop)
+        with open(self.store, 'wt') as outf:
+            for i in range(n_):
+                fp = f'{self.desktop}/app{i:05}.desktop'
+                open(fp, 'w').close()
+                outf.write(f'{fp}\t{POS_ATTR}\t{(i % 19) * 100},'
+                           f'{(i // 19 % 10) * 100}\n')
+                outf.write(f'{fp}\t{MON_ATTR}\t{i % 2}\n')
+
+        os.makedirs(os.path.dirname(icman_.NEMO_META_PATH), exist_ok=True)
+        with open(icman_.NEMO_META_PATH, 'wt') as outf:
+            outf.writelines(MetaLines(n_))
+
+    def ClearProfiles(self, icman_):
+        shutil.rmtree(icman_.CONFIG_DIR, ignore_errors=True)
+        os.makedirs(icman_.CONFIG_DIR)
+
+
+def GioInfoLines(desktop_, n_):
+    for i in range(n_):
+        fp = f'{desktop_}/app{i:05}.desktop'
+        yield f'uri: file://{urllib.parse.quote(fp)}\n'
+        yield f'local path: {fp}\n'
+        yield 'attributes:\n'
+        yield f'  {MON_ATTR}: {i % 2}\n'
+        yield f'  {POS_ATTR}: {i * 3},{i * 7}\n'
+
+
+def MetaLines(n_):
+    yield '[desktop-monitor-0]\n'
+    yield 'nemo-icon-position=0,0\n'
+    for i in range(n_):
+        yield '\n'
+        yield f'[item{i:05}]\n'
+        yield f'nemo-icon-position={i * 3},{i * 7}\n'
+        yield f'monitor={i % 2}\n'
+        yield 'nemo-icon-position-timestamp=1700000000\n'
+
+
+#######################################################
+
+
+# phase: name -> (setup(ctx) -> arg, run(ctx, arg), icons count)
+class Phases:
+
+    def __init__(self, icman_, home_, n_):
+        self.m = icman_
+        self.home = home_
+        self.n = n_
+        self.gio_lines = list(GioInfoLines(home_.desktop, n_))
+        self.meta_lines = list(MetaLines(n_))
+
+    def Populated(self):
+        self.home.Populate(self.m, self.n)
+
+    def Profile(self, fmt_):
+        self.home.Populate(self.m, self.n)
+        self.home.ClearProfiles(self.m)
+        self.m.PROFILE_FORMAT = fmt_
+        name = self.m.IcMan().SaveCurrentConfig()
+        return self.m.IcMan.GetConfigFullPath(name)
+
+    def Catalog(self, cold_):
+        self.home.ClearProfiles(self.m)
+        icons = self.m.IconSet()
+        for i in range(10):
+            icons.Append(f'{self.home.desktop}/app{i:05}.desktop', '', i, i,
+                         0)
+        for i in range(max(1, self.n // BENCH_PROFILES_DIV)):
+            self.m.IcMan._SaveIconConf(
+                self.m.IcMan.GetConfigFullPath(f'profile{i:05}'), icons,
+                'json')
+        if not cold_:
+            self.m.IcMan()
+
+    def Applied(self, changed_):
+        self.home.Populate(self.m, self.n)
+        self.home.ClearProfiles(self.m)
+        self.m.PROFILE_FORMAT = 'json'
+        im = self.m.IcMan()
+        name = im.SaveCurrentConfig()
+        icons = im._GetIcons(name)
+        step = max(1, int(1 / changed_)) if changed_ > 0 else 0
+        for i in range(0, len(icons), step) if step else ():
+            icons.SetPos(i, icons.xs[i] + 1, icons.ys[i], icons.ms[i])
+        self.m.IcMan._SaveIconConf(im.configs[name].fp, icons)
+        return name
+
+    def All(self):
+        m = self.m
+        return {
+            'parse_gio_info': (
+                lambda: None,
+                lambda _: sum(1 for _ in
+                              m.IcMan._ProcessLines_LoadCurrentIcons(
+                                  self.gio_lines))),
+            'parse_meta': (
+                lambda: None,
+                lambda _: m.IcMan._ProcessLines_LoadNemoMetaIcons(
+                    self.meta_lines)),
+            'load_desktop': (
+                self.Populated,
+                lambda _: m.IcMan._LoadCurentIcons()),
+            'rewrite_meta': (
+                lambda: (self.home.Populate(m, self.n), m.IconSet.FromRecords(
+                    m.IcMan._LoadNemoMetaIcons(m.NEMO_META_PATH)))[1],
+                lambda icons: m.IcMan._ApplyNemoMetaDesktop(
+                    m.NEMO_META_PATH, icons, 2)),
+            'save_json': (
+                lambda: (self.Populated(), self.home.ClearProfiles(m),
+                         setattr(m, 'PROFILE_FORMAT', 'json')),
+                lambda _: m.IcMan().SaveCurrentConfig()),
+            'save_bin': (
+                lambda: (self.Populated(), self.home.ClearProfiles(m),
+                         setattr(m, 'PROFILE_FORMAT', 'bin')),
+                lambda _: m.IcMan().SaveCurrentConfig()),
+            'load_json': (
+                lambda: self.Profile('json'),
+                lambda fp: m.IcMan._LoadIconConf(fp)),
+            'load_bin': (
+                lambda: self.Profile('bin'),
+                lambda fp: m.IcMan._LoadIconConf(fp)),
+            'catalog_cold': (
+                lambda: self.Catalog(True),
+                lambda _: m.IcMan()),
+            'catalog_warm': (
+                lambda: self.Catalog(False),
+                lambda _: m.IcMan()),
+            'apply_changed': (
+                lambda: self.Applied(BENCH_APPLY_CHANGED),
+                lambda name: m.IcMan().ApplyConfig(name)),
+            'apply_noop': (
+                lambda: self.Applied(0),
+                lambda name: m.IcMan().ApplyConfig(name)),
+        }
+
+
+def RunPhase(home_, setup_, run_, repeat_, memory_):
+    times = []
+    spawns = None
+    for _ in range(repeat_):
+        arg = setup_()
+        before = home_.Spawns()
+        t0 = time.perf_counter()
+        run_(arg)
+        times.append(time.perf_counter() - t0)
+        after = home_.Spawns()
+        spawns = {k: after[k] - before.get(k, 0) for k in after}
+
+    peak = None
+    if memory_:
+        arg = setup_()
+        tracemalloc.start()
+        try:
+            run_(arg)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {'seconds_min': min(times),
+            'seconds_median': statistics.median(times),
+            'peak_bytes': peak,
+            'spawns': {k: v for k, v in spawns.items() if v}}
+
+
+def GitRevision():
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def Compare(base_, results_):
+    base = {(r['phase'], r['icons']): r for r in base_['results']}
+    print(f'{"phase":16} {"icons":>6} {"base s":>10} {"new s":>10} '
+          f'{"ratio":>7}', file=sys.stderr)
+    for r in results_:
+        b = base.get((r['phase'], r['icons']))
+        if b is None:
+            continue
+        ratio = r['seconds_min'] / b['seconds_min'] if b['seconds_min'] \
+            else float('inf')
+        print(f'{r["phase"]:16} {r["icons"]:6} {b["seconds_min"]:10.4f} '
+              f'{r["seconds_min"]:10.4f} {ratio:7.2f}', file=sys.stderr)
+
+
+def Bench(args_):
+    root = tempfile.mkdtemp(prefix='icman-bench-')
+    home = BenchHome(root)
+    home.Setup()
+    os.environ['ICMAN_GIO_BACKEND'] = args_.gio_backend
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    icman = importlib.import_module('icman')
+
+    sizes = [int(v) for v in args_.sizes.split(',')]
+    results = []
+    try:
+        for n in sizes:
+            phases = Phases(icman, home, n).All()
+            for name, (setup, run) in phases.items():
+                if args_.phases and name not in args_.phases:
+                    continue
+                r = RunPhase(home, setup, run, args_.repeat, args_.memory)
+                r.update(phase=name, icons=n,
+                         icons_per_s=n / r['seconds_min']
+                         if r['seconds_min'] else None)
+                results.append(r)
+                peak = r['peak_bytes']
+                print(f'{name:16} {n:6} {r["seconds_min"]:10.4f}s '
+                      f'{r["icons_per_s"] or 0:12.0f}/s '
+                      f'{(peak or 0) / 1024:10.0f}KiB {r["spawns"]}',
+                      file=sys.stderr)
+    finally:
+        try:
+            icman.NemoSupervisor().Stop()
+        finally:
+            if not args_.keep:
+                shutil.rmtree(root, ignore_errors=True)
+
+    data = {'meta': {'revision': GitRevision(),
+                     'date': datetime.datetime.now().isoformat(),
+                     'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'gio_backend': args_.gio_backend,
+                     'repeat': args_.repeat,
+                     'monitors': BENCH_MONITORS},
+            'results': results}
+
+    if args_.compare:
+        with open(args_.compare, 'rt') as inf:
+            Compare(json.load(inf), results)
+
+    if args_.output:
+        with open(args_.output, 'wt') as outf:
+            json.dump(data, outf, indent=2)
+    else:
+        json.dump(data, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'stub-gio':
+        return StubGioInfo(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(description='icman benchmark')
+    parser.add_argument('--sizes', default=BENCH_SIZES,
+                        help='comma separated icons counts')
+    parser.add_argument('--repeat', type=int, default=BENCH_REPEAT)
+    parser.add_argument('--phases', nargs='*', help='run only these phases')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip the tracemalloc peak memory pass')
+    parser.add_argument('--gio-backend', default='cli',
+                        choices=('cli', 'lib', 'auto'))
+    parser.add_argument('--output', help='json results file (stdout)')
+    parser.add_argument('--compare', help='json results of a base run')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the synthetic home directory')
+    return Bench(parser.parse_args())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,405 @@
+import os
+import random
+
+import pytest
+
+import icman
+
+
+def _Icons():
+    icons = icman.IconSet()
+    icons.monitors = [icman.Monitor(x=0, y=0, w=1920, h=1080, name='m')]
+    icons.Append('/home/u/Desktop/a', 'a', 10, 20, 0)
+    return icons
+
+
+@pytest.mark.parametrize('cut', [1, 3, 10])
+def test_truncated_bin_profile(tmp_path, cut):
+    fp = tmp_path / 'p'
+    fp.write_bytes(icman.PackBinProfile(_Icons())[:-cut])
+    with pytest.raises(RuntimeError, match='truncated'):
+        icman.BinProfileView(str(fp))
+
+
+def _Layouts(rnd_, count_):
+    sizes = [(1920, 1080), (2560, 1440), (1280, 1024), (1920, 1082)]
+    configs = {}
+    for i in range(count_):
+        x = 0
+        mons = []
+        for j in range(rnd_.choice([1, 2, 2, 3, 4])):
+            w, h = rnd_.choice(sizes)
+            mons.append({'name': rnd_.choice(['DP-', 'HDMI-', '']) + str(j),
+                         'x': x + rnd_.choice([0, 5, 5000]),
+                         'y': rnd_.choice([0, 120]), 'w': w, 'h': h})
+            x += w
+        configs[f'p{i}'] = icman.ProfileInfo(
+            name=f'p{i}', mtime=rnd_.randint(0, 50), monitors=mons)
+    return configs
+
+
+def test_best_prefers_nearest_geometry():
+    configs = {
+        'far': icman.ProfileInfo(name='far', mtime=1, monitors=[
+            {'name': 'Y', 'x': 5000, 'y': 0, 'w': 1920, 'h': 1080}]),
+        'near': icman.ProfileInfo(name='near', mtime=0, monitors=[
+            {'name': 'Z', 'x': 0, 'y': 0, 'w': 1920, 'h': 1082}])}
+    idx = icman.LayoutIndex.Build(configs)
+    mons = [icman.Monitor(name='X', x=0, y=0, w=1920, h=1080)]
+    assert idx.Best(mons) == idx.Match(mons)[0][2] == 'near'
+
+
+def test_best_agrees_with_match():
+    rnd = random.Random(7)
+    configs = _Layouts(rnd, 600)
+    idx = icman.LayoutIndex.Build(configs)
+    probes = _Layouts(rnd, 200)
+    for i, info in enumerate(probes.values()):
+        if i == 100:
+            for name in list(configs)[:300]:
+                idx.Remove(name)
+        mons = [icman.Monitor(m) for m in info.monitors]
+        assert idx.Best(mons) == idx.Match(mons, 1)[0][2]
+
+
+def test_resolve_overlaps_uses_grid_cell():
+    icons = icman.IconSet()
+    icons.Append('/d/a', 'a', 10, 10, 0)
+    icons.Append('/d/b', 'b', 20, 15, 0)
+    mons = [icman.Monitor(x=0, y=0, w=800, h=600, name='m')]
+    assert icman.ResolveOverlaps(icons, mons, cell_=(80, 120)) == 2
+    assert sorted(zip(icons.xs, icons.ys)) == [(0, 0), (0, 120)]
+
+
+def test_grid_cell_override(monkeypatch):
+    monkeypatch.setattr(icman, 'ICON_CELL_ENV', '90x110')
+    assert icman._ReadGridCell() == (90, 110)
+    monkeypatch.setattr(icman, 'ICON_CELL_ENV', '90')
+    with pytest.raises(RuntimeError):
+        icman._ReadGridCell()
+
+
+def test_journal_append_after_torn_line(tmp_path):
+    journal = icman.DesktopJournal(str(tmp_path / 'journal'))
+    icons = icman.IconSet()
+    icons.Append('/d/a', 'a', 1, 0, 0)
+    journal.Append(icons)
+    with open(journal.fp, 'ab') as outf:
+        outf.write(b'{"t":1,"icons":[{"fp":"/d/a","x":5')
+
+    icons.SetPos(0, 99, 0, 0)
+    journal.Append(icons)
+    replayed = journal.Replay()[0]
+    assert list(replayed.xs) == [99]
+
+
+def test_nudge_rename_keeps_existing_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(icman, 'HOT_NUDGE', 'rename')
+    monkeypatch.setattr(icman, 'HOT_NUDGE_DELAY', 0)
+    (tmp_path / 'a').write_text('a')
+    (tmp_path / (icman.HOT_NUDGE_PREFIX + 'a')).write_text('other')
+    (tmp_path / 'b').write_text('b')
+    icman.IcMan._NudgeIcons([str(tmp_path / 'a'), str(tmp_path / 'b')])
+    assert (tmp_path / 'a').read_text() == 'a'
+    assert (tmp_path / (icman.HOT_NUDGE_PREFIX + 'a')).read_text() == 'other'
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        icman.HOT_NUDGE_PREFIX + 'a', 'a', 'b']
+
+
+def test_restore_nudged(tmp_path, capsys):
+    (tmp_path / (icman.HOT_NUDGE_PREFIX + 'a')).write_text('a')
+    (tmp_path / (icman.HOT_NUDGE_PREFIX + 'b')).write_text('old b')
+    (tmp_path / 'b').write_text('b')
+    icman.IcMan._RestoreNudged(str(tmp_path))
+    assert (tmp_path / 'a').read_text() == 'a'
+    assert (tmp_path / 'b').read_text() == 'b'
+    out = capsys.readouterr()
+    assert out.out == ''
+    assert 'Restored' in out.err and 'Failed to move back' in out.err
+
+
+def _RewriteMeta(text_, icons_, mon_cnt_=2):
+    meta = icman.IconSet()
+    for name, x, y, m in icons_:
+        meta.Append(icman.META_PATH_HOLDER, name, x, y, m)
+    lines = text_.splitlines(keepends=True)
+    return ''.join(icman.IcMan._ProcessLines_ApplyNemoMetaDesktop(
+        lines, meta, 'desktop-metadata', mon_cnt_))
+
+
+def test_meta_rewrite_updates_existing_keys():
+    text = ('[computer]\nnemo-icon-position=1,2\nmonitor=0\n'
+            'nemo-icon-position-timestamp=17\n')
+    assert _RewriteMeta(text, [('computer', 30, 40, 1)]) == (
+        '[computer]\nnemo-icon-position=30,40\nmonitor=1\n'
+        'nemo-icon-position-timestamp=17\n')
+
+
+def test_meta_rewrite_adds_missing_key():
+    text = '[home]\nnemo-icon-position=1,2\n\n[trash]\nmonitor=0\n'
+    assert _RewriteMeta(text, [('home', 5, 6, 1)]) == (
+        '[home]\nnemo-icon-position=5,6\nmonitor=1\n\n'
+        '[trash]\nmonitor=0\n')
+
+
+def test_meta_rewrite_appends_new_section():
+    text = '[home]\nmonitor=0\n'
+    assert _RewriteMeta(text, [('trash', 7, 8, 0)]) == (
+        '[home]\nmonitor=0\n\n[trash]\nnemo-icon-position=7,8\nmonitor=0\n')
+    assert _RewriteMeta('', [('trash', 7, 8, 5)]) == (
+        '[trash]\nnemo-icon-position=7,8\nmonitor=0\n')
+
+
+def test_meta_rewrite_without_trailing_newline():
+    text = '[home]\nmonitor=0'
+    assert _RewriteMeta(text, [('trash', 7, 8, 0)]) == (
+        '[home]\nmonitor=0\n\n[trash]\nnemo-icon-position=7,8\nmonitor=0\n')
+    assert _RewriteMeta(text, [('home', 3, 4, 1)]) == (
+        '[home]\nmonitor=1\nnemo-icon-position=3,4\n')
+    assert _RewriteMeta('[home]', [('home', 3, 4, 1)]) == (
+        '[home]\nnemo-icon-position=3,4\nmonitor=1\n')
+
+
+def test_meta_rewrite_keeps_other_lines():
+    other = ('# written by nemo\n'
+             '[desktop-monitor-0]\nnemo-icon-position=0,0  \n\n'
+             '[trash]\n  monitor=1\n# user comment\nfoo = bar \n\n')
+    text = other + '[home]\nnemo-icon-position=1,2\nmonitor=0\n'
+    out = _RewriteMeta(text, [('home', 9, 9, 0)])
+    assert out == other + '[home]\nnemo-icon-position=9,9\nmonitor=0\n'
+    assert _RewriteMeta(other, []) == other
+    assert [(o.name, o.x, o.y, o.m) for o in
+            icman.IcMan._ProcessLines_LoadNemoMetaIcons(
+                out.splitlines(keepends=True))] == [('home', 9, 9, 0)]
+
+
+# 'gio info -a metadata::*' output, which prints newlines of the local
+# path as ' ? '
+def _GioInfo(path_, quoted_, attrs_):
+    lines = [f'uri: file://{quoted_}\n',
+             f'local path: {path_.replace(chr(10), " ? ")}\n',
+             'unix mount: /dev/vda / ext4 rw\n', 'attributes:\n']
+    lines += [f'  metadata::{k}: {v}\n' for k, v in attrs_]
+    return lines
+
+
+def _LoadCurrent(lines_):
+    return [(o.fp, o.x, o.y, o.m) for o in
+            icman.IcMan._ProcessLines_LoadCurrentIcons(lines_)]
+
+
+def test_current_icons_percent_encoded_names():
+    lines = _GioInfo('/d/a b%.desktop', '/d/a%20b%25.desktop',
+                     [('monitor', 1), ('nemo-icon-position', '10,20')])
+    lines += _GioInfo('/d/é', '/d/%C3%A9',
+                      [('nemo-icon-position', '1,2'), ('monitor', 0)])
+    assert _LoadCurrent(lines) == [('/d/a b%.desktop', 10, 20, 1),
+                                   ('/d/é', 1, 2, 0)]
+
+
+def test_current_icons_names_with_newlines():
+    lines = _GioInfo('/d/a\nb', '/d/a%0Ab',
+                     [('nemo-icon-position', '5,6'), ('monitor', 0)])
+    lines += _GioInfo('/d/ c ', '/d/%20c%20',
+                      [('nemo-icon-position', '7,8'), ('monitor', 1)])
+    assert _LoadCurrent(lines) == [('/d/a\nb', 5, 6, 0),
+                                   ('/d/ c ', 7, 8, 1)]
+
+
+def test_current_icons_without_monitor_are_skipped():
+    lines = _GioInfo('/d/a', '/d/a', [('nemo-icon-position', '5,6')])
+    lines += _GioInfo('/d/b', '/d/b', [])
+    lines += _GioInfo('/d/c', '/d/c',
+                      [('nemo-icon-position', '7,8'), ('monitor', 1)])
+    assert _LoadCurrent(lines) == [('/d/c', 7, 8, 1)]
+
+
+def _DiffIcons(tmp_path_, rows_):
+    icons = icman.IconSet()
+    for name, x, y, m in rows_:
+        if name.startswith('['):
+            icons.Append(icman.META_PATH_HOLDER, name.strip('[]'), x, y, m)
+        else:
+            fp = tmp_path_ / name
+            fp.touch()
+            icons.Append(str(fp), '', x, y, m)
+    return icons
+
+
+def test_diff_of_unchanged_profile_is_empty(tmp_path):
+    rows = [('a', 1, 2, 0), ('b', 3, 4, 1), ('[home]', 5, 6, 0)]
+    diff = icman.ConfigDiff.Build(_DiffIcons(tmp_path, rows),
+                                  _DiffIcons(tmp_path, rows), 2)
+    assert diff.Empty()
+    assert list(diff.Lines()) == []
+
+
+def test_diff_has_only_moved_icons(tmp_path):
+    current = _DiffIcons(tmp_path, [('a', 1, 2, 0), ('b', 3, 4, 1),
+                                    ('[home]', 5, 6, 0), ('[trash]', 0, 0, 0)])
+    profile = _DiffIcons(tmp_path, [('a', 1, 2, 0), ('b', 3, 9, 1),
+                                    ('[home]', 5, 6, 0), ('[trash]', 0, 0, 1),
+                                    ('c', 7, 7, 0)])
+    profile.Append(str(tmp_path / 'gone'), '', 1, 1, 0)
+    diff = icman.ConfigDiff.Build(profile, current, 2)
+    assert [r[0] for r in diff.gio.Rows()] == [str(tmp_path / 'b'),
+                                               str(tmp_path / 'c')]
+    assert [r[1:] for r in diff.meta.Rows()] == [('trash', 0, 0, 1)]
+    assert diff.gone == [str(tmp_path / 'gone')]
+    assert diff.prev[str(tmp_path / 'b')] == (3, 4, 1)
+    assert diff.prev[str(tmp_path / 'c')] is None
+
+
+def test_forced_diff_has_every_icon(tmp_path, monkeypatch):
+    rows = [('a', 1, 2, 0), ('b', 3, 4, 1), ('[home]', 5, 6, 0)]
+    im = icman.IcMan.__new__(icman.IcMan)
+    monkeypatch.setattr(im, '_GetRemappedIcons',
+                        lambda name_, monitors_: _DiffIcons(tmp_path, rows))
+    monkeypatch.setattr(icman.IcMan, '_LoadCurrentState',
+                        lambda: _DiffIcons(tmp_path, rows))
+    mons = [icman.Monitor(x=0, y=0, w=800, h=600, name='m')] * 2
+    assert im.DiffConfig('p', mons, resolve_=False).Empty()
+    diff = im.DiffConfig('p', mons, force_=True, resolve_=False)
+    assert len(diff.gio) == 2 and len(diff.meta) == 1
+
+
+def test_remap_scales_into_target_monitor():
+    saved = [icman.Monitor(name='HDMI-1', x=0, y=0, w=1920, h=1080)]
+    current = [icman.Monitor(name='DP-1', x=0, y=0, w=1280, h=720),
+               icman.Monitor(name='HDMI-1', x=1280, y=0, w=2560, h=1440)]
+    icons = icman.IconSet()
+    icons.Append('/d/a', '', 960, 540, 0)
+    icons.Append('/d/b', '', 1900, 1070, 0)
+    assert icman.RemapIcons(icons, saved, current) == 2
+    # positions are relative to the monitor, clamped a cell off its edges
+    assert list(zip(icons.xs, icons.ys, icons.ms)) == [
+        (1280, 720, 1), (2560 - icman.ICON_CELL_W, 1440 - icman.ICON_CELL_H,
+                         1)]
+
+
+def test_remap_removed_monitor_falls_back_to_primary():
+    saved = [icman.Monitor(name='DP-1', x=0, y=0, w=3840, h=2160),
+             icman.Monitor(name='HDMI-1', x=3840, y=0, w=1920, h=1080)]
+    current = [icman.Monitor(name='HDMI-1', x=0, y=0, w=1920, h=1080)]
+    icons = icman.IconSet()
+    icons.Append('/d/a', '', 1920, 1080, 0)
+    icons.Append('/d/b', '', 100, 200, 1)
+    icons.Append('/d/c', '', 300, 400, 5)
+    icman.RemapIcons(icons, saved, current)
+    assert list(zip(icons.xs, icons.ys, icons.ms)) == [
+        (960, 540, 0), (100, 200, 0), (300, 400, 0)]
+
+
+def test_remap_same_layout_keeps_icons():
+    mons = [icman.Monitor(name='DP-1', x=0, y=0, w=1920, h=1080)]
+    icons = _Icons()
+    assert icman.RemapIcons(icons, mons, list(mons)) == 0
+    assert list(icons.xs) == [10]
+
+
+def _SnapIcons(n_, moved_=()):
+    icons = icman.IconSet()
+    icons.monitors = [icman.Monitor(x=0, y=0, w=1920, h=1080, name='DP-1')]
+    for i in range(n_):
+        x = i + 1000 if i in moved_ else i
+        icons.Append(f'/home/u/Desktop/f{i:04}', '', x, i * 2, i % 2)
+    icons.Append(icman.META_PATH_HOLDER, 'trash', 5, 6, 0)
+    return icons
+
+
+def _ObjectKeys(store_):
+    return {sub + f for sub in os.listdir(store_.objects)
+            for f in os.listdir(f'{store_.objects}/{sub}')}
+
+
+def test_snapshot_round_trip(tmp_path):
+    store = icman.SnapshotStore(str(tmp_path))
+    icons = _SnapIcons(300)
+    assert store.Save('work', icons, 'DP-1') == (1, len(_ObjectKeys(store)))
+    loaded = store.Load('work')
+    assert sorted(loaded.Rows()) == sorted(icons.Rows())
+    assert [m.Key() for m in loaded.monitors] == [
+        m.Key() for m in icons.monitors]
+    assert store.Manifest('work', 1)['layout'] == 'DP-1'
+
+
+def test_snapshot_unchanged_stores_nothing(tmp_path):
+    store = icman.SnapshotStore(str(tmp_path))
+    store.Save('work', _SnapIcons(300))
+    objects = _ObjectKeys(store)
+    assert store.Save('work', _SnapIcons(300)) == (1, 0)
+    assert _ObjectKeys(store) == objects
+    assert store.Versions('work') == [1]
+
+    seq, written = store.Save('work', _SnapIcons(300, moved_={7}))
+    assert seq == 2 and written == 1
+    assert len(_ObjectKeys(store)) == len(objects) + 1
+
+
+def test_snapshot_prune_keeps_referenced_chunks(tmp_path):
+    store = icman.SnapshotStore(str(tmp_path))
+    for v in range(3):
+        store.Save('work', _SnapIcons(300, moved_=range(v * 100)))
+    store.Save('home', _SnapIcons(50))
+    used = (set(store.Manifest('work', 3)['chunks'])
+            | set(store.Manifest('home', 1)['chunks']))
+    stale = _ObjectKeys(store) - used
+    assert stale
+    assert store.Prune(keep_last_=1, keep_daily_=0) == (2, len(stale))
+    assert store.Versions('work') == [3]
+    assert _ObjectKeys(store) == used
+    assert sorted(store.Load('work').Rows()) == sorted(
+        _SnapIcons(300, moved_=range(200)).Rows())
+
+
+def _WriteProfile(dir_, name_, count_):
+    icons = icman.IconSet()
+    icons.monitors = [icman.Monitor(x=0, y=0, w=1920, h=1080, name='DP-1')]
+    for i in range(count_):
+        icons.Append(f'/d/f{i}', '', i, i, 0)
+    fp = dir_ / f'{name_}.{icman.DATA_FILE_EXT}'
+    icman.IcMan._SaveIconConf(str(fp), icons, 'json')
+    return fp
+
+
+def test_catalog_refresh(tmp_path, monkeypatch):
+    _WriteProfile(tmp_path, 'a', 1)
+    b = _WriteProfile(tmp_path, 'b', 2)
+    cat = icman.ProfileCatalog(str(tmp_path))
+    cat.Refresh()
+    assert {n: e.count for n, e in cat.entries.items()} == {'a': 1, 'b': 2}
+    assert cat.entries['a'].layout == '1920x1080'
+
+    scanned = []
+    scan = icman.ProfileCatalog._Scan
+    monkeypatch.setattr(icman.ProfileCatalog, '_Scan',
+                        lambda self, fp_, st_: scanned.append(fp_) or
+                        scan(self, fp_, st_))
+    # a new instance reads the saved catalog and parses nothing unchanged
+    cat = icman.ProfileCatalog(str(tmp_path))
+    cat.Refresh()
+    assert scanned == [] and set(cat.entries) == {'a', 'b'}
+
+    _WriteProfile(tmp_path, 'b', 5)
+    os.utime(b, ns=(1, 1))
+    _WriteProfile(tmp_path, 'c', 3)
+    os.remove(tmp_path / f'a.{icman.DATA_FILE_EXT}')
+    cat.Refresh()
+    assert sorted(scanned) == [
+        str(b), str(tmp_path / f'c.{icman.DATA_FILE_EXT}')]
+    assert {n: e.count for n, e in cat.entries.items()} == {'b': 5, 'c': 3}
+
+
+def test_catalog_free_name(tmp_path):
+    cat = icman.ProfileCatalog(str(tmp_path))
+    cat.Refresh()
+    assert cat.FreeName('x') == 'x'
+    _WriteProfile(tmp_path, 'x', 1)
+    _WriteProfile(tmp_path, 'x_1', 1)
+    cat.Refresh()
+    first = cat.FreeName('x')
+    assert first == 'x_2'
+    _WriteProfile(tmp_path, first, 1)
+    # taken on disk without a refresh of the catalog
+    _WriteProfile(tmp_path, 'x_3', 1)
+    assert cat.FreeName('x') == 'x_4'